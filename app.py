@@ -1,56 +1,252 @@
 """
 Main Flask application file
-- Initializes Flask app and extensions
+- create_app builds the Flask app and binds the extensions to it
 - Registers routes and error handlers
 - Configures WebSocket events
-- Sets up database connection
+- Importing this module reads no settings and opens no database; the schema is created by flask --app app migrate
 """ 
 
-from flask import Flask, redirect, url_for, session, render_template, request
-from flask_socketio import SocketIO, emit, join_room, leave_room
-from functools import wraps
+from flask import Flask, Blueprint, Response, current_app, redirect, url_for, session, render_template, request, jsonify, abort, send_file
+from flask import stream_with_context
+from flask_socketio import emit, join_room, leave_room
+from functools import wraps, partial
 from database import *
 from crypto import *
-from dotenv import load_dotenv
+from config import load_config
+from ops import register_commands
+from presence import PresenceRegistry
+from workers import BoundedPool, PoolBusy, PoolTimeout
+from groupcommit import GroupCommitQueue
+from broker import LocalBrokerManager
+from metrics import MetricsRegistry, InstrumentedSocketIO
+from archive import MessageArchive
+from attachments import AttachmentStore, UploadRejected
+from membership import MembershipIndex
+from throttling import RateLimiter, RoomCoalescer, parse_limit, parse_limits
+from backup import export_chunks, gzip_chunks
+from verification import SignatureVerifier, verification_item, verify_messages, signed_with_current_keys
+from recorder import TrafficRecorder
 import os
 import sys
+import signal
 import click
-import base64
+import contextvars
+
+try:
+    import msgpack # Optional, lets clients ask for msgpack encoded payloads
+except ImportError:
+    msgpack = None
 
-# Load environment variables
-load_dotenv()
-MASTER_KEY = base64.b64decode(os.getenv('MASTER_KEY'))
-PEPPER = base64.b64decode(os.getenv('PEPPER'))
 CHAT_ROOM_LIMIT = 5
-ssl_cert_path = os.getenv('SSL_CERT_PATH')
-ssl_key_path = os.getenv('SSL_KEY_PATH')
-PORT = os.getenv('PORT')
-HOST = os.getenv('HOST')
-DEBUG = (os.getenv('DEBUG') == 'True')
+HISTORY_PAGE_SIZE = 50 # Messages sent when a room is opened and per scroll-back page
+HISTORY_PAGE_LIMIT = 200 # Largest page a client may ask for
+PUBLIC_KEY_QUERY_LIMIT = 200 # Most users whose public keys one query_public_keys call may ask for
+ROOM_KEY_QUERY_LIMIT = 100 # Most key epochs one query_room_keys call may ask for
+USER_SEARCH_PAGE_SIZE = 10 # Users one search_users call returns by default
+USER_SEARCH_PAGE_LIMIT = 50 # Most users one search_users call may ask for
+USER_SEARCH_PREFIX_LIMIT = 64 # Longest prefix search_users looks up
+PRESENCE_FLUSH_INTERVAL = 2 # Seconds between writes of online status to the database
+BUSY_RETRY_AFTER = 1 # Seconds clients should wait after a 503
+# Settings read from the environment are in app.config, see config.py
+
+## Extensions ##
+# Created without an app, so importing this module stays cheap; create_app binds them
+metrics = MetricsRegistry()
+socketio = InstrumentedSocketIO(metrics=metrics)
+pages = Blueprint('pages', __name__)
+debug_pages = Blueprint('debug', __name__) # Only registered when DEBUG is set
+
+# Who is in which chat room, checked on every room-scoped socket event; loaded from the database on first use
+membership = MembershipIndex()
+
+# Built by create_app from the app's settings
+password_pool = None # bcrypt runs here so it does not block the event loop
+database_pool = None # Database calls run here so a slow query or lock wait does not stall every other socket
+message_queue = None # Batches message inserts into one commit when MESSAGE_GROUP_COMMIT is enabled
+message_archive = None # Messages moved out of the database by archive-messages
+attachment_store = None # Encrypted files uploaded with /api/attachments
+rate_limiter = None # Per-connection token buckets; clients over budget get a throttled event
+room_refresh = None # Collapses bursts of requery_room notifications into one per room
+signature_pool = None # Checks message signatures when SIGNATURE_VERIFICATION is enabled
+signature_verifier = None # Queues stored messages for signature_pool
+
+# Background tasks, started by the first connection or message that needs them
+presence_task = None
+message_queue_task = None
 
 ## Configuration ##
-app = Flask(__name__)
-socketio = SocketIO(app)
-app.secret_key = os.urandom(24) # Required for session management
+# Builds the app from the environment; config overrides individual settings (see config.py for their names)
+# Nothing here touches the database: the schema is created by the migrate command, and the online status
+# reset and the membership index wait for the first connection and room event
+def create_app(config: dict = None) -> Flask:
+    global password_pool, database_pool, message_queue, message_archive, attachment_store, rate_limiter, room_refresh
+    global signature_pool, signature_verifier
+    app = Flask(__name__)
+    app.config.update(load_config())
+    app.config.update(config or {})
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    queue_url = app.config['SOCKETIO_MESSAGE_QUEUE']
+    if queue_url and not app.config['SECRET_KEY']:
+        raise RuntimeError("SECRET_KEY must be set when SOCKETIO_MESSAGE_QUEUE is used, so every worker accepts the same sessions")
+    app.secret_key = app.config['SECRET_KEY'] or os.urandom(24) # Required for session management
+
+    configure_database(app)
+    db.init_app(app)
+    metrics.init_app(app)
+    # With a message queue, emits reach clients connected to any worker
+    if queue_url and queue_url.startswith('tcp://'):
+        socketio.init_app(app, client_manager=LocalBrokerManager(queue_url))
+    elif queue_url:
+        socketio.init_app(app, message_queue=queue_url)
+    else:
+        socketio.init_app(app)
+    app.register_blueprint(pages)
+    if app.config['DEBUG']:
+        app.register_blueprint(debug_pages)
+    register_commands(app)
+
+    password_pool = BoundedPool('password', kind=app.config['PASSWORD_POOL_KIND'], workers=app.config['PASSWORD_POOL_SIZE'],
+                                queue_limit=app.config['PASSWORD_QUEUE_LIMIT'], sleep=socketio.sleep)
+    database_pool = BoundedPool('database', kind='thread', workers=app.config['DB_POOL_SIZE'],
+                                queue_limit=app.config['DB_QUEUE_LIMIT'], sleep=socketio.sleep)
+    if app.config['MESSAGE_GROUP_COMMIT']:
+        message_queue = GroupCommitQueue(lambda rows: db_call(db_create_messages, rows), max_batch=app.config['MESSAGE_BATCH_SIZE'],
+                                         max_delay=app.config['MESSAGE_BATCH_DELAY'],
+                                         create_event=socketio.server.eio.create_event, sleep=socketio.sleep)
+    message_archive = MessageArchive(app.config['ARCHIVE_DIR'])
+    attachment_store = AttachmentStore(app.config['ATTACHMENT_DIR'])
+    rate_limiter = RateLimiter(parse_limit(app.config['RATE_LIMIT_CONNECTION']), parse_limits(app.config['RATE_LIMITS']))
+    room_refresh = RoomCoalescer(lambda room_id: socketio.emit('requery_room', room=room_id), window=app.config['ROOM_REFRESH_WINDOW'],
+                                 start_task=socketio.start_background_task, sleep=socketio.sleep)
+    # Anonymized trace of every socket event, for benchmarks/replay.py
+    socketio.recorder = TrafficRecorder(app.config['TRAFFIC_TRACE_DIR'], max_events=app.config['TRAFFIC_TRACE_MAX_EVENTS'],
+                                        start_task=socketio.start_background_task, sleep=socketio.sleep) \
+        if app.config['TRAFFIC_TRACE_DIR'] else None
+    if app.config['SIGNATURE_VERIFICATION']:
+        signature_pool = BoundedPool('signature', kind=app.config['SIGNATURE_POOL_KIND'], workers=app.config['SIGNATURE_POOL_SIZE'],
+                                     queue_limit=app.config['SIGNATURE_QUEUE_LIMIT'], sleep=socketio.sleep)
+        signature_verifier = SignatureVerifier(lambda message_ids: run_in_app_context(app, verify_stored_messages, message_ids),
+                                               max_batch=app.config['SIGNATURE_BATCH_SIZE'], max_delay=app.config['SIGNATURE_BATCH_DELAY'],
+                                               start_task=socketio.start_background_task, sleep=socketio.sleep,
+                                               logger=app.logger)
+    return app
+
+# A SQLite file gets one writer connection, so writes queue in the pool instead of failing on the database lock,
+# and a pool of reader connections, which WAL mode lets read while a write is in progress
+def configure_database(app: Flask):
+    database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if database_uri.startswith('sqlite:') and database_uri != 'sqlite://' and ':memory:' not in database_uri:
+        sqlite_args = {'timeout': app.config['SQLITE_BUSY_TIMEOUT'], 'check_same_thread': False}
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 1, 'max_overflow': 0, 'pool_timeout': app.config['DB_CALL_TIMEOUT'],
+                                                   'connect_args': sqlite_args}
+        app.config['SQLALCHEMY_BINDS'] = {'reader': {'url': database_uri, 'pool_size': max(app.config['DB_POOL_SIZE'], 1),
+                                                     'max_overflow': 8, 'connect_args': sqlite_args}}
+
+# Runs fn(*args) on the database pool, in its own app context and session, and returns its result
+# Raises PoolBusy when the pool is full and PoolTimeout after DB_CALL_TIMEOUT
+# Returned model objects are detached from the session, with their columns loaded
+def db_call(fn, *args):
+    app = current_app._get_current_object()
+    return database_pool.run(contextvars.copy_context().run, run_in_app_context, app, fn, *args,
+                             timeout=app.config['DB_CALL_TIMEOUT'])
+
+def run_in_app_context(app: Flask, fn, *args):
+    with app.app_context():
+        return fn(*args)
 
-WIN = sys.platform.startswith('win')
-prefix = 'sqlite:///' if WIN else 'sqlite:////'
+# Starts the group commit writer with the first message sent
+def start_message_queue():
+    global message_queue_task
+    if message_queue_task is None:
+        message_queue_task = socketio.start_background_task(message_queue.run_forever, current_app._get_current_object().app_context)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = prefix + 'securechat.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Checks the signatures of stored messages on the signature pool and saves the results
+# Messages signed with keys the sender has since replaced are left unchecked
+# Returns {message_id: verified} for the messages checked
+def verify_stored_messages(message_ids: list) -> dict:
+    rows = [row for row in db_call(db_get_messages_to_verify, message_ids) if signed_with_current_keys(row)]
+    items = [verification_item(row, current_app.config['MASTER_KEY']) for row in rows]
+    verified = signature_pool.run(verify_messages, items, timeout=current_app.config['DB_CALL_TIMEOUT'])
+    results = {row[0]: result for row, result in zip(rows, verified)}
+    db_call(db_set_messages_verified, results)
+    return results
 
-db.init_app(app)
+## Presence ##
+presence = PresenceRegistry()
 
-# Create database tables
-with app.app_context():
-    db.create_all()
+# Periodically writes buffered online status changes to the database
+# Started by the first connection: no socket was connected before it, so nobody is online yet
+# With several workers, other workers may still have users online, so nothing is reset
+def persist_presence(app: Flask):
+    with app.app_context():
+        if not app.config['SOCKETIO_MESSAGE_QUEUE']:
+            db_call(db_reset_online_statuses)
+        while True:
+            socketio.sleep(PRESENCE_FLUSH_INTERVAL)
+            try:
+                db_call(presence.flush)
+            except Exception as e:
+                click.echo(f"Failed to persist presence: {e}")
+
+# Gauges served from /metrics alongside the per-handler metrics
+metrics.add_collector('key_cache', 'cache', key_cache_stats)
+metrics.add_collector('worker_pool', 'pool', lambda: {"password": password_pool.stats(), "database": database_pool.stats(),
+                                                      **({"signature": signature_pool.stats()} if signature_pool is not None else {})})
+metrics.add_collector('signature_verifier', 'queue', lambda: {"messages": signature_verifier.stats()} if signature_verifier is not None else {})
+metrics.add_collector('message_queue', 'queue', lambda: {"messages": message_queue.stats()} if message_queue is not None else {})
+metrics.add_collector('rate_limit', 'event', lambda: rate_limiter.stats())
+metrics.add_collector('room_refresh', 'event', lambda: {"requery_room": room_refresh.stats()})
+metrics.add_collector('presence', 'worker', lambda: {"local": {"online_users": presence.online_count()}})
+metrics.add_collector('membership', 'worker', lambda: {"local": membership.stats()})
+metrics.add_collector('traffic_recorder', 'trace', lambda: {"socketio": socketio.recorder.stats()} if socketio.recorder is not None else {})
+
+# Whether the user is a participant in the chat room
+# The in-memory index only sees this worker's changes, so with several workers the database is asked instead
+def is_room_member(room_id: int, user_id: int) -> bool:
+    if current_app.config['MEMBERSHIP_INDEX'] and not current_app.config['SOCKETIO_MESSAGE_QUEUE']:
+        if not membership.loaded:
+            db_call(membership.ensure_loaded, db_get_chat_participant_pairs)
+        return membership.is_member(int(room_id), user_id)
+    return db_call(db_is_chat_participant, room_id, user_id)
+
+# Tells every room the user is in that they came online or went offline
+def emit_presence_changed(user_id: int, is_online: bool):
+    for room in db_call(db_get_user_chat_sessions, user_id):
+        emit('presence_changed', {"room_id": room.id, "user_id": user_id, "is_online": is_online}, room=room.id)
 
 ## Authentication Decorators for Flask and SocketIO ##
+# Operator routes need the token in the setting token_key as a bearer token, or DEBUG mode when no token is configured
+def token_access_required(token_key: str):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            token = current_app.config[token_key]
+            if token:
+                if request.headers.get('Authorization') != f"Bearer {token}":
+                    abort(403)
+            elif not current_app.config['DEBUG']:
+                abort(404)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+metrics_access_required = token_access_required('METRICS_TOKEN')
+export_access_required = token_access_required('EXPORT_TOKEN')
+
 def login_required_flask(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user_id' not in session:
-            return redirect(url_for('login'))
+            return redirect(url_for('pages.login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+# API routes answer 401 instead of redirecting to the login page
+def login_required_api(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            return "Not logged in", 401
         return f(*args, **kwargs)
     return decorated_function
 
@@ -62,168 +258,477 @@ def login_required_socketio(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Rejects calls over the connection's budget for the event, telling the client when to retry
+def rate_limited_socketio(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if current_app.config['RATE_LIMITING']:
+            event = request.event['message']
+            retry_after = rate_limiter.check(request.sid, event)
+            if retry_after:
+                emit('throttled', {"event": event, "retry_after": round(retry_after, 3)})
+                return {"error": "throttled", "retry_after": round(retry_after, 3)}
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Rejects room-scoped events from users who are not participants in data['room_id']
+def room_member_required_socketio(f):
+    @wraps(f)
+    def decorated_function(data, *args, **kwargs):
+        if not is_room_member(data['room_id'], session['user_id']):
+            return {"error": "not a participant"}
+        return f(data, *args, **kwargs)
+    return decorated_function
+
+## Payload Helpers ##
+# Clients choose a payload format when connecting, e.g. io({auth: {payload_format: 'compact', encoding: 'msgpack'}})
+# - legacy (default): participants carry their full public keys, messages are a list of objects
+# - compact: participants carry key fingerprints (keys are fetched with query_public_keys),
+#   messages are sent as one array per field
+# - msgpack encoding (compact only, needs the msgpack package): replies are sent as binary msgpack
+# Room broadcasts (new_message, participant_added, ...) are the same for every client
+
+# Whether the user has a live socket
+# With several workers, sockets on other workers are only known from the database, as of their last flush
+def is_user_online(user) -> bool:
+    if presence.is_online(user.id):
+        return True
+    return bool(current_app.config['SOCKETIO_MESSAGE_QUEUE'] and user.is_online)
+
+# Client-facing representation of a participant in a chat room
+def serialize_participant(user) -> dict:
+    return {"id": user.id, "username": user.username, "is_online": is_user_online(user),
+            "rsa_public_key": user.public_key_rsa, "dsa_public_key": user.public_key_dsa,
+            "rsa_fingerprint": public_key_fingerprint(user.public_key_rsa),
+            "dsa_fingerprint": public_key_fingerprint(user.public_key_dsa)}
+
+# Compact representation of a participant, with fingerprints in place of public keys
+def serialize_participant_compact(user) -> dict:
+    return {"id": user.id, "username": user.username, "is_online": is_user_online(user),
+            "rsa_fingerprint": public_key_fingerprint(user.public_key_rsa),
+            "dsa_fingerprint": public_key_fingerprint(user.public_key_dsa)}
+
+# Client-facing representation of a stored message
+def serialize_message(msg) -> dict:
+    return {"id": msg.id, "sender_id": msg.sender_id, "created_at": str(msg.created_at.strftime('%m-%d %H:%M:%S')),
+            "content": msg.content, "signatures": {"RSA": msg.rsa_signature, "DSA": msg.dsa_signature},
+            "key_epoch": msg.key_epoch, "attachment": serialize_attachment(msg), "verified": msg.verified}
+
+# A message's attachment as {id, size}, or None; the file is fetched from /api/attachments/<id>
+def serialize_attachment(msg):
+    if msg.attachment_id is None:
+        return None
+    return {"id": msg.attachment_id, "size": msg.attachment_size}
+
+# Compact representation of a list of messages, one array per field
+def serialize_messages_compact(messages) -> dict:
+    return {"id": [msg.id for msg in messages],
+            "sender_id": [msg.sender_id for msg in messages],
+            "created_at": [str(msg.created_at.strftime('%m-%d %H:%M:%S')) for msg in messages],
+            "content": [msg.content for msg in messages],
+            "rsa_signature": [msg.rsa_signature for msg in messages],
+            "dsa_signature": [msg.dsa_signature for msg in messages],
+            "key_epoch": [msg.key_epoch for msg in messages],
+            "attachment_id": [msg.attachment_id for msg in messages],
+            "attachment_size": [msg.attachment_size for msg in messages],
+            "verified": [msg.verified for msg in messages]}
+
+# Room list entry with the user's unread count, from the counters on the chat session and participant rows
+def serialize_room_summary(room, participant) -> dict:
+    return {"id": room.id, "name": room.name, "unread": max(room.message_count - participant.read_count, 0),
+            "last_message_id": room.last_message_id,
+            "last_message_at": room.last_message_at.isoformat() if room.last_message_at else None,
+            "last_read_message_id": participant.last_read_message_id}
+
+# A new room key, encrypted with the master key
+def new_encrypted_room_key() -> str:
+    return encrypt_AES(generate_symmetric_key(), current_app.config['MASTER_KEY']).decode()
+
+# Returns {epoch: room key wrapped with the user's RSA public key} for the given {epoch: encrypted key}
+def wrap_room_keys(room_id: int, user, encrypted_keys: dict) -> dict:
+    master_key = current_app.config['MASTER_KEY']
+    return {epoch: get_wrapped_room_key(room_id, epoch, user.id, encrypted_key, user.public_key_rsa, master_key)
+            for epoch, encrypted_key in encrypted_keys.items()}
+
+# Returns up to limit messages of a chat room older than before_message_id (or the latest ones), oldest first
+# Reads from the archive once the client scrolls past the messages still in the database
+def get_history_page(room_id: int, limit: int, before_message_id: int = None) -> list:
+    messages = db_get_messages_page(room_id, limit, before_message_id)
+    if len(messages) < limit:
+        older_than = messages[0].id if messages else before_message_id
+        messages = message_archive.get_page(room_id, limit - len(messages), older_than) + messages
+    return messages
+
+# Participants in the format the current client asked for
+def serialize_participants(users) -> list:
+    if session.get('compact_payloads'):
+        return [serialize_participant_compact(user) for user in users]
+    return [serialize_participant(user) for user in users]
+
+# Messages in the format the current client asked for
+def serialize_messages(messages):
+    if session.get('compact_payloads'):
+        return serialize_messages_compact(messages)
+    return [serialize_message(msg) for msg in messages]
+
+# Replies to the current client in the format and encoding it asked for
+def emit_reply(event: str, payload: dict):
+    if session.get('compact_payloads'):
+        payload["format"] = "compact"
+    if session.get('msgpack_payloads'):
+        payload = msgpack.packb(payload)
+    emit(event, payload)
+
+# Too many logins/registrations are waiting for the password pool
+@pages.app_errorhandler(PoolBusy)
+@pages.app_errorhandler(PoolTimeout)
+def handle_pool_busy(e):
+    return "Server busy, try again shortly", 503, {"Retry-After": str(BUSY_RETRY_AFTER)}
+
+# Socket events that hit a full or slow pool tell the client to retry instead of failing silently
+@socketio.on_error_default
+def handle_socketio_error(e):
+    if isinstance(e, (PoolBusy, PoolTimeout)):
+        emit('server_busy', {"event": request.event['message'], "retry_after": BUSY_RETRY_AFTER})
+        return {"error": "busy", "retry_after": BUSY_RETRY_AFTER}
+    raise e
+
 ## HTML Page Routes ##
-@app.route('/')
+@pages.route('/')
 def index():
     if 'user_id' in session:
-        return redirect(url_for('chat', session_id=session['user_id']))
+        return redirect(url_for('pages.chat', session_id=session['user_id']))
     else:
-        return redirect(url_for('login'))
+        return redirect(url_for('pages.login'))
 
-@app.route('/login')
+@pages.route('/login')
 def login():
     if 'user_id' in session:
-        return redirect(url_for('chat'))
+        return redirect(url_for('pages.chat'))
     return render_template('login.html')
 
-@app.route('/register')
+@pages.route('/register')
 def register():
     return render_template('register.html')
 
-@app.route('/chat')
+@pages.route('/chat')
 @login_required_flask
 def chat():
     return render_template('chat.html')
 
 ## Web Socket Event Handlers ##
-# When a user connects, update their online status
-# And tell clients to requery the chat rooms they are in
+# When a user's first socket connects, mark them online
+# And tell the chat rooms they are in
 @socketio.on('connect')
 @login_required_socketio
-def handle_connect():
+def handle_connect(auth=None):
+    global presence_task
     user_id = session['user_id']
     if not user_id:
         return
-    else:
-        db_update_online_status(user_id, True)
-        for room in db_get_user_chat_sessions(session['user_id']):
-            emit('requery_room', room=room.id)
+    options = auth if isinstance(auth, dict) else {}
+    session['compact_payloads'] = options.get('payload_format') == 'compact'
+    session['msgpack_payloads'] = session['compact_payloads'] and options.get('encoding') == 'msgpack' and msgpack is not None
+    if presence_task is None:
+        presence_task = socketio.start_background_task(persist_presence, current_app._get_current_object())
+    if presence.connect(user_id, request.sid):
+        emit_presence_changed(user_id, True)
 
-# When a user disconnects, update their online status
-# And tell clients to requery the chat rooms they are in
+# When a user's last socket disconnects, mark them offline
+# And tell the chat rooms they are in
 @socketio.on('disconnect')
 @login_required_socketio
 def handle_disconnect():
     user_id = session['user_id']
     if not user_id:
         return
-    else:
-        db_update_online_status(user_id, False)
-        for room in db_get_user_chat_sessions(session['user_id']):
-            emit('requery_room', room=room.id)
+    rate_limiter.forget(request.sid)
+    if presence.disconnect(user_id, request.sid):
+        emit_presence_changed(user_id, False)
 
 # Add a user to a chat room
 # Only the owner of the chat room can add users
 @socketio.on('add_user_to_chat')
 @login_required_socketio
+@rate_limited_socketio
 def handle_add_user_to_chat(data):
     room_id = data['room_id']
     user_id = data['user_id']
-    chat_session = db_get_chat_session(room_id)
-    if chat_session.owner_id != session['user_id']:
-        return
-    db_add_chat_participant(room_id, user_id)
-    emit('requery_room', room=room_id)
+    owner_id = session['user_id']
+    def add_participant():
+        if db_get_chat_session(room_id).owner_id != owner_id:
+            return None
+        if not db_add_chat_participant(room_id, user_id):
+            return None
+        membership.add(room_id, user_id)
+        return db_get_user_by_id(user_id)
+    user = db_call(add_participant)
+    if user is not None:
+        emit('participant_added', {"room_id": room_id, "participant": serialize_participant(user)}, room=room_id)
 
 # Remove a user from a chat room
-# Any user can remove themselves from a chat room
+# Any participant can remove themselves; only the room's owner can remove someone else
 @socketio.on('remove_user_from_chat')
 @login_required_socketio
+@rate_limited_socketio
+@room_member_required_socketio
 def handle_remove_user_from_chat(data):
     room_id = data['room_id']
-    user_id = data['user_id']
-    if user_id != session['user_id'] and user_id != db_get_chat_session(room_id).owner_id:
-        return
-    if db_remove_chat_participant(room_id, user_id):
-        emit('requery_room', room=room_id)
+    user_id = int(data['user_id'])
+    current_user_id = session['user_id']
+    # Returns whether the user was removed and the room's new key epoch, if its key was rotated
+    def remove_participant():
+        if user_id != current_user_id and current_user_id != db_get_chat_session(room_id).owner_id:
+            return False, None
+        if not db_remove_chat_participant(room_id, user_id):
+            return False, None
+        membership.remove(room_id, user_id)
+        if not current_app.config['ROTATE_KEYS_ON_REMOVE']:
+            return True, None
+        return True, db_add_room_key_epochs({room_id: new_encrypted_room_key()})[room_id]
+    removed, key_epoch = db_call(remove_participant)
+    if removed:
+        emit('participant_removed', {"room_id": room_id, "user_id": user_id}, room=room_id)
+        # Take the removed user's sockets out of the room, so they stop receiving its messages and notifications
+        # Only this worker's sockets are known here; clients on other workers leave when told participant_removed
+        for sid in presence.sockets(user_id):
+            leave_room(room_id, sid=sid, namespace='/')
+    if key_epoch is not None:
+        # The removed user cannot fetch the new key, so they cannot read messages sent from now on
+        emit('room_key_rotated', {"room_id": room_id, "key_epoch": key_epoch}, room=room_id)
 
 # Send a message to a chat room
+# The stored message is pushed to the room once instead of making every client requery
+# It is only pushed, and the sender only acknowledged, once it has been committed
 @socketio.on('send_message_to_room')
 @login_required_socketio
+@rate_limited_socketio
+@room_member_required_socketio
 def handle_send_message_to_room(data):
-    room_id = data['room_id']
+    room_id = int(data['room_id'])
     user_id = data['user_id']
+    if user_id != session['user_id']:
+        return {"error": "user_id is not the logged in user"}
     message = data['message']
     rsa_signature = data['rsa_signature']
     dsa_signature = data['dsa_signature']
-    db_create_message(room_id, user_id, message, rsa_signature, dsa_signature)
-    emit('requery_room', room=room_id)
+    # A message may carry one attachment, fully uploaded to this room by the sender
+    attachment_id = data.get('attachment_id')
+    def load_room_state():
+        return db_get_chat_session(room_id).key_epoch, db_get_attachment(attachment_id) if attachment_id is not None else None
+    current_epoch, attachment = db_call(load_room_state)
+    # Only the room's current key is accepted: a removed participant still holds the previous one,
+    # and a made-up epoch could never be decrypted. Clients that do not send the epoch encrypt with the current key.
+    key_epoch = data.get('key_epoch')
+    if key_epoch is None:
+        key_epoch = current_epoch
+    elif key_epoch != current_epoch:
+        return {"error": "stale key epoch", "key_epoch": current_epoch}
+    attachment_size = None
+    if attachment_id is not None:
+        if attachment is None or not attachment.complete or attachment.session_id != room_id \
+                or attachment.uploader_id != session['user_id']:
+            return {"error": "invalid attachment"}
+        attachment_size = attachment.size
+    if message_queue is not None:
+        start_message_queue()
+        stored_message = message_queue.submit({"session_id": room_id, "sender_id": user_id, "content": message,
+                                               "rsa": rsa_signature, "dsa": dsa_signature, "key_epoch": key_epoch,
+                                               "attachment_id": attachment_id, "attachment_size": attachment_size,
+                                               "signing_keys": session.get('signing_keys')})
+    else:
+        stored_message = db_call(db_create_message, room_id, user_id, message, rsa_signature, dsa_signature, key_epoch,
+                                 attachment_id, attachment_size, session.get('signing_keys'))
+    if signature_verifier is not None:
+        signature_verifier.submit(stored_message.id)
+    emit('new_message', {"room_id": room_id, "message": serialize_message(stored_message)}, room=room_id)
+    return {"message_id": stored_message.id}
 
 # Create a new chat room and add the owner as a participant
 @socketio.on('create_chat_room')
 @login_required_socketio
+@rate_limited_socketio
 def handle_create_chat_room(data):
-    rooms = db_get_user_chat_sessions(session['user_id'])
+    owner_id = session['user_id']
+    rooms = db_call(db_get_user_chat_sessions, owner_id)
     if len(rooms) >= CHAT_ROOM_LIMIT:
-        click.echo(f"User {session['user_id']} has reached the chat room limit")
+        click.echo(f"User {owner_id} has reached the chat room limit")
         return
-    symm_key = generate_symmetric_key()
-    click.echo(f"Symmetric key: {symm_key.decode()} for chat session {data['chat_name']}")
-    enc_key = encrypt_AES(symm_key, MASTER_KEY)
-    click.echo(f"Encrypted symmetric key: {enc_key.decode()} for chat session {data['chat_name']}")
-    chat_session = db_create_chat_session(name=data['chat_name'], owner_id=session['user_id'], encrypted_symmetric_key=enc_key.decode())
-    db_add_chat_participant(session_id=chat_session.id, user_id=session['user_id'])
+    enc_key = new_encrypted_room_key()
+    def create_room():
+        chat_session = db_create_chat_session(name=data['chat_name'], owner_id=owner_id, encrypted_symmetric_key=enc_key)
+        db_add_chat_participant(session_id=chat_session.id, user_id=owner_id)
+        membership.add(chat_session.id, owner_id)
+        return chat_session
+    chat_session = db_call(create_room)
     emit('chat_created', {"room_id": chat_session.id})
 
 # Join a chat room
 @socketio.on('join_room')
 @login_required_socketio
+@rate_limited_socketio
+@room_member_required_socketio
 def handle_join_room(data):
-    room_id = data['room_id']
+    room_id = int(data['room_id'])
     join_room(room_id)
-    emit('requery_room', room=room_id)
+    room_refresh.notify(room_id)
 
 # Leave a chat room
 @socketio.on('leave_room')
 @login_required_socketio
+@rate_limited_socketio
 def handle_leave_room(data):
-    room_id = data['room_id']
+    room_id = int(data['room_id'])
     leave_room(room_id)
-    emit('requery_room', room=room_id)
+    # Leaving needs no membership, but only members may make the room's clients requery
+    if is_room_member(room_id, session['user_id']):
+        room_refresh.notify(room_id)
 
 # Sends all information about a chat room to the client
+# Only the latest page of messages is sent; older messages are fetched with query_chat_history
+# If since_message_id is given, only messages newer than it are sent (e.g. after a reconnect)
+# A client more than HISTORY_PAGE_LIMIT messages behind gets the latest page instead, with since_message_id null,
+# so catching up never loads an unbounded part of the history
+# Room keys are sent for the current epoch and the epochs of the messages sent
 @socketio.on('query_chat_room')
 @login_required_socketio
+@rate_limited_socketio
+@room_member_required_socketio
 def handle_query_chat_room(data):
     room_id = data['room_id']
-    session_users = db_get_chat_session_users(room_id)
-    session_messages = db_get_messages(room_id)
-    encrypted_session_key = db_get_chat_session_encrypted_symmetric_key(room_id)
-    user = db_get_user_by_id(session['user_id'])
-    unencrypted_session_key = decrypt_AES(encrypted_session_key, MASTER_KEY)
-    user_encrypted_key = encrypt_key_RSA(base64.b64decode(unencrypted_session_key), user.public_key_rsa)
+    since_message_id = data.get('since_message_id')
+    user_id = session['user_id']
+    def load_room(since_message_id):
+        if since_message_id is not None:
+            session_messages = db_get_messages_since(room_id, int(since_message_id), HISTORY_PAGE_LIMIT + 1)
+            if len(session_messages) > HISTORY_PAGE_LIMIT:
+                since_message_id = None # Too far behind: the latest page replaces what the client has
+        if since_message_id is None:
+            session_messages = get_history_page(room_id, HISTORY_PAGE_SIZE + 1)
+        chat_session = db_get_chat_session(room_id)
+        epochs = {msg.key_epoch for msg in session_messages} - {chat_session.key_epoch}
+        encrypted_keys = db_get_room_keys(room_id, list(epochs)) if epochs else {}
+        encrypted_keys[chat_session.key_epoch] = chat_session.encrypted_symmetric_key
+        return (since_message_id, chat_session, db_get_chat_session_users(room_id), session_messages,
+                db_get_user_by_id(user_id), encrypted_keys)
+    since_message_id, chat_session, session_users, session_messages, user, encrypted_keys = db_call(load_room, since_message_id)
+    has_more = None
+    if since_message_id is None:
+        has_more = len(session_messages) > HISTORY_PAGE_SIZE
+        session_messages = session_messages[-HISTORY_PAGE_SIZE:]
+    user_encrypted_keys = wrap_room_keys(room_id, user, encrypted_keys)
     payload= {
         "room_id": room_id, 
-        "room_name": db_get_chat_session(room_id).name,
-        "participants": [{"id": user.id, "username": user.username, "is_online": user.is_online, "rsa_public_key": user.public_key_rsa, "dsa_public_key": user.public_key_dsa} for user in session_users] if session_users else [],
-        "messages": [{"id": msg.id, "sender_id": msg.sender_id, "created_at": str(msg.created_at.strftime('%m-%d %H:%M:%S')),\
-                       "content": msg.content, "signatures": {"RSA": msg.rsa_signature, "DSA": msg.dsa_signature}} for msg in session_messages] if session_messages else [],
-        "   ": user_encrypted_key,
+        "room_name": chat_session.name,
+        "participants": serialize_participants(session_users or []),
+        "messages": serialize_messages(session_messages or []),
+        "since_message_id": since_message_id,
+        "has_more": has_more,
+        "user_encrypted_key": user_encrypted_keys[chat_session.key_epoch],
+        "key_epoch": chat_session.key_epoch,
+        "user_encrypted_keys": user_encrypted_keys,
     }
-    emit('res_query_chat_room', payload)
+    emit_reply('res_query_chat_room', payload)
+
+# Sends one page of older messages in a chat room, for scrolling back through history
+@socketio.on('query_chat_history')
+@login_required_socketio
+@rate_limited_socketio
+@room_member_required_socketio
+def handle_query_chat_history(data):
+    room_id = data['room_id']
+    before_message_id = data.get('before_message_id')
+    limit = max(1, min(int(data.get('limit', HISTORY_PAGE_SIZE)), HISTORY_PAGE_LIMIT))
+    session_messages = db_call(get_history_page, room_id, limit + 1, before_message_id)
+    emit_reply('res_query_chat_history', {
+        "room_id": room_id,
+        "before_message_id": before_message_id,
+        "messages": serialize_messages(session_messages[-limit:]),
+        "has_more": len(session_messages) > limit,
+    })
+
+# Sends the room keys of the given epochs, for messages whose epoch the client has no key for yet
+# Only participants get keys, so a removed user cannot read messages sent after the key was rotated
+@socketio.on('query_room_keys')
+@login_required_socketio
+@rate_limited_socketio
+@room_member_required_socketio
+def handle_query_room_keys(data):
+    room_id = data['room_id']
+    epochs = [int(epoch) for epoch in data.get('epochs', [])[:ROOM_KEY_QUERY_LIMIT]]
+    user_id = session['user_id']
+    def load_keys():
+        return db_get_user_by_id(user_id), db_get_room_keys(room_id, epochs)
+    user, encrypted_keys = db_call(load_keys)
+    emit_reply('res_query_room_keys', {"room_id": room_id, "user_encrypted_keys": wrap_room_keys(room_id, user, encrypted_keys)})
+
+# Sends the public keys of the given users, for clients that only received fingerprints
+@socketio.on('query_public_keys')
+@login_required_socketio
+@rate_limited_socketio
+def handle_query_public_keys(data):
+    user_ids = [int(user_id) for user_id in data.get('user_ids', [])[:PUBLIC_KEY_QUERY_LIMIT]]
+    users = db_call(db_get_users_by_ids, user_ids) if user_ids else []
+    emit_reply('res_query_public_keys', {
+        "keys": [{"user_id": user.id,
+                  "rsa_fingerprint": public_key_fingerprint(user.public_key_rsa), "rsa_public_key": user.public_key_rsa,
+                  "dsa_fingerprint": public_key_fingerprint(user.public_key_dsa), "dsa_public_key": user.public_key_dsa}
+                 for user in users],
+    })
 
 # Sends all chat rooms the user is a part of
 @socketio.on('query_user_chat_rooms')
 @login_required_socketio
+@rate_limited_socketio
 def handle_query_user_chat_rooms():
-    rooms = db_get_user_chat_sessions(session['user_id'])
+    rooms = db_call(db_get_user_chat_rooms, session['user_id'])
     emit('res_query_user_chat_rooms', {
-        "chat_rooms": [{"id": room.id, "name": room.name} for room in rooms],
+        "chat_rooms": [serialize_room_summary(room, participant) for room, participant in rooms],
     })
 
+# Moves the user's read cursor in a chat room forward to message_id
+# Acknowledged with the number of messages still unread, or null if the cursor did not move
+@socketio.on('mark_read')
+@login_required_socketio
+@rate_limited_socketio
+@room_member_required_socketio
+def handle_mark_read(data):
+    room_id = data['room_id']
+    unread = db_call(db_mark_read, room_id, session['user_id'], int(data['message_id']))
+    return {"room_id": room_id, "unread": unread}
+
 # Allows any user to query their own ID
 @socketio.on('query_user_id')
 @login_required_socketio
+@rate_limited_socketio
 def handle_query_user_id():
     emit('res_query_user_id', {
         "user_id": session['user_id'],
     })
 
+# Type-ahead search of the user directory, for adding participants
+# Acknowledged with up to limit users whose username starts with prefix (ignoring ASCII case), in username order,
+# and next, to pass as after for the following page, or null on the last page
+@socketio.on('search_users')
+@login_required_socketio
+@rate_limited_socketio
+def handle_search_users(data):
+    prefix = str(data.get('prefix', ''))[:USER_SEARCH_PREFIX_LIMIT]
+    limit = max(1, min(int(data.get('limit', USER_SEARCH_PAGE_SIZE)), USER_SEARCH_PAGE_LIMIT))
+    after = data.get('after')
+    if not prefix:
+        return {"prefix": prefix, "users": [], "next": None}
+    users = db_call(db_search_users, prefix, limit + 1, (str(after['username']), int(after['id'])) if after else None)
+    page = users[:limit]
+    return {"prefix": prefix, "users": [{"id": user.id, "username": user.username} for user in page],
+            "next": {"username": page[-1].username, "id": page[-1].id} if len(users) > limit else None}
+
 # Allows any user to query another user's ID by username, even if they are not in the same chat room
 @socketio.on('query_user_by_username')
 @login_required_socketio
+@rate_limited_socketio
 def handle_query_user_by_username(data):
-    user = db_check_account(data['username'])
+    user = db_call(db_check_account, data['username'])
     if user:
         emit('res_query_user_by_username', {
             "user_id": user.id,
@@ -236,7 +741,7 @@ def handle_query_user_by_username(data):
         })
                 
 ## API Routes ##
-@app.route('/api/register', methods=['POST'])
+@pages.route('/api/register', methods=['POST'])
 def register_api():
     username = request.form['username']
     password = request.form['password']
@@ -244,19 +749,18 @@ def register_api():
     dsakey = ""
     
     # Check if username already exists
-    user = db_check_account(username)
+    user = db_call(db_check_account, username)
     if user is not None:
         return "Username already exists", 401
     
     # Hash password
-    hashed_password = hash_password(password, PEPPER)
+    hashed_password = password_pool.run(hash_password, password, current_app.config['PEPPER'])
 
-    db_create_account(username=username, password_hash=hashed_password,\
-                       public_key_rsa=rsakey, public_key_dsa=dsakey)
+    db_call(db_create_account, username, hashed_password, rsakey, dsakey)
     
     return "Registration successful", 200
 
-@app.route('/api/login', methods=['POST'])
+@pages.route('/api/login', methods=['POST'])
 def login_api():
     username = request.form['username']
     password = request.form['password']
@@ -264,34 +768,165 @@ def login_api():
     dsakey = request.form['dsaPublicKey']
     
     # Grab user from database
-    user = db_check_account(username)
-    if user and check_password(password, PEPPER, user.password_hash):
-        session['user_id'] = user.id
-        db_update_public_key(user.id, rsakey, dsakey)
+    user = db_call(db_check_account, username)
+    if user is None:
+        return "Invalid credentials", 401
+    user_id, password_hash = user.id, user.password_hash
+
+    if password_pool.run(check_password, password, current_app.config['PEPPER'], password_hash):
+        session['user_id'] = user_id
+        # This browser session signs with these keys; messages record them, so later logins do not void their signatures
+        session['signing_keys'] = signing_keys_fingerprint(rsakey, dsakey)
+        db_call(db_update_public_key, user_id, rsakey, dsakey)
+        invalidate_user_keys(user_id)
         return "Login successful", 200
     else:
         return "Invalid credentials", 401
     
-@app.route('/api/logout', methods=['POST'])
+# Presence updates are sent when the user's sockets disconnect
+@pages.route('/api/logout', methods=['POST'])
 def logout_api():
-    if 'user_id' in session:
-        for room in db_get_user_chat_sessions(session['user_id']):
-            socketio.emit('requery_room', room=room.id)
-        session.clear()
+    session.clear()
     return "Logout Successful", 200
 
+## Attachment Routes ##
+# Uploads go in three steps:
+# 1. POST /api/attachments with room_id and size (of the encrypted file) returns the attachment ID and the largest chunk
+# 2. PUT /api/attachments/<id>?offset=N with each chunk as the raw request body, in order
+#    A 409 reply holds the bytes received so far; GET /api/attachments/<id>/status returns the same after a disconnect
+# 3. send_message_to_room with attachment_id once the upload is complete
+@pages.route('/api/attachments', methods=['POST'])
+@login_required_api
+def create_attachment_api():
+    room_id = int(request.form['room_id'])
+    size = int(request.form['size'])
+    user_id = session['user_id']
+    max_size = current_app.config['ATTACHMENT_MAX_SIZE']
+    if size <= 0 or size > max_size:
+        return f"Attachments must be between 1 and {max_size} bytes", 413
+    if not is_room_member(room_id, user_id):
+        return "Not a participant", 403
+    attachment = db_call(db_create_attachment, room_id, user_id, size)
+    return jsonify({"attachment_id": attachment.id, "size": size, "chunk_size": current_app.config['ATTACHMENT_CHUNK_SIZE']}), 201
+
+# Stores one chunk; the body is streamed to disk, never read into memory whole
+@pages.route('/api/attachments/<int:attachment_id>', methods=['PUT'])
+@login_required_api
+def upload_attachment_chunk_api(attachment_id: int):
+    attachment = db_call(db_get_attachment, attachment_id)
+    if attachment is None or attachment.uploader_id != session['user_id']:
+        abort(404)
+    length = request.content_length
+    if length is None:
+        return "Content-Length required", 411
+    chunk_size = current_app.config['ATTACHMENT_CHUNK_SIZE']
+    if length > chunk_size:
+        return f"Chunks must be at most {chunk_size} bytes", 413
+    try:
+        received = attachment_store.write_chunk(attachment_id, int(request.args['offset']), request.stream, length, attachment.size)
+    except UploadRejected as e:
+        return jsonify({"error": str(e), "received": e.received, "size": attachment.size}), 409
+    if received == attachment.size:
+        db_call(db_complete_attachment, attachment_id)
+    return jsonify({"received": received, "size": attachment.size, "complete": received == attachment.size})
+
+# Upload progress, for resuming after a failed chunk
+@pages.route('/api/attachments/<int:attachment_id>/status')
+@login_required_api
+def attachment_status_api(attachment_id: int):
+    attachment = db_call(db_get_attachment, attachment_id)
+    if attachment is None or attachment.uploader_id != session['user_id']:
+        abort(404)
+    received = attachment_store.received(attachment_id)
+    return jsonify({"received": received, "size": attachment.size, "complete": received == attachment.size})
+
+# Sends a complete attachment to a participant of its room
+# Range requests get 206 partial responses, so clients can fetch large files in parts or resume a download
+# With USE_X_SENDFILE a fronting web server sends the file itself (and handles ranges)
+@pages.route('/api/attachments/<int:attachment_id>')
+@login_required_api
+def download_attachment_api(attachment_id: int):
+    attachment = db_call(db_get_attachment, attachment_id)
+    if attachment is None or not attachment.complete or not is_room_member(attachment.session_id, session['user_id']):
+        abort(404)
+    return send_file(attachment_store.path(attachment_id), mimetype='application/octet-stream', conditional=True,
+                     download_name=f"{attachment_id}.bin")
+
+## Metrics Routes ##
+# Prometheus scrape endpoint
+@pages.route('/metrics')
+@metrics_access_required
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+# POST handler=<event or endpoint>&calls=N profiles that handler's next N calls
+# GET ?handler=<event or endpoint> returns the profile collected so far
+@pages.route('/metrics/profile', methods=['GET', 'POST'])
+@metrics_access_required
+def metrics_profile():
+    if request.method == 'POST':
+        handler = request.form['handler']
+        calls = int(request.form.get('calls', 100))
+        metrics.start_profile(handler, calls)
+        return f"Profiling the next {calls} calls of {handler}", 200
+    return metrics.profile_report(request.args['handler']), 200, {"Content-Type": "text/plain"}
+
+## Export Routes ##
+# Streams the whole database as JSON lines (see backup.py), gzip compressed unless ?format=jsonl
+# Each window of rows is read on the database pool and sent before the next one is read
+# The read transaction lasts as long as the download, so it is cut off after EXPORT_MAX_SECONDS; use flask export for slow links
+@pages.route('/export')
+@export_access_required
+def export_database():
+    export_format = request.args.get('format', 'jsonl.gz')
+    if export_format not in ('jsonl', 'jsonl.gz'):
+        abort(400)
+    chunks = export_chunks(db.engines.get('reader', db.engine), read=db_call, max_seconds=current_app.config['EXPORT_MAX_SECONDS'])
+    headers = {"Content-Disposition": f"attachment; filename=securechat-{datetime.now():%Y%m%d-%H%M%S}.{export_format}"}
+    if export_format == 'jsonl':
+        return Response(stream_with_context(chunks), mimetype='application/x-ndjson', headers=headers)
+    return Response(stream_with_context(gzip_chunks(chunks)), mimetype='application/gzip', headers=headers)
+
 ## Debug Routes ##
-if DEBUG:
-    @app.route('/database')
-    def database():
-        return database_to_html(db)
+@debug_pages.route('/cache_stats')
+def cache_stats():
+    return jsonify(key_cache_stats())
+
+@debug_pages.route('/pool_stats')
+def pool_stats():
+    return jsonify({"password": password_pool.stats(), "database": database_pool.stats(),
+                    "message_queue": message_queue.stats() if message_queue is not None else None})
+
+# Closes the traffic trace and takes this worker's users off the online count before the process is terminated;
+# atexit handlers do not run on SIGTERM
+def handle_sigterm(app: Flask, signum, frame):
+    if socketio.recorder is not None:
+        socketio.recorder.close(timeout=1.0)
+    presence.release()
+    try:
+        with app.app_context():
+            presence.flush()
+    except Exception as e:
+        click.echo(f"Failed to persist presence: {e}")
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
 
 if __name__ == '__main__':
+    app = create_app()
+    signal.signal(signal.SIGTERM, partial(handle_sigterm, app))
+    if not app.config['MASTER_KEY'] or not app.config['PEPPER']:
+        sys.exit("MASTER_KEY and PEPPER must be set (see .env_default)")
+    with app.app_context():
+        pending = db_pending_migrations()
+    if pending:
+        sys.exit(f"The database schema is out of date ({'; '.join(pending)}). Run: flask --app app migrate")
     os.system('cls' if os.name == 'nt' else 'clear')
+    host, port, debug = app.config['HOST'], app.config['PORT'], app.config['DEBUG']
+    ssl_cert_path, ssl_key_path = app.config['SSL_CERT_PATH'], app.config['SSL_KEY_PATH']
     ssl_context = (ssl_cert_path, ssl_key_path) if ssl_cert_path and ssl_key_path else None
-    click.echo(f"Server started. Connect to {HOST}:{PORT}")
+    click.echo(f"Server started. Connect to {host}:{port}")
     if ssl_context:
-        socketio.run(app, host=HOST, port=PORT, debug=DEBUG, ssl_context=ssl_context)
+        socketio.run(app, host=host, port=port, debug=debug, ssl_context=ssl_context)
     else:
         click.echo("SSL certificate and key not found. Running in insecure (HTTP) mode.")
-        socketio.run(app, host=HOST, port=PORT, debug=DEBUG)
\ No newline at end of file
+        socketio.run(app, host=host, port=port, debug=debug)
@@ -0,0 +1,90 @@
+"""
+Cold storage for old chat messages
+- Each chat session has a directory of gzip compressed JSON lines segments, oldest messages first
+- Segments are written once and never changed; archiving more messages adds a new segment
+- Segment file names hold the first and last message ID, so pages are read without opening other segments
+- Archived messages are the oldest ones of their chat session, so every archived ID is below every hot ID
+- Messages keep their room key epoch; the keys themselves stay in the database
+- Messages keep their attachment ID and size; the files stay in the attachment store
+- Messages keep the server's signature check (verified), so archived history is not checked again
+"""
+
+from database import Message
+from datetime import datetime
+from functools import lru_cache
+import gzip
+import json
+import os
+
+SEGMENT_SUFFIX = '.jsonl.gz'
+
+# Reads a whole segment; segments never change, so recently read ones are kept in memory
+@lru_cache(maxsize=32)
+def read_segment(path: str) -> tuple:
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return tuple(json.loads(line) for line in f)
+
+class MessageArchive:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _session_dir(self, session_id: int) -> str:
+        return os.path.join(self.directory, str(int(session_id)))
+
+    # Returns (first_id, last_id, path) for each segment of the chat session, oldest first
+    def segments(self, session_id: int) -> list:
+        session_dir = self._session_dir(session_id)
+        if not os.path.isdir(session_dir):
+            return []
+        segments = []
+        for name in os.listdir(session_dir):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            first_id, last_id = name[:-len(SEGMENT_SUFFIX)].split('-')
+            segments.append((int(first_id), int(last_id), os.path.join(session_dir, name)))
+        segments.sort()
+        return segments
+
+    # ID of the newest archived message in the chat session, or 0
+    def last_archived_id(self, session_id: int) -> int:
+        segments = self.segments(session_id)
+        return segments[-1][1] if segments else 0
+
+    # Writes messages (oldest first, all newer than anything archived) as a new segment
+    # The segment is written to a temporary file and renamed, so a crash never leaves a partial segment
+    def append(self, session_id: int, messages: list):
+        if not messages:
+            return
+        session_dir = self._session_dir(session_id)
+        os.makedirs(session_dir, exist_ok=True)
+        name = f"{messages[0].id:012d}-{messages[-1].id:012d}{SEGMENT_SUFFIX}"
+        path = os.path.join(session_dir, name)
+        lines = [json.dumps({"id": msg.id, "sender_id": msg.sender_id, "created_at": msg.created_at.isoformat(),
+                             "content": msg.content, "rsa_signature": msg.rsa_signature,
+                             "dsa_signature": msg.dsa_signature, "key_epoch": msg.key_epoch,
+                             "attachment_id": msg.attachment_id, "attachment_size": msg.attachment_size,
+                             "verified": msg.verified},
+                            separators=(',', ':')) for msg in messages]
+        with open(path + '.tmp', 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                gz.write(("\n".join(lines) + "\n").encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    # Returns up to limit archived messages older than before_message_id (or the newest ones), oldest first
+    # Messages are detached Message objects, so they serialize like messages from the database
+    def get_page(self, session_id: int, limit: int, before_message_id: int = None) -> list:
+        messages = []
+        for first_id, last_id, path in reversed(self.segments(session_id)):
+            if len(messages) >= limit:
+                break
+            if before_message_id is not None and first_id >= before_message_id:
+                continue
+            rows = [row for row in read_segment(path) if before_message_id is None or row["id"] < before_message_id]
+            messages = rows[-(limit - len(messages)):] + messages
+        return [Message(id=row["id"], session_id=session_id, sender_id=row["sender_id"], content=row["content"],
+                        created_at=datetime.fromisoformat(row["created_at"]), rsa_signature=row["rsa_signature"],
+                        dsa_signature=row["dsa_signature"], key_epoch=row.get("key_epoch", 0),
+                        attachment_id=row.get("attachment_id"), attachment_size=row.get("attachment_size"),
+                        verified=row.get("verified")) for row in messages]
@@ -0,0 +1,76 @@
+"""
+Encrypted file attachments stored on disk
+- Clients encrypt files themselves and upload the ciphertext in chunks; the server never sees a key
+- Chunks are streamed to disk in small blocks, so no upload is held in memory whole
+- An upload's progress is the size of its file, so an interrupted upload resumes after the last complete chunk
+- A chunk that does not arrive whole is cut off again, so files only ever end on a chunk boundary
+- Downloads are served straight from the file (see the download route for range requests)
+"""
+
+import os
+
+BLOCK_SIZE = 64 * 1024 # Bytes read from the request and written to disk at a time
+
+# Raised when a chunk cannot be written, with the number of bytes the server already has
+# The client should continue uploading from received
+class UploadRejected(Exception):
+    def __init__(self, reason: str, received: int):
+        super().__init__(reason)
+        self.received = received
+
+class AttachmentStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._writing = set() # attachments with a chunk being written
+
+    # Files are spread over 256 directories so none of them grows too large
+    def path(self, attachment_id: int) -> str:
+        return os.path.join(self.directory, f"{int(attachment_id) % 256:02x}", f"{int(attachment_id)}.bin")
+
+    # Bytes of the attachment stored so far
+    def received(self, attachment_id: int) -> int:
+        try:
+            return os.path.getsize(self.path(attachment_id))
+        except FileNotFoundError:
+            return 0
+
+    # Appends length bytes read from stream at offset, which must be where the stored data ends
+    # size is the attachment's declared total size; the file is synced to disk once it is complete
+    # Returns the bytes stored after this chunk
+    def write_chunk(self, attachment_id: int, offset: int, stream, length: int, size: int) -> int:
+        if attachment_id in self._writing:
+            raise UploadRejected("another chunk is being written", self.received(attachment_id))
+        self._writing.add(attachment_id)
+        try:
+            received = self.received(attachment_id)
+            if offset != received:
+                raise UploadRejected("chunk does not start where the upload ends", received)
+            if offset + length > size:
+                raise UploadRejected("chunk goes past the attachment's size", received)
+            path = self.path(attachment_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'ab') as f:
+                try:
+                    written = 0
+                    while written < length:
+                        block = stream.read(min(BLOCK_SIZE, length - written))
+                        if not block:
+                            raise UploadRejected("chunk ended early", offset)
+                        f.write(block)
+                        written += len(block)
+                    if offset + length == size:
+                        f.flush()
+                        os.fsync(f.fileno())
+                except BaseException:
+                    f.truncate(offset)
+                    raise
+            return offset + length
+        finally:
+            self._writing.discard(attachment_id)
+
+    # Deletes an attachment's file, if it has one
+    def remove(self, attachment_id: int):
+        try:
+            os.remove(self.path(attachment_id))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,159 @@
+"""
+Streaming export and import of the whole database
+- An export is JSON lines: a header, then for each table a line naming its columns followed by one array per row,
+  and a closing line with the row count of every table, so a cut-off export is refused on import
+- Tables are written parents first (users before chat sessions before messages), so an import never needs
+  rows that come later in the file
+- Rows are read in windows ordered by primary key, each window starting after the last key of the previous one,
+  all inside one read transaction, so the export is a consistent snapshot and memory does not grow with the tables
+- Exports can be gzip compressed on the fly; imports detect compression from the file itself
+- The read transaction holds back WAL checkpoints while it lasts, so an export can be given a time limit;
+  one that runs out ends with an error line instead of the counts, and is refused on import
+- Imports insert in batches, one transaction per batch, into a freshly migrated (empty) database
+- The message archive and attachment files are not part of an export; copy ARCHIVE_DIR and ATTACHMENT_DIR alongside it
+"""
+
+from database import db
+from sqlalchemy import tuple_, select
+from datetime import datetime
+import gzip
+import json
+import time
+import zlib
+
+EXPORT_FORMAT = 'securechat-export'
+EXPORT_VERSION = 1
+EXPORT_WINDOW = 1000 # Rows read per query
+IMPORT_BATCH = 5000 # Rows inserted per transaction
+GZIP_LEVEL = 6
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot export {type(value).__name__}")
+
+# One encoder for every line; json.dumps would build a new one per row
+encoder = json.JSONEncoder(separators=(',', ':'), default=encode_value)
+
+def dumps(record) -> str:
+    return encoder.encode(record) + '\n'
+
+# Rows of the table whose primary key comes after the key `after` (None for the first window)
+def read_window(connection, table, after, window: int) -> list:
+    key = list(table.primary_key.columns)
+    query = table.select().order_by(*key).limit(window)
+    if after is not None:
+        query = query.where(tuple_(*key) > tuple_(*after))
+    return [tuple(row) for row in connection.execute(query)]
+
+# Yields the export as text chunks, one per window of rows
+# read(fn, *args) runs each query; the server passes db_call so the event loop never waits on SQLite
+# With max_seconds, an export still running after that long (e.g. a slow download) stops with an error line
+def export_chunks(engine, window: int = EXPORT_WINDOW, read=None, max_seconds: float = None):
+    read = read or (lambda fn, *args: fn(*args))
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+    tables = db.metadata.sorted_tables
+    with engine.connect() as connection:
+        # pysqlite only begins transactions for writes; without this every window would see a different database
+        if connection.dialect.name == 'sqlite':
+            connection.exec_driver_sql('BEGIN')
+        yield dumps({"format": EXPORT_FORMAT, "version": EXPORT_VERSION, "created_at": datetime.now(),
+                     "tables": [table.name for table in tables]})
+        counts = {}
+        for table in tables:
+            columns = [column.name for column in table.columns]
+            key_positions = [columns.index(column.name) for column in table.primary_key.columns]
+            yield dumps({"table": table.name, "columns": columns})
+            counts[table.name] = 0
+            after = None
+            while True:
+                if deadline is not None and time.monotonic() > deadline:
+                    yield dumps({"error": f"Export stopped after {max_seconds:g} seconds; it is incomplete"})
+                    return
+                rows = read(read_window, connection, table, after, window)
+                if rows:
+                    yield ''.join(dumps(row) for row in rows)
+                counts[table.name] += len(rows)
+                if len(rows) < window:
+                    break
+                after = tuple(rows[-1][i] for i in key_positions)
+        yield dumps({"end": counts})
+
+# Compresses text chunks into a gzip stream, yielding compressed bytes as they become available
+def gzip_chunks(chunks, level: int = GZIP_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+# Opens an export file for reading lines, compressed or not
+def open_export(path: str):
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    if compressed:
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+# For each exported column, the function turning its values back into what the column expects (None to keep them)
+def column_decoders(table, columns: list) -> list:
+    decoders = []
+    for name in columns:
+        if name not in table.columns:
+            raise ValueError(f"Column {table.name}.{name} does not exist; migrate the database first")
+        is_datetime = isinstance(table.columns[name].type, db.DateTime)
+        decoders.append(datetime.fromisoformat if is_datetime else None)
+    return decoders
+
+# Loads an export (an iterable of lines) into the empty database at engine; returns the row count of each table
+# Raises ValueError for anything that is not a complete export of a compatible schema
+def import_lines(engine, lines, batch_size: int = IMPORT_BATCH) -> dict:
+    lines = iter(lines)
+    header = json.loads(next(lines, 'null'))
+    if not isinstance(header, dict) or header.get('format') != EXPORT_FORMAT:
+        raise ValueError("Not a database export")
+    if header.get('version', 0) > EXPORT_VERSION:
+        raise ValueError(f"Export version {header['version']} is newer than this server understands")
+    tables = db.metadata.tables
+    counts = {}
+    with engine.connect() as connection:
+        for table in tables.values():
+            if connection.execute(select(1).select_from(table).limit(1)).first() is not None:
+                raise ValueError(f"Table {table.name} is not empty; import into a freshly migrated database")
+        # Each batch is committed, so durability only matters once the whole import is done
+        if connection.dialect.name == 'sqlite':
+            connection.exec_driver_sql('PRAGMA synchronous=NORMAL')
+        table, columns, decoders, batch = None, None, None, []
+
+        def insert_batch():
+            if batch:
+                connection.execute(table.insert(), batch)
+                connection.commit()
+                counts[table.name] += len(batch)
+                batch.clear()
+
+        for line in lines:
+            record = json.loads(line)
+            if isinstance(record, list):
+                if table is None:
+                    raise ValueError("Row before any table")
+                batch.append({name: value if decode is None or value is None else decode(value)
+                              for name, decode, value in zip(columns, decoders, record)})
+                if len(batch) >= batch_size:
+                    insert_batch()
+            elif 'table' in record:
+                insert_batch()
+                if record['table'] not in tables:
+                    raise ValueError(f"Table {record['table']} does not exist; migrate the database first")
+                table, columns = tables[record['table']], record['columns']
+                decoders = column_decoders(table, columns)
+                counts[table.name] = 0
+            elif 'error' in record:
+                raise ValueError(record['error'])
+            elif 'end' in record:
+                insert_batch()
+                if record['end'] != counts:
+                    raise ValueError(f"Imported {counts}, but the export lists {record['end']}")
+                return counts
+    raise ValueError(f"The export ends early and is incomplete; imported so far: {counts}")
@@ -0,0 +1,102 @@
+"""
+Attachment upload and download through a real server
+- Uploads a random file of each size in chunks, then downloads it whole and in ranges
+- Reports throughput and the server's peak resident memory, which should not grow with the file size
+- Meanwhile another client measures query_user_id round trips, to show socket traffic keeps flowing
+
+Run from the repository root:
+    python benchmarks/bench_attachments.py [--sizes-mb 1,16,64] [--chunk-kb 1024]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import start_server, generate_keys, register, login, connect
+from bench_db_stall import measure_round_trips, percentile
+
+# Peak resident memory of a process in MB (Linux only)
+def peak_rss_mb(pid: int) -> float:
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+def run(sizes_mb: list, chunk_size: int, keys: dict) -> list:
+    results = []
+    env = {'ATTACHMENT_DIR': tempfile.mkdtemp(), 'ATTACHMENT_CHUNK_SIZE': str(chunk_size),
+           'ATTACHMENT_MAX_SIZE': str(max(sizes_mb) * 1024 * 1024)}
+    with start_server(env) as (base_url, process):
+        register(base_url, 'uploader')
+        register(base_url, 'prober')
+        http = login(base_url, 'uploader', keys)
+        prober = connect(base_url, login(base_url, 'prober', keys))
+        client = connect(base_url, http)
+        created = threading.Event()
+        rooms = {}
+        client.on('chat_created', lambda data: (rooms.update(data), created.set()))
+        client.emit('create_chat_room', {'chat_name': 'bench'})
+        created.wait(10)
+        room_id = rooms['room_id']
+
+        for size_mb in sizes_mb:
+            data = os.urandom(size_mb * 1024 * 1024)
+            stop = threading.Event()
+            probe = {}
+            prober_thread = threading.Thread(target=lambda: probe.update(
+                latencies=measure_round_trips(prober, 'query_user_id', None, 'res_query_user_id', stop)))
+            prober_thread.start()
+
+            start = time.perf_counter()
+            attachment_id = http.post(base_url + '/api/attachments', data={'room_id': room_id, 'size': len(data)}).json()['attachment_id']
+            for offset in range(0, len(data), chunk_size):
+                response = http.put(f'{base_url}/api/attachments/{attachment_id}?offset={offset}', data=data[offset:offset + chunk_size])
+                response.raise_for_status()
+            upload_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            downloaded = http.get(f'{base_url}/api/attachments/{attachment_id}').content
+            download_seconds = time.perf_counter() - start
+            assert downloaded == data, 'download does not match upload'
+
+            start = time.perf_counter()
+            for offset in range(0, len(data), chunk_size):
+                response = http.get(f'{base_url}/api/attachments/{attachment_id}',
+                                    headers={'Range': f'bytes={offset}-{offset + chunk_size - 1}'})
+                assert response.status_code == 206 and response.content == data[offset:offset + chunk_size]
+            range_seconds = time.perf_counter() - start
+
+            stop.set()
+            prober_thread.join()
+            results.append({'size_mb': size_mb, 'upload': size_mb / upload_seconds, 'download': size_mb / download_seconds,
+                            'ranges': size_mb / range_seconds, 'rss': peak_rss_mb(process.pid),
+                            'probe': probe.get('latencies', [])})
+        client.disconnect()
+        prober.disconnect()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes-mb', default='1,16,64', help='comma separated file sizes in MB')
+    parser.add_argument('--chunk-kb', type=int, default=1024, help='upload chunk and download range size')
+    args = parser.parse_args()
+
+    keys = generate_keys()
+    results = run([int(size) for size in args.sizes_mb.split(',')], args.chunk_kb * 1024, keys)
+    print(f"{'MB':>5} {'upload MB/s':>12} {'download MB/s':>14} {'ranges MB/s':>12} {'peak RSS MB':>12} {'probe p50':>10} {'probe max':>10}")
+    for r in results:
+        print(f"{r['size_mb']:>5} {r['upload']:12.1f} {r['download']:14.1f} {r['ranges']:12.1f} {r['rss']:12.1f} "
+              f"{percentile(r['probe'], 50):10.1f} {r['probe'][-1] if r['probe'] else 0:10.1f}")
+    print("Probe latencies are query_user_id round trips in ms during the transfers")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Event loop stalls while the database is locked
+- Starts app.py with database calls on the event loop (DB_POOL_SIZE=0) and on the database pool
+- Another process holds the SQLite write lock for a while, so message inserts wait on the busy timeout
+- Meanwhile one client keeps sending messages and another measures query_user_id (no database)
+  and query_chat_room (reads only) round trips
+
+Run from the repository root:
+    python benchmarks/bench_db_stall.py [--lock-seconds 2] [--pool-sizes 0,4]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import start_server, generate_keys, register, login, connect
+
+# Returns the value at percentile p (0-100) of a sorted list
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Emits event with data every interval and records the time until the reply event arrives
+def measure_round_trips(client, event: str, data, reply: str, stop: threading.Event, interval: float = 0.02) -> list:
+    latencies = []
+    received = threading.Event()
+    client.on(reply, lambda *args: received.set())
+    while not stop.is_set():
+        received.clear()
+        start = time.perf_counter()
+        client.emit(event, data)
+        if received.wait(timeout=30):
+            latencies.append((time.perf_counter() - start) * 1000)
+        time.sleep(interval)
+    return sorted(latencies)
+
+# Holds SQLite's write lock on the database file for the given time
+def hold_write_lock(database_path: str, seconds: float):
+    connection = sqlite3.connect(database_path, timeout=30, isolation_level=None)
+    connection.execute('BEGIN IMMEDIATE')
+    time.sleep(seconds)
+    connection.execute('COMMIT')
+    connection.close()
+
+def run(pool_size: int, lock_seconds: float, keys: dict) -> dict:
+    database_path = os.path.join(tempfile.mkdtemp(), 'stall.db')
+    with start_server({'DB_POOL_SIZE': str(pool_size)}, database_path=database_path) as (base_url, _):
+        register(base_url, 'sender')
+        register(base_url, 'prober')
+        sender = connect(base_url, login(base_url, 'sender', keys))
+        prober = connect(base_url, login(base_url, 'prober', keys))
+        created = threading.Event()
+        rooms = {}
+        sender.on('chat_created', lambda data: (rooms.update(data), created.set()))
+        ids = {}
+        id_received = threading.Event()
+        prober.on('res_query_user_id', lambda data: (ids.update(data), id_received.set()))
+        sender.emit('create_chat_room', {'chat_name': 'bench'})
+        prober.emit('query_user_id')
+        created.wait(10)
+        id_received.wait(10)
+        room_id = rooms['room_id']
+        sender.emit('add_user_to_chat', {'room_id': room_id, 'user_id': ids['user_id']})
+        time.sleep(0.2)
+
+        stop = threading.Event()
+        def send_messages():
+            while not stop.is_set():
+                sender.call('send_message_to_room', {'room_id': room_id, 'user_id': 1, 'message': 'x',
+                                                     'rsa_signature': 'r', 'dsa_signature': 'd'}, timeout=30)
+                time.sleep(0.05)
+        results = {}
+        def probe(name, event, data, reply):
+            results[name] = measure_round_trips(prober, event, data, reply, stop)
+        threads = [threading.Thread(target=send_messages),
+                   threading.Thread(target=probe, args=('user_id', 'query_user_id', None, 'res_query_user_id')),
+                   threading.Thread(target=probe, args=('room', 'query_chat_room', {'room_id': room_id}, 'res_query_chat_room'))]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+        hold_write_lock(database_path, lock_seconds)
+        time.sleep(0.5)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        sender.disconnect()
+        prober.disconnect()
+
+    return {'pool_size': pool_size, 'user_id': results['user_id'], 'room': results['room']}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lock-seconds', type=float, default=2.0)
+    parser.add_argument('--pool-sizes', default='0,4', help='comma separated DB_POOL_SIZE values; 0 runs database calls on the event loop')
+    args = parser.parse_args()
+
+    keys = generate_keys()
+    print(f"{'pool':>5} {'user_id p50':>12} {'user_id max':>12} {'room p50':>9} {'room max':>9}")
+    for pool_size in [int(size) for size in args.pool_sizes.split(',')]:
+        r = run(pool_size, args.lock_seconds, keys)
+        print(f"{r['pool_size']:>5} {percentile(r['user_id'], 50):12.1f} {r['user_id'][-1] if r['user_id'] else 0:12.1f} "
+              f"{percentile(r['room'], 50):9.1f} {r['room'][-1] if r['room'] else 0:9.1f}")
+    print(f"Latencies in ms, while another process held the write lock for {args.lock_seconds}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark for flask export / import as the database grows
+- Fills a scratch SQLite database with messages shaped like real ones (base64 ciphertext and signatures),
+  in rounds of 10x more rows
+- Times exporting to a plain and a gzip compressed file, and importing the compressed file into an empty database
+- Reports the peak Python memory of each step (traced in a separate run, so tracing does not slow the timed one);
+  it stays flat as the tables grow
+
+Run from the repository root:
+    python benchmarks/bench_export.py [--max-rows 100000] [--window 1000] [--batch-size 5000]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from sqlalchemy import create_engine
+from database import db, User, ChatSession, Message, db_migrate
+from backup import export_chunks, gzip_chunks, open_export, import_lines
+from bench_history import INSERT_CHUNK
+
+ROOMS = 10
+
+# Adds messages spread over the rooms until there are target of them
+def fill_messages(start: int, target: int):
+    base = datetime(2024, 1, 1)
+    for chunk_start in range(start, target, INSERT_CHUNK):
+        rows = [{"session_id": i % ROOMS + 1, "sender_id": 1, "content": "x" * 256, "created_at": base + timedelta(seconds=i),
+                 "rsa_signature": "r" * 344, "dsa_signature": "d" * 96}
+                for i in range(chunk_start, min(chunk_start + INSERT_CHUNK, target))]
+        db.session.execute(Message.__table__.insert(), rows)
+        db.session.commit()
+
+def export_file(path: str, window: int) -> int:
+    chunks = export_chunks(db.engine, window=window)
+    with open(path, 'wb') as f:
+        for data in gzip_chunks(chunks) if path.endswith('.gz') else (chunk.encode('utf-8') for chunk in chunks):
+            f.write(data)
+    return os.path.getsize(path)
+
+def import_file(path: str, database_path: str, batch_size: int):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(database_path + suffix):
+            os.remove(database_path + suffix)
+    engine = create_engine('sqlite:///' + database_path)
+    db.metadata.create_all(engine)
+    with open_export(path) as f:
+        import_lines(engine, f, batch_size=batch_size)
+    engine.dispose()
+
+# Returns (seconds, result) of one call
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+# Peak traced memory in MB of one call
+def peak_mb(fn) -> float:
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-rows', type=int, default=100000)
+    parser.add_argument('--window', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(app)
+        plain, compressed, imported = (os.path.join(tmp, name) for name in ('export.jsonl', 'export.jsonl.gz', 'import.db'))
+
+        with app.app_context():
+            db_migrate()
+            db.session.add(User(username='bench', password_hash='x', public_key_rsa='x', public_key_dsa='x'))
+            for i in range(ROOMS):
+                db.session.add(ChatSession(name=f'room{i}', owner_id=1, encrypted_symmetric_key='x'))
+            db.session.commit()
+
+            print(f"{'messages':>9} {'export s':>9} {'MB':>7} {'MB/s':>6} {'gzip s':>7} {'gz MB':>6} "
+                  f"{'import s':>9} {'rows/s':>8} {'peak MB export':>15} {'peak MB import':>15}")
+            rows = 0
+            size = 10000
+            while size <= args.max_rows:
+                fill_messages(rows, size)
+                rows = size
+                export_s, plain_size = timed(lambda: export_file(plain, args.window))
+                gzip_s, gzip_size = timed(lambda: export_file(compressed, args.window))
+                import_s, _ = timed(lambda: import_file(compressed, imported, args.batch_size))
+                export_peak = peak_mb(lambda: export_file(compressed, args.window))
+                import_peak = peak_mb(lambda: import_file(compressed, imported, args.batch_size))
+                print(f"{rows:>9} {export_s:9.2f} {plain_size / 1e6:7.1f} {plain_size / 1e6 / export_s:6.0f} {gzip_s:7.2f} "
+                      f"{gzip_size / 1e6:6.1f} {import_s:9.2f} {rows / import_s:8.0f} {export_peak:15.1f} {import_peak:15.1f}")
+                size *= 10
+            print(f"window {args.window} rows, import batches of {args.batch_size} rows")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Message write throughput: one commit per message vs group commit
+- Writes messages into a scratch SQLite database on disk
+- Per-message mode calls db_create_message in a loop (one fsync per message)
+- Group commit mode sends the same messages from many concurrent senders through GroupCommitQueue
+
+Run from the repository root:
+    python benchmarks/bench_group_commit.py [--messages 2000] [--senders 32] [--batch 64] [--delay-ms 5]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from database import db, User, ChatSession, Message, db_create_message, db_create_messages
+from groupcommit import GroupCommitQueue
+
+# Creates a Flask app bound to a fresh database file with one user and one room
+def make_app(path: str) -> Flask:
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(username='bench', password_hash='x', public_key_rsa='x', public_key_dsa='x'))
+        db.session.add(ChatSession(name='bench', owner_id=1, encrypted_symmetric_key='x'))
+        db.session.commit()
+    return app
+
+def per_message(app: Flask, messages: int) -> float:
+    with app.app_context():
+        start = time.perf_counter()
+        for _ in range(messages):
+            db_create_message(1, 1, 'x' * 64, 'r', 'd')
+        return time.perf_counter() - start
+
+def group_commit(app: Flask, messages: int, senders: int, batch: int, delay: float) -> tuple:
+    queue = GroupCommitQueue(db_create_messages, max_batch=batch, max_delay=delay)
+    threading.Thread(target=queue.run_forever, args=(app.app_context,), daemon=True).start()
+    row = {"session_id": 1, "sender_id": 1, "content": 'x' * 64, "rsa": 'r', "dsa": 'd'}
+    def sender(count):
+        for _ in range(count):
+            queue.submit(row)
+    threads = [threading.Thread(target=sender, args=(messages // senders,)) for _ in range(senders)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, queue.stats()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--senders', type=int, default=32)
+    parser.add_argument('--batch', type=int, default=64)
+    parser.add_argument('--delay-ms', type=float, default=5)
+    args = parser.parse_args()
+    messages = args.messages - args.messages % args.senders
+
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as tmp:
+        elapsed = per_message(make_app(os.path.join(tmp, 'per_message.db')), messages)
+        print(f"per-message commit: {messages / elapsed:8.0f} msg/s  ({messages} commits)")
+
+        app = make_app(os.path.join(tmp, 'group.db'))
+        elapsed, stats = group_commit(app, messages, args.senders, args.batch, args.delay_ms / 1000)
+        print(f"group commit:       {messages / elapsed:8.0f} msg/s  ({stats['batches']} commits, "
+              f"average batch {stats['average_batch']:.1f}, largest {stats['largest_batch']})")
+        with app.app_context():
+            ids = [m.id for m in Message.query.order_by(Message.id).all()]
+            assert ids == list(range(1, messages + 1)), "message IDs are not contiguous"
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark for opening a chat room as its history grows
+- Fills a scratch SQLite database with up to 10^6 messages in one room
+- Times the latest page (what query_chat_room loads) and a scroll-back page
+- Optionally times the old full-history load for comparison
+
+Run from the repository root:
+    python benchmarks/bench_history.py [--max-rows 1000000] [--full]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from database import db, User, ChatSession, Message, db_get_messages, db_get_messages_page
+
+PAGE_SIZE = 50
+REPEAT = 20
+INSERT_CHUNK = 50000
+
+# Inserts messages into the room until it holds target rows
+def fill_history(session_id: int, sender_id: int, start: int, target: int):
+    base = datetime(2024, 1, 1)
+    for chunk_start in range(start, target, INSERT_CHUNK):
+        rows = [{"session_id": session_id, "sender_id": sender_id, "content": "x" * 64,
+                 "created_at": base + timedelta(seconds=i), "rsa_signature": "r", "dsa_signature": "d"}
+                for i in range(chunk_start, min(chunk_start + INSERT_CHUNK, target))]
+        db.session.execute(Message.__table__.insert(), rows)
+        db.session.commit()
+
+# Returns the median time in milliseconds of calling fn REPEAT times
+def time_ms(fn) -> float:
+    samples = []
+    for _ in range(REPEAT):
+        db.session.expire_all()
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-rows', type=int, default=10 ** 6)
+    parser.add_argument('--full', action='store_true', help='also time loading the full history (slow)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(app)
+
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(username='bench', password_hash='x', public_key_rsa='x', public_key_dsa='x'))
+            db.session.add(ChatSession(name='bench', owner_id=1, encrypted_symmetric_key='x'))
+            db.session.commit()
+
+            print(f"{'rows':>10} {'latest page ms':>15} {'older page ms':>15} {'full load ms':>15}")
+            rows = 0
+            size = 1000
+            while size <= args.max_rows:
+                fill_history(1, 1, rows, size)
+                rows = size
+                middle = db_get_messages_page(1, 1)[0].id // 2
+                latest = time_ms(lambda: db_get_messages_page(1, PAGE_SIZE))
+                older = time_ms(lambda: db_get_messages_page(1, PAGE_SIZE, middle))
+                full = f"{time_ms(lambda: db_get_messages(1)):15.2f}" if args.full else f"{'-':>15}"
+                print(f"{rows:>10} {latest:15.2f} {older:15.2f} {full}")
+                size *= 10
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Chat latency during a login burst
+- Starts app.py with and without the password worker pool
+- Measures send -> delivery latency of chat messages while N logins are in flight
+- Reports how many logins were turned away with 503
+
+Run from the repository root:
+    python benchmarks/bench_login_burst.py [--logins 100] [--pool-sizes 0,4]
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import start_server, generate_keys, register, login, connect
+
+# Returns the value at percentile p (0-100) of a sorted list
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Sends a message every interval and records the time until the server pushes it back
+def measure_latency(client, room_id: int, user_id: int, stop: threading.Event, interval: float = 0.02) -> list:
+    latencies = []
+    delivered = threading.Event()
+    client.on('new_message', lambda data: delivered.set())
+    while not stop.is_set():
+        delivered.clear()
+        start = time.perf_counter()
+        client.emit('send_message_to_room', {'room_id': room_id, 'user_id': user_id, 'message': 'x',
+                                             'rsa_signature': 'r', 'dsa_signature': 'd'})
+        if delivered.wait(timeout=10):
+            latencies.append((time.perf_counter() - start) * 1000)
+        time.sleep(interval)
+    return sorted(latencies)
+
+def run(pool_size: int, logins: int, keys: dict) -> dict:
+    with start_server({'PASSWORD_POOL_SIZE': str(pool_size)}) as (base_url, _):
+        register(base_url, 'chatter')
+        register(base_url, 'burst')
+        http = login(base_url, 'chatter', keys)
+        client = connect(base_url, http)
+        created = threading.Event()
+        rooms = {}
+        client.on('chat_created', lambda data: (rooms.update(data), created.set()))
+        ids = {}
+        id_received = threading.Event()
+        client.on('res_query_user_id', lambda data: (ids.update(data), id_received.set()))
+        client.emit('create_chat_room', {'chat_name': 'bench'})
+        client.emit('query_user_id')
+        created.wait(10)
+        id_received.wait(10)
+        client.emit('join_room', {'room_id': rooms['room_id']})
+        time.sleep(0.2)
+
+        statuses = []
+        def do_login():
+            response = requests.post(base_url + '/api/login', data={'username': 'burst', 'password': 'password',
+                                                                    'rsaPublicKey': keys['rsa_public'], 'dsaPublicKey': keys['dsa_public']})
+            statuses.append(response.status_code)
+
+        stop = threading.Event()
+        idle_stop = threading.Timer(1.0, stop.set)
+        idle_stop.start()
+        idle = measure_latency(client, rooms['room_id'], ids['user_id'], stop)
+
+        stop.clear()
+        threads = [threading.Thread(target=do_login) for _ in range(logins)]
+        result = {}
+        def burst():
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            result['burst_seconds'] = time.perf_counter() - start
+            stop.set()
+        burst_thread = threading.Thread(target=burst)
+        burst_thread.start()
+        loaded = measure_latency(client, rooms['room_id'], ids['user_id'], stop)
+        burst_thread.join()
+        client.disconnect()
+
+    return {
+        'pool_size': pool_size,
+        'idle_p50': percentile(idle, 50),
+        'burst_p50': percentile(loaded, 50),
+        'burst_p99': percentile(loaded, 99),
+        'burst_max': loaded[-1] if loaded else 0.0,
+        'samples': len(loaded),
+        'ok': statuses.count(200),
+        'busy': statuses.count(503),
+        'burst_seconds': result['burst_seconds'],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=100)
+    parser.add_argument('--pool-sizes', default='0,4', help='comma separated PASSWORD_POOL_SIZE values; 0 is bcrypt on the event loop')
+    args = parser.parse_args()
+
+    keys = generate_keys()
+    print(f"{'pool':>5} {'idle p50':>9} {'burst p50':>10} {'burst p99':>10} {'burst max':>10} {'samples':>8} {'200':>5} {'503':>5} {'burst s':>8}")
+    for pool_size in [int(size) for size in args.pool_sizes.split(',')]:
+        r = run(pool_size, args.logins, keys)
+        print(f"{r['pool_size']:>5} {r['idle_p50']:9.1f} {r['burst_p50']:10.1f} {r['burst_p99']:10.1f} {r['burst_max']:10.1f} "
+              f"{r['samples']:>8} {r['ok']:>5} {r['busy']:>5} {r['burst_seconds']:8.1f}")
+    print("Latencies in ms")
+
+if __name__ == '__main__':
+    main()
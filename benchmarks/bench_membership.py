@@ -0,0 +1,95 @@
+"""
+Cost of the room membership check on socket events
+- In process: one MembershipIndex lookup against an index of many rooms, vs one db_is_chat_participant query
+- Through a real server: round trips of leave_room (never checked) and join_room (checked)
+  with the in-memory index (MEMBERSHIP_INDEX=True) and with a database query per event (MEMBERSHIP_INDEX=False)
+
+Run from the repository root:
+    python benchmarks/bench_membership.py [--rooms 10000] [--members 10] [--calls 500]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server import start_server, generate_keys, register, login, connect
+from bench_db_stall import percentile
+from membership import MembershipIndex
+
+# Average microseconds per call of fn over the given arguments
+def time_calls(fn, calls: list) -> float:
+    start = time.perf_counter()
+    for args in calls:
+        fn(*args)
+    return (time.perf_counter() - start) / len(calls) * 1e6
+
+# Times the check itself: index lookups vs SQL queries on a database with the same memberships
+def run_in_process(rooms: int, members: int, calls: int) -> dict:
+    pairs = [(room_id, room_id * members + i) for room_id in range(1, rooms + 1) for i in range(members)]
+    index = MembershipIndex()
+    index.load(pairs)
+    lookups = [random.choice(pairs) for _ in range(calls)]
+
+    database = sqlite3_with_participants(pairs)
+    query = 'SELECT 1 FROM chat_participants WHERE session_id = ? AND user_id = ? LIMIT 1'
+    return {'index': time_calls(index.is_member, lookups),
+            'sql': time_calls(lambda room_id, user_id: database.execute(query, (room_id, user_id)).fetchone(), lookups)}
+
+# A scratch SQLite database with a chat_participants table shaped like the app's
+def sqlite3_with_participants(pairs: list):
+    database = sqlite3.connect(os.path.join(tempfile.mkdtemp(), 'members.db'))
+    database.execute('CREATE TABLE chat_participants (session_id INTEGER, user_id INTEGER, PRIMARY KEY (session_id, user_id))')
+    database.executemany('INSERT INTO chat_participants VALUES (?, ?)', pairs)
+    database.commit()
+    return database
+
+# Round trip latencies in ms of an acknowledged event
+def round_trips(client, event: str, data: dict, calls: int) -> list:
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        client.call(event, data, timeout=10)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return sorted(latencies)
+
+def run_server(use_index: bool, calls: int, keys: dict) -> dict:
+    with start_server({'MEMBERSHIP_INDEX': str(use_index)}) as (base_url, _):
+        register(base_url, 'member')
+        client = connect(base_url, login(base_url, 'member', keys))
+        rooms = {}
+        client.on('chat_created', lambda data: rooms.update(data))
+        client.call('create_chat_room', {'chat_name': 'bench'}, timeout=10)
+        data = {'room_id': rooms['room_id']}
+        round_trips(client, 'join_room', data, 20) # warm up
+        results = {'leave_room': round_trips(client, 'leave_room', data, calls),
+                   'join_room': round_trips(client, 'join_room', data, calls)}
+        client.disconnect()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=10000)
+    parser.add_argument('--members', type=int, default=10, help='participants per room')
+    parser.add_argument('--calls', type=int, default=500)
+    args = parser.parse_args()
+
+    r = run_in_process(args.rooms, args.members, args.calls * 20)
+    print(f"Check alone, {args.rooms * args.members} memberships: index {r['index']:.2f} us, SQL query {r['sql']:.2f} us")
+
+    keys = generate_keys()
+    print(f"{'check':>8} {'leave_room p50':>15} {'join_room p50':>14} {'leave_room p99':>15} {'join_room p99':>14}")
+    for use_index in (True, False):
+        r = run_server(use_index, args.calls, keys)
+        print(f"{'index' if use_index else 'database':>8} {percentile(r['leave_room'], 50):15.2f} {percentile(r['join_room'], 50):14.2f} "
+              f"{percentile(r['leave_room'], 99):15.2f} {percentile(r['join_room'], 99):14.2f}")
+    print("Round trips in ms; leave_room is not checked, join_room is")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark for search_users as the user directory grows
+- Fills a scratch SQLite database with random usernames, in rounds of 10x more accounts
+- Times one page of db_search_users (a range scan on ix_users_username_lower) for prefixes of 1 to 3 characters,
+  and the 20th page of a 1-character prefix from its next cursor, against the same search written as a LIKE filter
+  (with OFFSET for the 20th page), which scans every account
+
+Run from the repository root:
+    python benchmarks/bench_search.py [--max-users 100000] [--page-size 10]
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from database import db, User, db_migrate, db_search_users
+from bench_history import time_ms, INSERT_CHUNK
+
+PREFIXES = ['m', 'ma', 'mar']
+
+# Adds accounts with random lowercase and capitalised usernames until there are target of them
+def fill_users(start: int, target: int):
+    rng = random.Random(start)
+    for chunk_start in range(start, target, INSERT_CHUNK):
+        rows = []
+        for i in range(chunk_start, min(chunk_start + INSERT_CHUNK, target)):
+            name = ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10)))
+            rows.append({"username": f"{name.capitalize() if i % 3 == 0 else name}{i}", "password_hash": 'x',
+                         "public_key_rsa": 'x', "public_key_dsa": 'x'})
+        db.session.execute(User.__table__.insert(), rows)
+    db.session.commit()
+
+# The same search without the index: every username is lowercased and matched
+def like_search(prefix: str, limit: int, offset: int = 0) -> list:
+    name = db.func.lower(User.username)
+    return (db.session.query(User.id, User.username).filter(name.like(prefix.lower() + '%'))
+            .order_by(name, User.id).offset(offset).limit(limit).all())
+
+# The next cursor a client holds after scrolling through pages - 1 pages of a search
+def cursor_before_page(prefix: str, limit: int, page: int) -> tuple:
+    after = None
+    for _ in range(page - 1):
+        users = db_search_users(prefix, limit, after)
+        after = (users[-1].username, users[-1].id)
+    return after
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-users', type=int, default=100000)
+    parser.add_argument('--page-size', type=int, default=10)
+    args = parser.parse_args()
+    limit = args.page_size
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(app)
+
+        with app.app_context():
+            db_migrate()
+            columns = ''.join(f" {f'{prefix!r} index':>11} {f'{prefix!r} LIKE':>11}" for prefix in PREFIXES)
+            print(f"{'users':>8}{columns} {'page 20 index':>14} {'page 20 LIKE':>13}")
+            users = 0
+            size = 10000
+            while size <= args.max_users:
+                fill_users(users, size)
+                users = size
+                row = f"{users:>8}"
+                for prefix in PREFIXES:
+                    assert [tuple(u) for u in db_search_users(prefix, limit)] == [tuple(u) for u in like_search(prefix, limit)]
+                    row += f" {time_ms(lambda: db_search_users(prefix, limit)):11.2f} {time_ms(lambda: like_search(prefix, limit)):11.2f}"
+                after = cursor_before_page('m', limit, 20)
+                assert [tuple(u) for u in db_search_users('m', limit, after)] == [tuple(u) for u in like_search('m', limit, 19 * limit)]
+                row += f" {time_ms(lambda: db_search_users('m', limit, after)):14.2f} {time_ms(lambda: like_search('m', limit, 19 * limit)):13.2f}"
+                print(row)
+                size *= 10
+            print(f"ms per search, {limit} users per page")
+
+if __name__ == '__main__':
+    main()
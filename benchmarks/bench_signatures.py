@@ -0,0 +1,110 @@
+"""
+Benchmark for server-side signature verification
+- Builds messages the way the browser client does: AES-GCM content under a room key, an RSA-PSS (2048 bit, SHA-256)
+  and an ECDSA (P-384, SHA-384) signature over the plaintext, from a set of senders
+- Times verify_messages alone for each signature type, with parsed public keys cached and parsed for every message
+- Then times batches spread over thread and process pools of 1 to --max-workers workers
+- Reports signatures per second, and per core (divided by the workers, up to the number of CPUs)
+
+Run from the repository root:
+    python benchmarks/bench_signatures.py [--messages 2000] [--senders 50] [--batch-size 64] [--max-workers <CPUs>]
+"""
+
+import argparse
+import base64
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256, SHA384
+from Crypto.PublicKey import RSA, ECC
+from Crypto.Signature import pss, DSS
+from crypto import PUBLIC_KEY_CACHE, decrypt_message_AES, verify_signature_RSA, verify_signature_DSA
+from verification import verify_messages
+
+# Encrypts like crypto.js encryptMessage: IV, ciphertext, tag
+def encrypt_message(text: bytes, room_key: bytes) -> str:
+    nonce = os.urandom(12)
+    ciphertext, tag = AES.new(room_key, AES.MODE_GCM, nonce=nonce).encrypt_and_digest(text)
+    return base64.b64encode(nonce + ciphertext + tag).decode()
+
+def export_public_key(key) -> str:
+    return base64.b64encode(key.public_key().export_key(format='DER')).decode()
+
+# verify_messages inputs for messages from random senders
+def build_items(messages: int, senders: int) -> list:
+    room_key = os.urandom(32)
+    keys = [(RSA.generate(2048), ECC.generate(curve='P-384')) for _ in range(senders)]
+    public_keys = [(export_public_key(rsa), export_public_key(ecc)) for rsa, ecc in keys]
+    items = []
+    for i in range(messages):
+        rsa_key, ecc_key = keys[i % senders]
+        text = f"message {i} ".encode() * 8
+        rsa_signature = base64.b64encode(pss.new(rsa_key, salt_bytes=32).sign(SHA256.new(text))).decode()
+        dsa_signature = base64.b64encode(DSS.new(ecc_key, 'fips-186-3').sign(SHA384.new(text))).decode()
+        items.append((encrypt_message(text, room_key), room_key, rsa_signature, dsa_signature) + public_keys[i % senders])
+    return items
+
+# Signatures per second of fn over the items; fn checks one item
+def rate(fn, items: list, signatures: int, cached: bool = True) -> float:
+    PUBLIC_KEY_CACHE.clear()
+    start = time.perf_counter()
+    for item in items:
+        if not cached:
+            PUBLIC_KEY_CACHE.clear()
+        assert fn(item)
+    return len(items) * signatures / (time.perf_counter() - start)
+
+def check_rsa(item) -> bool:
+    content, room_key, rsa_signature, _, rsa_public_key, _ = item
+    return verify_signature_RSA(decrypt_message_AES(content, room_key), rsa_signature, rsa_public_key)
+
+def check_dsa(item) -> bool:
+    content, room_key, _, dsa_signature, _, dsa_public_key = item
+    return verify_signature_DSA(decrypt_message_AES(content, room_key), dsa_signature, dsa_public_key)
+
+def check_both(item) -> bool:
+    return verify_messages([item])[0]
+
+# Signatures per second with batches spread over a pool of workers
+def pool_rate(executor_class, workers: int, items: list, batch_size: int) -> float:
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    with executor_class(max_workers=workers) as executor:
+        list(executor.map(verify_messages, batches[:workers])) # start the workers and warm their key caches
+        start = time.perf_counter()
+        results = [result for batch in executor.map(verify_messages, batches) for result in batch]
+        elapsed = time.perf_counter() - start
+    assert all(results)
+    return len(items) * 2 / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--senders', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    cpus = os.cpu_count()
+
+    print(f"Signing {args.messages} messages from {args.senders} senders...")
+    items = build_items(args.messages, args.senders)
+
+    print(f"{'check':<22} {'keys cached':>12} {'keys parsed':>12}  signatures/s, one thread")
+    for name, fn, signatures in (('RSA-PSS 2048', check_rsa, 1), ('ECDSA P-384', check_dsa, 1), ('both (verify_messages)', check_both, 2)):
+        print(f"{name:<22} {rate(fn, items, signatures):12.0f} {rate(fn, items, signatures, cached=False):12.0f}")
+
+    print(f"\n{'pool':<8} {'workers':>7} {'signatures/s':>13} {'per core':>9}")
+    for kind, executor_class in (('thread', ThreadPoolExecutor), ('process', ProcessPoolExecutor)):
+        workers = 1
+        while workers <= args.max_workers:
+            signatures_per_second = pool_rate(executor_class, workers, items, args.batch_size)
+            print(f"{kind:<8} {workers:>7} {signatures_per_second:13.0f} {signatures_per_second / min(workers, cpus):9.0f}")
+            workers *= 2
+    print(f"{cpus} CPUs; batches of {args.batch_size} messages, two signatures each")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark for the room list with unread counts as rooms get busy
+- Fills a scratch SQLite database with one user in many rooms, each with a growing history
+- The user has read about half of every room
+- Times the room list (one query over the counters) against counting unread messages per room,
+  and marking the newest message of a room read
+
+Run from the repository root:
+    python benchmarks/bench_unread.py [--rooms 20] [--max-rows 100000]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask
+from database import db, User, ChatSession, ChatParticipant, Message, db_get_user_chat_rooms, db_mark_read
+from bench_history import time_ms, INSERT_CHUNK
+
+# Adds messages to every room until each holds target rows, keeping the rooms' counters up to date
+def fill_rooms(rooms: int, start: int, target: int):
+    base = datetime(2024, 1, 1)
+    for session_id in range(1, rooms + 1):
+        for chunk_start in range(start, target, INSERT_CHUNK):
+            rows = [{"session_id": session_id, "sender_id": 1, "content": "x" * 64,
+                     "created_at": base + timedelta(seconds=i), "rsa_signature": "r", "dsa_signature": "d"}
+                    for i in range(chunk_start, min(chunk_start + INSERT_CHUNK, target))]
+            db.session.execute(Message.__table__.insert(), rows)
+        last_id = db.session.query(db.func.max(Message.id)).filter(Message.session_id == session_id).scalar()
+        db.session.execute(db.update(ChatSession).where(ChatSession.id == session_id)
+                           .values(message_count=target, last_message_id=last_id, last_message_at=base + timedelta(seconds=target)))
+    db.session.commit()
+
+# The user has read the first half of every room
+def read_half(rooms: int, target: int):
+    for session_id in range(1, rooms + 1):
+        first_id = db.session.query(db.func.min(Message.id)).filter(Message.session_id == session_id).scalar()
+        db.session.execute(db.update(ChatParticipant).where(ChatParticipant.session_id == session_id)
+                           .values(last_read_message_id=first_id + target // 2, read_count=target // 2 + 1))
+    db.session.commit()
+
+# Unread counts the way the room list would need them without counters
+def count_unread_per_room(user_id: int) -> list:
+    counts = []
+    for room, participant in db_get_user_chat_rooms(user_id):
+        counts.append(Message.query.filter(Message.session_id == room.id, Message.id > participant.last_read_message_id).count())
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--max-rows', type=int, default=100000, help='messages per room in the last round')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(app)
+
+        with app.app_context():
+            db.create_all()
+            db.session.add(User(username='bench', password_hash='x', public_key_rsa='x', public_key_dsa='x'))
+            for i in range(args.rooms):
+                db.session.add(ChatSession(name=f'room{i}', owner_id=1, encrypted_symmetric_key='x'))
+            db.session.flush()
+            for i in range(args.rooms):
+                db.session.add(ChatParticipant(session_id=i + 1, user_id=1))
+            db.session.commit()
+
+            print(f"{'rows/room':>10} {'room list ms':>13} {'COUNT per room ms':>18} {'mark_read ms':>13}")
+            rows = 0
+            size = 1000
+            while size <= args.max_rows:
+                fill_rooms(args.rooms, rows, size)
+                rows = size
+                read_half(args.rooms, rows)
+                room_list = time_ms(lambda: db_get_user_chat_rooms(1))
+                counted = time_ms(lambda: count_unread_per_room(1))
+                last_id = db.session.get(ChatSession, 1).last_message_id
+                # Each call moves the cursor back first, so every sample does the full update
+                def mark_newest_read():
+                    db.session.execute(db.update(ChatParticipant).where(ChatParticipant.session_id == 1)
+                                       .values(last_read_message_id=last_id - 10))
+                    db_mark_read(1, 1, last_id)
+                mark_read = time_ms(mark_newest_read)
+                print(f"{rows:>10} {room_list:13.2f} {counted:18.2f} {mark_read:13.2f}")
+                size *= 10
+            print(f"{args.rooms} rooms, half of each unread; mark_read marks the newest message read")
+
+if __name__ == '__main__':
+    main()
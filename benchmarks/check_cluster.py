@@ -0,0 +1,92 @@
+"""
+End-to-end check of the multi-worker deployment
+- Starts broker.py and two app.py workers with cluster.py against a scratch database
+- Logs in on worker 1 and reuses the session cookie on worker 2 (shared SECRET_KEY)
+- Sends a message from a client on worker 1 and checks a client on worker 2 receives it
+- Checks worker 1 shows the client on worker 2 online, once worker 2 has written its presence
+
+Run from the repository root:
+    python benchmarks/check_cluster.py
+"""
+
+import base64
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server import free_port, free_port_range, generate_keys, register, login, connect, migrate_database
+from cluster import start_cluster, stop_cluster
+
+# Waits for an event on a client and returns its data
+def wait_for(received: dict, event: threading.Event, timeout: float = 10.0):
+    if not event.wait(timeout):
+        raise AssertionError('timed out waiting for event')
+    return received
+
+def main():
+    tmp = tempfile.mkdtemp()
+    env = {
+        'DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'cluster.db'),
+        'MASTER_KEY': base64.b64encode(os.urandom(32)).decode(),
+        'PEPPER': base64.b64encode(os.urandom(32)).decode(),
+        'DEBUG': 'False',
+    }
+    migrate_database(dict(os.environ, **env))
+    base_port = free_port_range(2)
+    broker, processes = start_cluster(2, base_port, free_port(), env=env, quiet=True)
+    try:
+        worker1 = f'http://127.0.0.1:{base_port}'
+        worker2 = f'http://127.0.0.1:{base_port + 1}'
+        keys = generate_keys()
+        register(worker1, 'alice')
+        register(worker2, 'bob')
+        alice_http = login(worker1, 'alice', keys)
+        bob_http = login(worker1, 'bob', keys)
+
+        alice = connect(worker1, alice_http)
+        bob = connect(worker2, bob_http) # Session cookie from worker 1 is accepted by worker 2
+
+        created, created_event = {}, threading.Event()
+        alice.on('chat_created', lambda data: (created.update(data), created_event.set()))
+        alice.emit('create_chat_room', {'chat_name': 'cluster'})
+        room_id = wait_for(created, created_event)['room_id']
+
+        ids, ids_event = {}, threading.Event()
+        bob.on('res_query_user_id', lambda data: (ids.update(data), ids_event.set()))
+        bob.emit('query_user_id')
+        bob_id = wait_for(ids, ids_event)['user_id']
+
+        # Joining is only allowed once bob is a participant
+        alice.call('add_user_to_chat', {'room_id': room_id, 'user_id': bob_id}, timeout=10)
+        alice.emit('join_room', {'room_id': room_id})
+        bob.emit('join_room', {'room_id': room_id})
+        time.sleep(0.5)
+
+        delivered, delivered_event = {}, threading.Event()
+        bob.on('new_message', lambda data: (delivered.update(data), delivered_event.set()))
+        alice.emit('send_message_to_room', {'room_id': room_id, 'user_id': 1, 'message': 'hello',
+                                            'rsa_signature': 'r', 'dsa_signature': 'd'})
+        message = wait_for(delivered, delivered_event)['message']
+        assert message['content'] == 'hello', message
+        print(f"OK: message sent on port {base_port} was delivered on port {base_port + 1}")
+
+        # Worker 2 writes bob's presence within PRESENCE_FLUSH_INTERVAL (2 seconds) of his connecting
+        time.sleep(3)
+        room, room_event = {}, threading.Event()
+        alice.on('res_query_chat_room', lambda data: (room.update(data), room_event.set()))
+        alice.emit('query_chat_room', {'room_id': room_id})
+        online = {participant['id']: participant['is_online'] for participant in wait_for(room, room_event)['participants']}
+        assert online == {1: True, bob_id: True}, online
+        print(f"OK: user connected on port {base_port + 1} is shown online on port {base_port}")
+        alice.disconnect()
+        bob.disconnect()
+    finally:
+        stop_cluster(broker, processes)
+
+if __name__ == '__main__':
+    main()
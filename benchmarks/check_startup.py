@@ -0,0 +1,167 @@
+"""
+Import and startup time budget
+- Times, in fresh interpreters, importing app.py and ops.py, create_app() and whole maintenance commands
+- Imports are measured on top of the third-party packages they load, so the budget covers this repository's own
+  import-time work and not the speed of the machine
+- Also fails if importing app.py or calling create_app() needs MASTER_KEY/PEPPER or touches the database,
+  or if rotate-room-keys --rewrap fails or leaves a room key that the new master key cannot decrypt
+
+Run from the repository root:
+    python benchmarks/check_startup.py [--runs 5]
+"""
+
+import argparse
+import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Milliseconds, median of the runs
+STARTUP_BUDGETS = {
+    'import app': 150, # on top of its dependencies
+    'import ops': 100, # on top of its dependencies
+    'create_app()': 500, # includes loading the async server (eventlet)
+    'flask migrate --check': 2500, # the whole process, for an up-to-date database
+    'flask rotate-room-keys --rewrap': 5000, # the whole process, for REWRAP_ROOMS rooms
+}
+
+# Rooms in the database rotate-room-keys --rewrap runs on
+REWRAP_ROOMS = 200
+
+# Third-party packages app.py and ops.py pull in, imported first so they are not counted
+DEPENDENCIES = 'import flask, flask_socketio, flask_sqlalchemy, sqlalchemy, dotenv, bcrypt, Crypto.Cipher.AES, ' \
+               'Crypto.Cipher.PKCS1_OAEP, Crypto.PublicKey.RSA, Crypto.PublicKey.ECC, Crypto.Signature.DSS'
+
+# Runs in a fresh interpreter; prints the timings as JSON
+CHILD = f'''
+import json, os, sys, time
+{DEPENDENCIES}
+start = time.perf_counter()
+import ops
+ops_import = time.perf_counter() - start
+start = time.perf_counter()
+import app
+app_import = time.perf_counter() - start
+start = time.perf_counter()
+flask_app = app.create_app()
+create = time.perf_counter() - start
+print(json.dumps({{"import ops": ops_import, "import app": app_import, "create_app()": create,
+                  "database touched": os.path.exists(sys.argv[1])}}))
+'''
+
+# Creates rooms, each with its first key encrypted under MASTER_KEY
+SEED_ROOMS = '''
+import sys
+import app
+from crypto import encrypt_AES, generate_symmetric_key
+from database import db_create_account, db_check_account, db_create_chat_session
+flask_app = app.create_app()
+with flask_app.app_context():
+    db_create_account('owner', 'not a password hash', 'rsa', 'dsa')
+    owner = db_check_account('owner')
+    for index in range(int(sys.argv[1])):
+        key = encrypt_AES(generate_symmetric_key(), flask_app.config['MASTER_KEY']).decode()
+        db_create_chat_session(f'room {index}', owner.id, key)
+'''
+
+# Prints how many room keys MASTER_KEY cannot decrypt
+CHECK_ROOM_KEYS = '''
+import app
+from crypto import decrypt_AES
+from database import db, RoomKey
+flask_app = app.create_app()
+failed = 0
+with flask_app.app_context():
+    for key in db.session.scalars(db.select(RoomKey.encrypted_symmetric_key)):
+        try:
+            decrypt_AES(key, flask_app.config['MASTER_KEY'])
+        except Exception:
+            failed += 1
+print(failed)
+'''
+
+# Environment without keys, and with a database file that does not exist yet
+def clean_env(database_path: str) -> dict:
+    env = {name: value for name, value in os.environ.items() if name not in ('MASTER_KEY', 'PEPPER', 'OLD_MASTER_KEY')}
+    env['DATABASE_URI'] = 'sqlite:///' + database_path
+    return env
+
+def median(values: list) -> float:
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def measure_imports(runs: int) -> dict:
+    database_path = os.path.join(tempfile.mkdtemp(), 'startup.db')
+    samples = {'import app': [], 'import ops': [], 'create_app()': []}
+    for _ in range(runs):
+        # Run from an empty directory, so no .env supplies the keys
+        output = subprocess.run([sys.executable, '-c', f'import sys; sys.path.insert(0, {os.path.abspath(REPO_ROOT)!r})\n' + CHILD,
+                                 database_path], cwd=tempfile.mkdtemp(), env=clean_env(database_path),
+                                capture_output=True, text=True)
+        if output.returncode != 0:
+            sys.exit(f"Importing app.py or create_app() failed without keys:\n{output.stderr}")
+        timings = json.loads(output.stdout.strip().splitlines()[-1])
+        if timings['database touched']:
+            sys.exit("Importing app.py or create_app() touched the database")
+        for name in samples:
+            samples[name].append(timings[name] * 1000)
+    return {name: median(values) for name, values in samples.items()}
+
+def measure_command(runs: int) -> float:
+    database_path = os.path.join(tempfile.mkdtemp(), 'startup.db')
+    env = dict(clean_env(database_path), MASTER_KEY=base64.b64encode(os.urandom(32)).decode())
+    command = [sys.executable, '-m', 'flask', '--app', 'app', 'migrate']
+    subprocess.run(command, cwd=REPO_ROOT, env=env, capture_output=True, check=True)
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command + ['--check'], cwd=REPO_ROOT, env=env, capture_output=True, check=True)
+        samples.append((time.perf_counter() - start) * 1000)
+    return median(samples)
+
+# Runs rotate-room-keys --rewrap once on a database with REWRAP_ROOMS rooms, which uses the reader bind
+# a SQLite file gets, and checks every room key moved to the new master key
+def measure_rewrap() -> float:
+    database_path = os.path.join(tempfile.mkdtemp(), 'rewrap.db')
+    old_key = base64.b64encode(os.urandom(32)).decode()
+    env = dict(clean_env(database_path), MASTER_KEY=old_key)
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'migrate'], cwd=REPO_ROOT, env=env, capture_output=True, check=True)
+    subprocess.run([sys.executable, '-c', SEED_ROOMS, str(REWRAP_ROOMS)], cwd=REPO_ROOT, env=env, capture_output=True, check=True)
+    env = dict(env, MASTER_KEY=base64.b64encode(os.urandom(32)).decode(), OLD_MASTER_KEY=old_key)
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'rotate-room-keys', '--rewrap'],
+                            cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+    elapsed = (time.perf_counter() - start) * 1000
+    if output.returncode != 0:
+        sys.exit(f"rotate-room-keys --rewrap failed:\n{output.stderr}")
+    output = subprocess.run([sys.executable, '-c', CHECK_ROOM_KEYS], cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True)
+    failed = int(output.stdout.strip().splitlines()[-1])
+    if failed:
+        sys.exit(f"rotate-room-keys --rewrap left {failed} room keys the new master key cannot decrypt")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    results = measure_imports(args.runs)
+    results['flask migrate --check'] = measure_command(args.runs)
+    results['flask rotate-room-keys --rewrap'] = measure_rewrap()
+
+    failed = False
+    print(f"{'step':<33} {'ms':>8} {'budget':>7}")
+    for name, ms in results.items():
+        budget = STARTUP_BUDGETS[name]
+        over = ms > budget
+        failed = failed or over
+        print(f"{name:<33} {ms:>8.1f} {budget:>7}{'  OVER BUDGET' if over else ''}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
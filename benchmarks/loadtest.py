@@ -0,0 +1,289 @@
+"""
+Socket.IO load test for one app.py server
+- Starts app.py against a scratch SQLite database and drives it with python-socketio clients
+- Clients register, log in with generated RSA/ECDSA keys, create rooms and send encrypted, signed messages
+- Runs a matrix of connection counts, room sizes and history lengths
+- Reports open-room latency, send -> delivery latency (p50/p95/p99), throughput, server CPU and memory
+- Writes results as JSON so two runs can be compared with --compare
+
+Run from the repository root:
+    python benchmarks/loadtest.py [--connections 20,50] [--room-sizes 5,20] [--history 0,5000]
+                                  [--duration 5] [--rate 2] [--output results.json] [--compare old.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server import (start_server, generate_keys, register, login, connect, unwrap_room_key,
+                    encrypt_message, sign_rsa, sign_dsa, REPO_ROOT)
+
+KEY_PAIRS = 4 # Distinct key pairs shared round-robin between simulated users
+SIGNED_MESSAGES = 32 # Distinct plaintexts signed up front and reused
+
+# Returns the value at percentile p (0-100) of a sorted list
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def summarize(values: list) -> dict:
+    values = sorted(values)
+    return {"count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95),
+            "p99": percentile(values, 99), "max": values[-1] if values else 0.0}
+
+# One logged-in simulated user with an open socket
+class SimulatedUser:
+    def __init__(self, base_url: str, username: str, keys: dict):
+        self.username = username
+        self.keys = keys
+        self.http = login(base_url, username, keys)
+        self.client = connect(base_url, self.http)
+        self.responses = {}
+        self.events = {}
+        for name in ('res_query_user_id', 'chat_created', 'res_query_chat_room'):
+            self.events[name] = threading.Event()
+            self.client.on(name, self._recorder(name))
+        self.user_id = self.request('query_user_id', None, 'res_query_user_id')['user_id']
+
+    def _recorder(self, name):
+        def record(data):
+            self.responses[name] = data
+            self.events[name].set()
+        return record
+
+    # Emits an event and waits for its response event
+    def request(self, event: str, data, response: str, timeout: float = 60.0) -> dict:
+        self.events[response].clear()
+        if data is None:
+            self.client.emit(event)
+        else:
+            self.client.emit(event, data)
+        if not self.events[response].wait(timeout):
+            raise RuntimeError(f"{self.username}: no {response} after {event}")
+        return self.responses[response]
+
+# Inserts history rows straight into the scratch database
+def seed_history(database_path: str, room_id: int, sender_ids: list, count: int, content: str, rsa: str, dsa: str):
+    if count == 0:
+        return
+    base = datetime.now() - timedelta(seconds=count)
+    with sqlite3.connect(database_path, timeout=30) as conn:
+        conn.executemany(
+            "INSERT INTO messages (session_id, sender_id, content, created_at, rsa_signature, dsa_signature) VALUES (?, ?, ?, ?, ?, ?)",
+            ((room_id, sender_ids[i % len(sender_ids)], content, (base + timedelta(seconds=i)).isoformat(sep=' '), rsa, dsa)
+             for i in range(count)))
+
+# Samples the server's CPU and memory until stop is set
+def sample_process(pid: int, stop: threading.Event, samples: dict):
+    process = psutil.Process(pid)
+    process.cpu_percent(None)
+    while not stop.wait(0.25):
+        samples['cpu'].append(process.cpu_percent(None))
+        samples['rss'].append(process.memory_info().rss)
+
+def run_cell(users: list, process, database_path: str, room_size: int, history: int, duration: float, rate: float, cell: int) -> dict:
+    # Group users into rooms; rotate the owner so no user exceeds the chat room limit
+    rooms = []
+    for start in range(0, len(users) - room_size + 1, room_size):
+        members = users[start:start + room_size]
+        owner = members[cell % room_size]
+        room_id = owner.request('create_chat_room', {'chat_name': f'load-{cell}-{start}'}, 'chat_created')['room_id']
+        for member in members:
+            if member is not owner:
+                # Wait for the add, since members may only join rooms they belong to
+                owner.client.call('add_user_to_chat', {'room_id': room_id, 'user_id': member.user_id}, timeout=30)
+        rooms.append((room_id, members))
+
+    plaintext = 'load test message ' * 4
+    sample_keys = users[0].keys
+    for room_id, members in rooms:
+        seed_history(database_path, room_id, [member.user_id for member in members], history,
+                     encrypt_message(plaintext, os.urandom(32)), sign_rsa(plaintext, sample_keys), sign_dsa(plaintext, sample_keys))
+
+    # Open every room: join, then time query_chat_room
+    open_latencies = []
+    room_keys = {}
+    for room_id, members in rooms:
+        for member in members:
+            member.client.emit('join_room', {'room_id': room_id})
+            start = time.perf_counter()
+            payload = member.request('query_chat_room', {'room_id': room_id}, 'res_query_chat_room')
+            open_latencies.append((time.perf_counter() - start) * 1000)
+            room_keys[(room_id, member.user_id)] = unwrap_room_key(payload['user_encrypted_key'], member.keys)
+
+    # Pre-encrypt and sign messages per sender so the send loop only measures the server
+    outgoing = {}
+    for room_id, members in rooms:
+        for member in members:
+            texts = [f'{plaintext}{i}' for i in range(SIGNED_MESSAGES)]
+            outgoing[(room_id, member.user_id)] = [(text, sign_rsa(text, member.keys), sign_dsa(text, member.keys)) for text in texts]
+
+    sent_at = {}
+    delivery_latencies = []
+    lock = threading.Lock()
+    def on_new_message(data):
+        now = time.perf_counter()
+        with lock:
+            start = sent_at.get(data['message']['content'])
+            if start is not None:
+                delivery_latencies.append((now - start) * 1000)
+    for user in users:
+        user.client.on('new_message', on_new_message)
+
+    stop = threading.Event()
+    samples = {'cpu': [], 'rss': []}
+    sampler = threading.Thread(target=sample_process, args=(process.pid, stop, samples))
+    sampler.start()
+
+    sends = [0]
+    def sender(room_id, member):
+        key = room_keys[(room_id, member.user_id)]
+        messages = outgoing[(room_id, member.user_id)]
+        i = 0
+        next_send = time.perf_counter()
+        while not stop.is_set():
+            text, rsa_signature, dsa_signature = messages[i % len(messages)]
+            ciphertext = encrypt_message(text, key)
+            with lock:
+                sent_at[ciphertext] = time.perf_counter()
+                sends[0] += 1
+            member.client.emit('send_message_to_room', {'room_id': room_id, 'user_id': member.user_id, 'message': ciphertext,
+                                                        'rsa_signature': rsa_signature, 'dsa_signature': dsa_signature})
+            i += 1
+            next_send += 1 / rate
+            stop.wait(max(0, next_send - time.perf_counter()))
+
+    threads = [threading.Thread(target=sender, args=(room_id, member)) for room_id, members in rooms for member in members]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    time.sleep(1) # Let in-flight deliveries arrive
+    sampler.join()
+
+    for room_id, members in rooms:
+        for member in members:
+            member.client.emit('leave_room', {'room_id': room_id})
+
+    return {
+        "connections": len(users),
+        "room_size": room_size,
+        "rooms": len(rooms),
+        "history": history,
+        "open_room_ms": summarize(open_latencies),
+        "delivery_ms": summarize(delivery_latencies),
+        "sent": sends[0],
+        "delivered": len(delivery_latencies),
+        "expected_deliveries": sends[0] * room_size,
+        "send_rate": sends[0] / elapsed,
+        "delivery_rate": len(delivery_latencies) / elapsed,
+        "server_cpu_percent": sum(samples['cpu']) / len(samples['cpu']) if samples['cpu'] else 0.0,
+        "server_rss_mb": max(samples['rss']) / 2 ** 20 if samples['rss'] else 0.0,
+    }
+
+# Key used to match cells between two result files
+def cell_key(cell: dict) -> tuple:
+    return (cell['connections'], cell['room_size'], cell['history'])
+
+def print_cells(cells: list, baseline: dict = None):
+    print(f"{'conns':>5} {'room':>4} {'history':>7} {'open p50':>9} {'open p99':>9} {'deliv p50':>9} {'deliv p95':>9} "
+          f"{'deliv p99':>9} {'deliv/s':>8} {'cpu%':>5} {'rss MB':>7}")
+    for cell in cells:
+        line = (f"{cell['connections']:>5} {cell['room_size']:>4} {cell['history']:>7} {cell['open_room_ms']['p50']:9.1f} "
+                f"{cell['open_room_ms']['p99']:9.1f} {cell['delivery_ms']['p50']:9.1f} {cell['delivery_ms']['p95']:9.1f} "
+                f"{cell['delivery_ms']['p99']:9.1f} {cell['delivery_rate']:8.0f} {cell['server_cpu_percent']:5.0f} {cell['server_rss_mb']:7.1f}")
+        old = (baseline or {}).get(cell_key(cell))
+        if old:
+            deltas = [(name, metric) for name, metric in (('open p50', ('open_room_ms', 'p50')), ('deliv p99', ('delivery_ms', 'p99')))]
+            changes = []
+            for name, (group, stat) in deltas:
+                before, after = old[group][stat], cell[group][stat]
+                if before:
+                    changes.append(f"{name} {100 * (after - before) / before:+.0f}%")
+            line += '   vs baseline: ' + ', '.join(changes)
+        print(line)
+    print("Latencies in ms")
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', default='20,50', help='comma separated connection counts')
+    parser.add_argument('--room-sizes', default='5,20', help='comma separated room sizes')
+    parser.add_argument('--history', default='0,5000', help='comma separated history lengths per room')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds of sending per cell')
+    parser.add_argument('--rate', type=float, default=2.0, help='messages per second per connection')
+    parser.add_argument('--output', help='JSON results file (default: benchmarks/results/loadtest-<time>.json)')
+    parser.add_argument('--compare', help='earlier JSON results file to compare against')
+    parser.add_argument('--server-env', action='append', default=[], metavar='NAME=VALUE', help='extra environment for app.py')
+    args = parser.parse_args()
+
+    connections = [int(value) for value in args.connections.split(',')]
+    room_sizes = [int(value) for value in args.room_sizes.split(',')]
+    histories = [int(value) for value in args.history.split(',')]
+    server_env = dict(item.split('=', 1) for item in args.server_env)
+
+    key_pairs = [generate_keys() for _ in range(KEY_PAIRS)]
+    cells = []
+    for connection_count in connections:
+        database_path = os.path.join(tempfile.mkdtemp(), 'loadtest.db')
+        with start_server(server_env, database_path=database_path) as (base_url, process):
+            usernames = [f'load{i}' for i in range(connection_count)]
+            for username in usernames:
+                register(base_url, username)
+            users = [SimulatedUser(base_url, username, key_pairs[i % KEY_PAIRS]) for i, username in enumerate(usernames)]
+            cell_number = 0
+            for room_size in room_sizes:
+                if room_size > connection_count:
+                    continue
+                for history in histories:
+                    result = run_cell(users, process, database_path, room_size, history, args.duration, args.rate, cell_number)
+                    cell_number += 1
+                    cells.append(result)
+                    print_cells([result])
+            for user in users:
+                user.client.disconnect()
+
+    results = {
+        "revision": git_revision(),
+        "created_at": datetime.now().isoformat(timespec='seconds'),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "settings": {"duration": args.duration, "rate": args.rate, "server_env": server_env},
+        "cells": cells,
+    }
+    output = args.output or os.path.join(REPO_ROOT, 'benchmarks', 'results', f"loadtest-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {cell_key(cell): cell for cell in json.load(f)['cells']}
+    print()
+    print_cells(cells, baseline)
+    print(f"Results written to {output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+SQL statement budget per socket event
+- Builds the app with create_app against a scratch SQLite database
+- Fills one room with many participants and messages
+- Counts the SQL statements each socket event runs and fails if any exceeds its budget
+
+Budgets are fixed numbers, so an N+1 query pattern shows up as soon as a room has
+more than a handful of participants.
+
+Run from the repository root:
+    python benchmarks/query_budget.py [--participants 25] [--messages 200]
+"""
+
+import argparse
+import base64
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Maximum SQL statements per socket event, independent of room size
+QUERY_BUDGETS = {
+    'connect': 1,
+    'disconnect': 1,
+    'create_chat_room': 6,
+    'join_room': 0,
+    'leave_room': 0,
+    'add_user_to_chat': 6,
+    'remove_user_from_chat': 6,
+    'send_message_to_room': 3,
+    'query_chat_room': 5,
+    'query_chat_room/outsider': 0, # rejected by the membership index, no SQL
+    'query_chat_history': 3,
+    'query_room_keys': 2,
+    'query_public_keys': 1,
+    'query_user_chat_rooms': 1,
+    'mark_read': 1,
+    'query_user_by_username': 1,
+    'search_users': 1,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--participants', type=int, default=25)
+    parser.add_argument('--messages', type=int, default=200)
+    args = parser.parse_args()
+
+    from Crypto.PublicKey import RSA, ECC
+    from app import create_app, socketio
+    from database import count_queries, db_check_account, db_migrate
+
+    tmp = tempfile.mkdtemp()
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(tmp, 'budget.db'),
+                      'MASTER_KEY': os.urandom(32), 'PEPPER': os.urandom(32),
+                      'RATE_LIMITING': False}) # Setup sends hundreds of events from one connection
+    with app.app_context():
+        db_migrate()
+
+    rsa_public = base64.b64encode(RSA.generate(2048).publickey().export_key(format='DER')).decode()
+    dsa_public = base64.b64encode(ECC.generate(curve='P-256').public_key().export_key(format='DER')).decode()
+
+    # Registers and logs in a user, returning their HTTP client
+    def login(username):
+        client = app.test_client()
+        client.post('/api/register', data={'username': username, 'password': 'password'})
+        client.post('/api/login', data={'username': username, 'password': 'password',
+                                        'rsaPublicKey': rsa_public, 'dsaPublicKey': dsa_public})
+        return client
+
+    results = []
+
+    # Runs one socket event and records its statement count
+    def measure(name, fn):
+        with app.app_context():
+            with count_queries() as statements:
+                fn()
+        results.append((name, len(statements)))
+
+    owner_http = login('owner')
+    owner = socketio.test_client(app, flask_test_client=owner_http)
+    owner.emit('create_chat_room', {'chat_name': 'budget'})
+    room_id = owner.get_received()[-1]['args'][0]['room_id']
+    owner.emit('join_room', {'room_id': room_id})
+
+    with app.app_context():
+        owner_id = db_check_account('owner').id
+    for i in range(args.participants):
+        login(f'user{i}')
+        with app.app_context():
+            owner.emit('add_user_to_chat', {'room_id': room_id, 'user_id': db_check_account(f'user{i}').id})
+    for i in range(args.messages):
+        owner.emit('send_message_to_room', {'room_id': room_id, 'user_id': owner_id, 'message': 'x',
+                                            'rsa_signature': 'r', 'dsa_signature': 'd'})
+    login('extra')
+    with app.app_context():
+        extra_id = db_check_account('extra').id
+
+    member_http = login('member')
+    measure('connect', lambda: socketio.test_client(app, flask_test_client=member_http))
+    member = socketio.test_client(app, flask_test_client=member_http)
+    measure('create_chat_room', lambda: member.emit('create_chat_room', {'chat_name': 'second'}))
+    measure('join_room', lambda: owner.emit('join_room', {'room_id': room_id}))
+    measure('add_user_to_chat', lambda: owner.emit('add_user_to_chat', {'room_id': room_id, 'user_id': extra_id}))
+    measure('remove_user_from_chat', lambda: owner.emit('remove_user_from_chat', {'room_id': room_id, 'user_id': owner_id}))
+    owner.emit('add_user_to_chat', {'room_id': room_id, 'user_id': owner_id})
+    measure('send_message_to_room', lambda: owner.emit('send_message_to_room', {'room_id': room_id, 'user_id': owner_id,
+                                                                                'message': 'x', 'rsa_signature': 'r', 'dsa_signature': 'd'}))
+    measure('query_chat_room', lambda: owner.emit('query_chat_room', {'room_id': room_id}))
+    measure('query_chat_room/outsider', lambda: member.emit('query_chat_room', {'room_id': room_id}))
+    measure('query_chat_history', lambda: owner.emit('query_chat_history', {'room_id': room_id, 'before_message_id': args.messages // 2}))
+    measure('query_room_keys', lambda: owner.emit('query_room_keys', {'room_id': room_id, 'epochs': [0, 1]}))
+    measure('query_public_keys', lambda: owner.emit('query_public_keys', {'user_ids': [owner_id, extra_id]}))
+    measure('query_user_chat_rooms', lambda: owner.emit('query_user_chat_rooms'))
+    measure('mark_read', lambda: owner.emit('mark_read', {'room_id': room_id, 'message_id': args.messages}))
+    measure('query_user_by_username', lambda: owner.emit('query_user_by_username', {'username': 'extra'}))
+    measure('search_users', lambda: owner.emit('search_users', {'prefix': 'user', 'limit': 5, 'after': {'username': 'user1', 'id': 3}},
+                                               callback=True))
+    measure('leave_room', lambda: owner.emit('leave_room', {'room_id': room_id}))
+    measure('disconnect', lambda: member.disconnect())
+
+    failed = False
+    print(f"{'event':<25} {'statements':>10} {'budget':>7}")
+    for name, count in results:
+        budget = QUERY_BUDGETS[name]
+        over = count > budget
+        failed = failed or over
+        print(f"{name:<25} {count:>10} {budget:>7}{'  OVER BUDGET' if over else ''}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
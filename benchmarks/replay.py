@@ -0,0 +1,327 @@
+"""
+Replays a recorded traffic trace (recorder.py, TRAFFIC_TRACE_DIR) against a local app.py and a scratch SQLite database
+- Creates an account for every user in the trace and a room for every room in it, with every user who acted in the room
+  (or was added to it) as a participant; setup accounts own the rooms, so the chat room limit never gets in the way
+- Every recorded connection gets its own Socket.IO client, opened and closed where the trace connects and disconnects;
+  its events are sent in recorded order, each one waiting for the server's acknowledgement of the previous one
+- Payloads are rebuilt from the recorded sizes: messages are encrypted with the room key and signed like the browser does,
+  other events carry this run's room and user IDs
+- --speed 1 keeps the recorded timing, 10 replays ten times faster, max sends each event as soon as its connection is free
+- Reports the latency of every event type (p50/p95/p99/max) next to the handler time recorded in production,
+  and writes JSON results; --compare shows the change against an earlier run, e.g. of another build
+- Only ownership is not replayed: add_user_to_chat and remove_user_from_chat of another user are refused unless the
+  trace's user happens to own the room here, which still exercises the same checks
+
+Run from the repository root (needs pip install -r benchmarks/requirements.txt):
+    python benchmarks/replay.py traces/trace-<time>-<pid>.jsonl.gz [--speed 1|10|max] [--history 0] [--max-events N]
+                                [--output results.json] [--compare old.json] [--server-env NAME=VALUE]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import queue
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from recorder import TRACE_FORMAT, payload_size
+from server import start_server, generate_keys, register, login, connect, unwrap_room_key, encrypt_message, sign_rsa, sign_dsa
+from loadtest import summarize, percentile, sample_process, seed_history, git_revision, REPO_ROOT
+
+KEY_PAIRS = 4 # Distinct key pairs shared round-robin between replayed users
+ROOMS_PER_OWNER = 5 # app.CHAT_ROOM_LIMIT
+SIZE_BUCKET = 64 # Message plaintexts are rounded to this many bytes, so few need signing
+NO_DATA_EVENTS = ('query_user_chat_rooms', 'query_user_id')
+CALL_TIMEOUT = 30
+
+# Returns the trace header and its events as dicts, oldest first
+# A trace cut off by a crash is read up to its last complete block
+def read_trace(path: str, max_events: int = None) -> tuple:
+    events = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('format') != TRACE_FORMAT:
+            sys.exit(f"{path} is not a traffic trace")
+        try:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                events.append(dict(zip(header['fields'], json.loads(line))))
+                if max_events is not None and len(events) >= max_events:
+                    break
+        except EOFError:
+            pass
+    events.sort(key=lambda event: event['t_ms'])
+    return header, events
+
+# Trace users, and the trace users taking part in each trace room
+def trace_participants(events: list) -> tuple:
+    users = set()
+    rooms = defaultdict(set)
+    for event in events:
+        for user in (event['user'], event.get('target')):
+            if user is not None:
+                users.add(user)
+                if event['room'] is not None:
+                    rooms[event['room']].add(user)
+    return users, rooms
+
+# State of the scratch server shared by every replayed connection
+class ReplayContext:
+    def __init__(self, base_url: str, database_path: str, key_pairs: list):
+        self.base_url = base_url
+        self.database_path = database_path
+        self.key_pairs = key_pairs
+        self.sessions = {} # trace user -> logged in requests session
+        self.user_ids = {} # trace user -> user ID on this server
+        self.user_keys = {} # trace user -> key pair
+        self.room_ids = {} # trace room -> room ID on this server
+        self.room_keys = {} # trace room -> room key
+        self.last_message_ids = {} # trace room -> newest message ID sent here
+        self.signed = {} # (key pair, plaintext size) -> (plaintext, RSA signature, DSA signature)
+        self.send_overhead = 0
+        self.lock = threading.Lock()
+
+    def create_users(self, users: set):
+        for user in sorted(users):
+            register(self.base_url, f'replay{user}')
+            self.user_keys[user] = self.key_pairs[user % len(self.key_pairs)]
+            self.sessions[user] = login(self.base_url, f'replay{user}', self.user_keys[user])
+        import sqlite3
+        with sqlite3.connect(self.database_path) as conn:
+            ids = dict(conn.execute("SELECT username, id FROM users"))
+        self.user_ids = {user: ids[f'replay{user}'] for user in users}
+
+    # Setup accounts create the rooms and add their participants, then fetch each room's key
+    def create_rooms(self, rooms: dict):
+        keys = self.key_pairs[0]
+        trace_rooms = sorted(rooms)
+        for start in range(0, len(trace_rooms), ROOMS_PER_OWNER):
+            username = f'replay-owner{start // ROOMS_PER_OWNER}'
+            register(self.base_url, username)
+            client = connect(self.base_url, login(self.base_url, username, keys))
+            created = queue.Queue()
+            rooms_payloads = queue.Queue()
+            client.on('chat_created', created.put)
+            client.on('res_query_chat_room', rooms_payloads.put)
+            for room in trace_rooms[start:start + ROOMS_PER_OWNER]:
+                client.emit('create_chat_room', {'chat_name': f'replay{room}'})
+                room_id = created.get(timeout=CALL_TIMEOUT)['room_id']
+                self.room_ids[room] = room_id
+                for user in sorted(rooms[room]):
+                    client.call('add_user_to_chat', {'room_id': room_id, 'user_id': self.user_ids[user]}, timeout=CALL_TIMEOUT)
+                client.emit('query_chat_room', {'room_id': room_id})
+                self.room_keys[room] = unwrap_room_key(rooms_payloads.get(timeout=CALL_TIMEOUT)['user_encrypted_key'], keys)
+            client.disconnect()
+
+    # A message of about size payload bytes, signed by the user's key pair like the browser client does
+    def message(self, user: int, room: int, size: int) -> dict:
+        keys = self.user_keys[user]
+        plaintext_size = max(SIZE_BUCKET, (max(size - self.send_overhead, 0) * 3 // 4 - 28) // SIZE_BUCKET * SIZE_BUCKET)
+        with self.lock:
+            signed = self.signed.get((id(keys), plaintext_size))
+        if signed is None:
+            text = 'x' * plaintext_size
+            signed = (text, sign_rsa(text, keys), sign_dsa(text, keys))
+            with self.lock:
+                self.signed[(id(keys), plaintext_size)] = signed
+        text, rsa_signature, dsa_signature = signed
+        return {'room_id': self.room_ids[room], 'user_id': self.user_ids[user], 'message': encrypt_message(text, self.room_keys[room]),
+                'rsa_signature': rsa_signature, 'dsa_signature': dsa_signature}
+
+    # The payload a client would send for a recorded event
+    def payload(self, event: dict):
+        name, user, room = event['event'], event['user'], event['room']
+        room_id = self.room_ids.get(room)
+        target_id = self.user_ids.get(event.get('target'), self.user_ids[user])
+        if name == 'send_message_to_room':
+            return self.message(user, room, event['bytes'])
+        if name in ('add_user_to_chat', 'remove_user_from_chat'):
+            return {'room_id': room_id, 'user_id': target_id}
+        if name == 'query_room_keys':
+            return {'room_id': room_id, 'epochs': [0]}
+        if name == 'query_public_keys':
+            return {'user_ids': [target_id]}
+        if name == 'mark_read':
+            return {'room_id': room_id, 'message_id': self.last_message_ids.get(room, 1)}
+        if name == 'search_users':
+            return {'prefix': f'replay{user}'[:7], 'limit': 10}
+        if name == 'query_user_by_username':
+            return {'username': f'replay{event.get("target") or user}'}
+        if name == 'create_chat_room':
+            return {'chat_name': f'replay-new{user}'}
+        return {'room_id': room_id} if room_id is not None else {}
+
+# Sends one recorded connection's events in order on its own client
+class ReplayConnection:
+    def __init__(self, context: ReplayContext, user: int, results):
+        self.context = context
+        self.user = user
+        self.results = results # callable(event name, ms, failed)
+        self.client = None
+        self.events = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        self.client = connect(self.context.base_url, self.context.sessions[self.user])
+
+    def _run(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            name = event['event']
+            start = time.perf_counter()
+            failed = False
+            try:
+                if name == 'connect':
+                    if self.client is None:
+                        self._connect()
+                elif name == 'disconnect':
+                    if self.client is not None:
+                        self.client.disconnect()
+                        self.client = None
+                else:
+                    if self.client is None:
+                        self._connect() # The trace started while this connection was open
+                        start = time.perf_counter()
+                    if name in NO_DATA_EVENTS:
+                        reply = self.client.call(name, timeout=CALL_TIMEOUT)
+                    else:
+                        reply = self.client.call(name, self.context.payload(event), timeout=CALL_TIMEOUT)
+                    failed = isinstance(reply, dict) and 'error' in reply
+                    if name == 'send_message_to_room' and not failed:
+                        self.context.last_message_ids[event['room']] = reply['message_id']
+            except Exception:
+                failed = True
+            self.results(name, (time.perf_counter() - start) * 1000, failed)
+        if self.client is not None:
+            self.client.disconnect()
+
+# Sends every event at its recorded time divided by speed (speed None sends them all at once)
+# Returns the seconds the replay took
+def replay(context: ReplayContext, events: list, speed, results) -> float:
+    connections = {}
+    start = time.perf_counter()
+    for event in events:
+        if event['user'] is None:
+            continue
+        if speed is not None:
+            delay = start + event['t_ms'] / 1000 / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        connection = connections.get(event['conn'])
+        if connection is None:
+            connection = connections[event['conn']] = ReplayConnection(context, event['user'], results)
+        connection.events.put(event)
+    for connection in connections.values():
+        connection.events.put(None)
+    for connection in connections.values():
+        connection.thread.join()
+    return time.perf_counter() - start
+
+def print_results(results: dict, baseline: dict = None):
+    print(f"{'event':<24} {'count':>6} {'errors':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'trace p50':>10}")
+    for name, summary in sorted(results['events'].items()):
+        line = (f"{name:<24} {summary['count']:>6} {summary['errors']:>6} {summary['p50']:8.2f} {summary['p95']:8.2f} "
+                f"{summary['p99']:8.2f} {summary['max']:8.2f} {summary['trace_server_p50']:10.2f}")
+        before = (baseline or {}).get(name)
+        if before:
+            changes = [f"{key} {100 * (summary[key] - before[key]) / before[key]:+.0f}%" for key in ('p50', 'p95', 'p99') if before[key]]
+            line += '   vs baseline: ' + ', '.join(changes)
+        print(line)
+    print(f"{results['replayed']} events in {results['seconds']:.1f}s ({results['events_per_second']:.0f}/s), "
+          f"server CPU {results['server_cpu_percent']:.0f}%, RSS {results['server_rss_mb']:.0f} MB; latencies in ms, "
+          f"trace p50 is the handler time recorded in production")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace')
+    parser.add_argument('--speed', default='1', help='1 for recorded timing, 10 for ten times faster, max for no waiting')
+    parser.add_argument('--history', type=int, default=0, help='messages seeded into every room before replaying')
+    parser.add_argument('--max-events', type=int, help='replay only the first N events')
+    parser.add_argument('--output', help='JSON results file (default: benchmarks/results/replay-<time>.json)')
+    parser.add_argument('--compare', help='earlier JSON results file to compare against')
+    parser.add_argument('--server-env', action='append', default=[], metavar='NAME=VALUE', help='extra environment for app.py')
+    args = parser.parse_args()
+    speed = None if args.speed == 'max' else float(args.speed)
+    server_env = dict(item.split('=', 1) for item in args.server_env)
+
+    header, events = read_trace(args.trace, args.max_events)
+    users, rooms = trace_participants(events)
+    print(f"{len(events)} events from {len(users)} users in {len(rooms)} rooms, "
+          f"recorded over {events[-1]['t_ms'] / 1000 if events else 0:.0f}s starting {header['started_at']}")
+
+    database_path = os.path.join(tempfile.mkdtemp(), 'replay.db')
+    with start_server(server_env, database_path=database_path) as (base_url, process):
+        context = ReplayContext(base_url, database_path, [generate_keys() for _ in range(KEY_PAIRS)])
+        context.create_users(users)
+        context.create_rooms(rooms)
+        context.send_overhead = payload_size(dict(context.message(min(users), min(rooms), 0), message='')) if rooms else 0
+        if args.history:
+            text = 'x' * SIZE_BUCKET
+            keys = context.key_pairs[0]
+            for room, members in rooms.items():
+                seed_history(database_path, context.room_ids[room], [context.user_ids[user] for user in members], args.history,
+                             encrypt_message(text, context.room_keys[room]), sign_rsa(text, keys), sign_dsa(text, keys))
+        print(f"Replaying at {'maximum speed' if speed is None else f'{speed:g}x'}...")
+
+        latencies = defaultdict(list)
+        errors = defaultdict(int)
+        lock = threading.Lock()
+        def record(name, ms, failed):
+            with lock:
+                latencies[name].append(ms)
+                errors[name] += 1 if failed else 0
+
+        stop = threading.Event()
+        samples = {'cpu': [], 'rss': []}
+        sampler = threading.Thread(target=sample_process, args=(process.pid, stop, samples))
+        sampler.start()
+        seconds = replay(context, events, speed, record)
+        stop.set()
+        sampler.join()
+
+    recorded = defaultdict(list)
+    for event in events:
+        recorded[event['event']].append(event['server_ms'])
+    replayed = sum(len(values) for values in latencies.values())
+    results = {
+        "revision": git_revision(),
+        "created_at": datetime.now().isoformat(timespec='seconds'),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "settings": {"trace": os.path.basename(args.trace), "speed": args.speed, "history": args.history,
+                     "max_events": args.max_events, "server_env": server_env},
+        "events": {name: dict(summarize(values), errors=errors[name],
+                              trace_server_p50=percentile(sorted(recorded[name]), 50)) for name, values in latencies.items()},
+        "replayed": replayed,
+        "seconds": seconds,
+        "events_per_second": replayed / seconds if seconds else 0.0,
+        "server_cpu_percent": sum(samples['cpu']) / len(samples['cpu']) if samples['cpu'] else 0.0,
+        "server_rss_mb": max(samples['rss']) / 2 ** 20 if samples['rss'] else 0.0,
+    }
+    output = args.output or os.path.join(REPO_ROOT, 'benchmarks', 'results', f"replay-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['events']
+    print()
+    print_results(results, baseline)
+    print(f"Results written to {output}")
+
+if __name__ == '__main__':
+    main()
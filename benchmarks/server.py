@@ -0,0 +1,144 @@
+"""
+Helpers for benchmarks that drive a real app.py server
+- Creates the schema of a scratch SQLite database and starts app.py against it in a subprocess
+- Registers and logs in users over HTTP and opens python-socketio clients with their session
+- Encrypts and signs messages in the same formats as static/js/crypto.js
+"""
+
+import base64
+import contextlib
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+import socketio
+from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Hash import SHA256, SHA384
+from Crypto.PublicKey import RSA, ECC
+from Crypto.Random import get_random_bytes
+from Crypto.Signature import DSS, pss
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Returns a free TCP port on localhost
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# Returns the first of count consecutive free TCP ports on localhost
+def free_port_range(count: int) -> int:
+    while True:
+        base = free_port()
+        try:
+            for port in range(base, base + count):
+                with socket.socket() as s:
+                    s.bind(('127.0.0.1', port))
+            return base
+        except OSError:
+            continue
+
+# Creates or upgrades the schema of the database in env['DATABASE_URI'], like flask --app app migrate
+def migrate_database(env: dict):
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'migrate'], cwd=REPO_ROOT, env=env,
+                   stdout=subprocess.DEVNULL, check=True)
+
+# Starts app.py and yields (base_url, process); env overrides are passed to the server
+# The scratch database is created at database_path if given
+@contextlib.contextmanager
+def start_server(env: dict = None, startup_timeout: float = 30.0, database_path: str = None):
+    database_path = database_path or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    port = free_port()
+    server_env = dict(os.environ)
+    server_env.update({
+        'HOST': '127.0.0.1',
+        'PORT': str(port),
+        'DEBUG': 'False',
+        'DATABASE_URI': 'sqlite:///' + database_path,
+        'MASTER_KEY': base64.b64encode(os.urandom(32)).decode(),
+        'PEPPER': base64.b64encode(os.urandom(32)).decode(),
+        'TERM': 'dumb',
+        'RATE_LIMITING': 'False', # Benchmarks measure capacity; pass RATE_LIMITING=True in env to include the limits
+    })
+    server_env.update(env or {})
+    migrate_database(server_env)
+    process = subprocess.Popen([sys.executable, 'app.py'], cwd=REPO_ROOT, env=server_env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.time() + startup_timeout
+        while True:
+            try:
+                requests.get(base_url + '/login', timeout=1)
+                break
+            except requests.ConnectionError:
+                if process.poll() is not None or time.time() > deadline:
+                    raise RuntimeError('app.py did not start')
+                time.sleep(0.1)
+        yield base_url, process
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+# A pair of public keys shared by all simulated users, returned base64 encoded like the browser sends them
+# Also returns the private keys for clients that need to unwrap room keys or sign
+def generate_keys() -> dict:
+    rsa = RSA.generate(2048)
+    dsa = ECC.generate(curve='P-384')
+    return {
+        'rsa_private': rsa,
+        'dsa_private': dsa,
+        'rsa_public': base64.b64encode(rsa.publickey().export_key(format='DER')).decode(),
+        'dsa_public': base64.b64encode(dsa.public_key().export_key(format='DER')).decode(),
+    }
+
+# Registers a user, retrying while the server answers 503
+def register(base_url: str, username: str, password: str = 'password'):
+    while True:
+        response = requests.post(base_url + '/api/register', data={'username': username, 'password': password})
+        if response.status_code != 503:
+            return response
+        time.sleep(float(response.headers.get('Retry-After', 1)))
+
+# Logs in and returns the requests session holding the login cookie
+def login(base_url: str, username: str, keys: dict, password: str = 'password') -> requests.Session:
+    http = requests.Session()
+    while True:
+        response = http.post(base_url + '/api/login', data={'username': username, 'password': password,
+                                                            'rsaPublicKey': keys['rsa_public'], 'dsaPublicKey': keys['dsa_public']})
+        if response.status_code != 503:
+            break
+        time.sleep(float(response.headers.get('Retry-After', 1)))
+    response.raise_for_status()
+    return http
+
+# Opens a Socket.IO client authenticated with the given logged-in session
+def connect(base_url: str, http: requests.Session) -> socketio.Client:
+    client = socketio.Client()
+    cookie = '; '.join(f'{name}={value}' for name, value in http.cookies.items())
+    client.connect(base_url, headers={'Cookie': cookie}, transports=['websocket'])
+    return client
+
+# Decrypts the room key from res_query_chat_room with the user's RSA private key
+def unwrap_room_key(user_encrypted_key: str, keys: dict) -> bytes:
+    cipher = PKCS1_OAEP.new(keys['rsa_private'], hashAlgo=SHA256)
+    return cipher.decrypt(base64.b64decode(user_encrypted_key))
+
+# AES-GCM encrypts a message as base64(iv || ciphertext || tag), like encryptMessage in crypto.js
+def encrypt_message(message: str, room_key: bytes) -> str:
+    iv = get_random_bytes(12)
+    cipher = AES.new(room_key, AES.MODE_GCM, nonce=iv)
+    ciphertext, tag = cipher.encrypt_and_digest(message.encode())
+    return base64.b64encode(iv + ciphertext + tag).decode()
+
+# RSA-PSS (SHA-256, 32 byte salt) signature, like signMessageRSA in crypto.js
+def sign_rsa(message: str, keys: dict) -> str:
+    return base64.b64encode(pss.new(keys['rsa_private'], salt_bytes=32).sign(SHA256.new(message.encode()))).decode()
+
+# ECDSA P-384 (SHA-384) signature in raw r||s form, like signMessageDSA in crypto.js
+def sign_dsa(message: str, keys: dict) -> str:
+    return base64.b64encode(DSS.new(keys['dsa_private'], 'fips-186-3').sign(SHA384.new(message.encode()))).decode()
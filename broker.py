@@ -0,0 +1,208 @@
+"""
+Local message broker for running several app.py workers on one machine
+- A small TCP fan-out server: every frame a worker publishes is sent to every connected worker
+- LocalBrokerManager plugs it into python-socketio so emit(..., room=...) reaches clients on any worker
+- Stand-in for Redis/RabbitMQ during development and tests; use SOCKETIO_MESSAGE_QUEUE=tcp://host:port
+- Frames are JSON (bytes and tuples tagged), so a frame from the network can never run code in a worker
+- There is no authentication: the broker only listens on loopback unless --allow-remote is given
+
+Run the broker:
+    python broker.py [--host 127.0.0.1] [--port 5555] [--allow-remote]
+"""
+
+import argparse
+import base64
+import ipaddress
+import json
+import socket
+import socketserver
+import struct
+import threading
+import time
+from urllib.parse import urlparse
+
+import socketio
+
+HEADER = struct.Struct('!I')
+
+# Sends one length-prefixed frame
+def send_frame(sock, payload: bytes):
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+# Reads exactly n bytes, or returns None if the connection closed
+def recv_exact(sock, n: int):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+# Reads one length-prefixed frame, or returns None if the connection closed
+def recv_frame(sock):
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    return recv_exact(sock, HEADER.unpack(header)[0])
+
+# JSON cannot tell tuples from lists (emit data as a tuple means several arguments) or hold bytes (msgpack replies),
+# so both are tagged
+def tag_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode()}
+    if isinstance(value, tuple):
+        return {'__tuple__': [tag_value(item) for item in value]}
+    if isinstance(value, list):
+        return [tag_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: tag_value(item) for key, item in value.items()}
+    return value
+
+def untag_value(value: dict):
+    if len(value) == 1 and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    if len(value) == 1 and '__tuple__' in value:
+        return tuple(value['__tuple__'])
+    return value
+
+def encode_message(message: dict) -> bytes:
+    return json.dumps(tag_value(message), separators=(',', ':')).encode('utf-8')
+
+def decode_message(payload: bytes) -> dict:
+    return json.loads(payload, object_hook=untag_value)
+
+# Whether host only resolves to loopback addresses
+def is_loopback(host: str) -> bool:
+    try:
+        return all(ipaddress.ip_address(info[4][0]).is_loopback for info in socket.getaddrinfo(host, None))
+    except (OSError, ValueError):
+        return False
+
+## Broker ##
+# A connected worker's socket and send lock; hashable so subscribers can live in a set
+class _Subscriber(dict):
+    __hash__ = object.__hash__
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, BrokerHandler)
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    # Sends a frame to every connected worker, dropping any that have gone away
+    def broadcast(self, payload: bytes):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                with subscriber['lock']:
+                    send_frame(subscriber['sock'], payload)
+            except OSError:
+                with self.lock:
+                    self.subscribers.discard(subscriber)
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        subscriber = _Subscriber(sock=self.request, lock=threading.Lock())
+        with self.server.lock:
+            self.server.subscribers.add(subscriber)
+        try:
+            while True:
+                payload = recv_frame(self.request)
+                if payload is None:
+                    break
+                self.server.broadcast(payload)
+        except OSError:
+            pass
+        finally:
+            with self.server.lock:
+                self.server.subscribers.discard(subscriber)
+
+# Starts a broker in a background thread and returns the server (call shutdown() to stop it)
+# Anyone who can reach the broker can emit to every client, so other hosts need allow_remote
+def start_broker(host: str = '127.0.0.1', port: int = 5555, allow_remote: bool = False) -> BrokerServer:
+    if not allow_remote and not is_loopback(host):
+        raise ValueError(f"The broker has no authentication; refusing to listen on {host} without allow_remote")
+    server = BrokerServer((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+## Socket.IO client manager ##
+class LocalBrokerManager(socketio.PubSubManager):
+    name = 'localbroker'
+
+    def __init__(self, url: str = 'tcp://127.0.0.1:5555', channel: str = 'flask-socketio', write_only: bool = False, logger=None):
+        parsed = urlparse(url)
+        self.address = (parsed.hostname, parsed.port)
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    # Opens a connection to the broker using sockets that cooperate with the server's async mode
+    def _connect(self):
+        if self.server is not None and self.server.async_mode == 'eventlet':
+            from eventlet.green import socket as socket_module
+        else:
+            socket_module = socket
+        sock = socket_module.create_connection(self.address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _publish(self, data):
+        payload = encode_message({'channel': self.channel, 'data': data})
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect()
+                    send_frame(self._publisher, payload)
+                    return
+                except OSError:
+                    self._publisher = None
+                    if attempt:
+                        raise
+
+    def _listen(self):
+        while True:
+            try:
+                sock = self._connect()
+            except OSError:
+                self._get_logger().error('Cannot reach message broker at %s:%s, retrying', *self.address)
+                self.server.sleep(1)
+                continue
+            try:
+                while True:
+                    payload = recv_frame(sock)
+                    if payload is None:
+                        break
+                    try:
+                        message = decode_message(payload)
+                    except ValueError:
+                        self._get_logger().error('Ignoring a malformed message broker frame')
+                        continue
+                    if isinstance(message, dict) and message.get('channel') == self.channel:
+                        yield message['data']
+            except OSError:
+                pass
+            finally:
+                sock.close()
+            self._get_logger().error('Lost connection to message broker, reconnecting')
+            self.server.sleep(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local Socket.IO message broker')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--allow-remote', action='store_true', help='listen on a non-loopback host (the broker has no authentication)')
+    args = parser.parse_args()
+    broker = start_broker(args.host, args.port, args.allow_remote)
+    print(f"Broker listening on tcp://{args.host}:{args.port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        broker.shutdown()
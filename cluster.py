@@ -0,0 +1,82 @@
+"""
+Starts a multi-worker deployment on one machine
+- Runs the broker.py message broker
+- Starts N app.py workers on consecutive ports, sharing SECRET_KEY and the message queue
+- Put a sticky load balancer in front of the workers (see deploy/nginx.conf)
+
+Usage:
+    python cluster.py [--workers 4] [--base-port 5001] [--broker-port 5555]
+"""
+
+from broker import start_broker
+from dotenv import load_dotenv
+import argparse
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import time
+
+# Waits until something accepts connections on the port
+def wait_for_port(host: str, port: int, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Worker on port {port} exited with code {process.returncode}")
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Worker on port {port} did not start")
+
+# Starts the broker and the workers; returns (broker, worker processes)
+# env overrides are passed to every worker
+def start_cluster(workers: int, base_port: int, broker_port: int, host: str = '127.0.0.1', env: dict = None, quiet: bool = False):
+    load_dotenv()
+    broker = start_broker('127.0.0.1', broker_port)
+    worker_env = dict(os.environ)
+    worker_env.update(env or {})
+    worker_env['HOST'] = host
+    worker_env['SOCKETIO_MESSAGE_QUEUE'] = f'tcp://127.0.0.1:{broker_port}'
+    worker_env['SECRET_KEY'] = worker_env.get('SECRET_KEY') or secrets.token_hex(32)
+    worker_env['TERM'] = worker_env.get('TERM') or 'dumb'
+    output = subprocess.DEVNULL if quiet else None
+    processes = []
+    try:
+        # Workers do not create the schema; they exit if it needs flask --app app migrate first
+        for i in range(workers):
+            worker_env['PORT'] = str(base_port + i)
+            process = subprocess.Popen([sys.executable, 'app.py'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       env=dict(worker_env), stdout=output, stderr=output)
+            processes.append(process)
+        for i, process in enumerate(processes):
+            wait_for_port(host, base_port + i, process)
+    except Exception:
+        stop_cluster(broker, processes)
+        raise
+    return broker, processes
+
+def stop_cluster(broker, processes: list):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait(timeout=10)
+    broker.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run several app.py workers behind one message broker')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--base-port', type=int, default=5001)
+    parser.add_argument('--broker-port', type=int, default=5555)
+    parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args()
+    broker, processes = start_cluster(args.workers, args.base_port, args.broker_port, args.host)
+    print(f"{args.workers} workers on ports {args.base_port}-{args.base_port + args.workers - 1}, broker on {args.broker_port}")
+    try:
+        while all(process.poll() is None for process in processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    stop_cluster(broker, processes)
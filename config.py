@@ -0,0 +1,76 @@
+"""
+Settings read from the environment (and .env)
+- Nothing is read at import; create_app calls load_config() and stores the result in app.config
+- Benchmarks and scripts pass overrides to create_app instead of setting environment variables
+- Keys are decoded here, so a missing MASTER_KEY or PEPPER only matters to code that uses them
+"""
+
+from dotenv import load_dotenv
+import os
+import sys
+import base64
+
+# Decodes a base64 key from the environment, or None if it is not set
+def env_key(name: str):
+    value = os.getenv(name)
+    return base64.b64decode(value) if value else None
+
+def env_int(name: str, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+def env_float(name: str, default):
+    value = os.getenv(name)
+    return float(value) if value else default
+
+# Reads every setting from the environment, after loading .env
+def load_config() -> dict:
+    load_dotenv()
+    prefix = 'sqlite:///' if sys.platform.startswith('win') else 'sqlite:////'
+    return {
+        'MASTER_KEY': env_key('MASTER_KEY'), # Encrypts room keys at rest
+        'OLD_MASTER_KEY': env_key('OLD_MASTER_KEY'), # Previous master key, for rotate-room-keys --rewrap
+        'PEPPER': env_key('PEPPER'),
+        'SSL_CERT_PATH': os.getenv('SSL_CERT_PATH'),
+        'SSL_KEY_PATH': os.getenv('SSL_KEY_PATH'),
+        'PORT': os.getenv('PORT'),
+        'HOST': os.getenv('HOST'),
+        'DEBUG': (os.getenv('DEBUG') == 'True'),
+        'SQLALCHEMY_DATABASE_URI': os.getenv('DATABASE_URI') or prefix + 'securechat.db',
+        'PASSWORD_POOL_KIND': os.getenv('PASSWORD_POOL_KIND') or 'thread', # 'thread' or 'process'
+        'PASSWORD_POOL_SIZE': env_int('PASSWORD_POOL_SIZE', 4), # 0 hashes passwords on the event loop
+        'PASSWORD_QUEUE_LIMIT': env_int('PASSWORD_QUEUE_LIMIT', 64),
+        'DB_POOL_SIZE': env_int('DB_POOL_SIZE', 4), # Native threads running database calls; 0 runs them on the event loop
+        'DB_QUEUE_LIMIT': env_int('DB_QUEUE_LIMIT', 256), # Database calls waiting beyond this are rejected as busy
+        'DB_CALL_TIMEOUT': env_float('DB_CALL_TIMEOUT', 10), # Seconds before a handler gives up on a database call
+        'MEMBERSHIP_INDEX': (os.getenv('MEMBERSHIP_INDEX') or 'True') == 'True', # Check room membership in memory; False asks the database every time
+        'ROTATE_KEYS_ON_REMOVE': (os.getenv('ROTATE_KEYS_ON_REMOVE') or 'True') == 'True', # New room key epoch whenever a participant is removed
+        'SQLITE_BUSY_TIMEOUT': env_float('SQLITE_BUSY_TIMEOUT', 5), # Seconds SQLite waits for a lock before failing
+        'TRAFFIC_TRACE_DIR': os.getenv('TRAFFIC_TRACE_DIR'), # Record an anonymized trace of socket events here (recorder.py); unset records nothing
+        'TRAFFIC_TRACE_MAX_EVENTS': env_int('TRAFFIC_TRACE_MAX_EVENTS', 1000000), # Recording stops after this many events
+        'METRICS_TOKEN': os.getenv('METRICS_TOKEN'), # Bearer token for /metrics; without one, /metrics is only served in DEBUG
+        'EXPORT_TOKEN': os.getenv('EXPORT_TOKEN'), # Bearer token for /export; without one, /export is only served in DEBUG
+        'EXPORT_MAX_SECONDS': env_float('EXPORT_MAX_SECONDS', 300), # /export stops (incomplete) after this long, so its read transaction cannot pin the WAL
+        'SECRET_KEY': os.getenv('SECRET_KEY'), # Must be shared by all workers when running more than one
+        'SOCKETIO_MESSAGE_QUEUE': os.getenv('SOCKETIO_MESSAGE_QUEUE'), # e.g. tcp://127.0.0.1:5555 (broker.py) or redis://localhost:6379/0
+        'MESSAGE_GROUP_COMMIT': (os.getenv('MESSAGE_GROUP_COMMIT') == 'True'), # Commit messages in batches
+        'MESSAGE_BATCH_SIZE': env_int('MESSAGE_BATCH_SIZE', 64), # Most messages per batch
+        'MESSAGE_BATCH_DELAY': env_float('MESSAGE_BATCH_DELAY_MS', 5) / 1000, # Longest a message waits for its batch
+        'SIGNATURE_VERIFICATION': (os.getenv('SIGNATURE_VERIFICATION') == 'True'), # Check message signatures on the server after storing them
+        'SIGNATURE_POOL_KIND': os.getenv('SIGNATURE_POOL_KIND') or 'thread', # 'thread' or 'process'
+        'SIGNATURE_POOL_SIZE': env_int('SIGNATURE_POOL_SIZE', 2), # Workers checking signatures; 0 checks them on the event loop
+        'SIGNATURE_QUEUE_LIMIT': env_int('SIGNATURE_QUEUE_LIMIT', 16), # Batches waiting beyond this stay unchecked
+        'SIGNATURE_BATCH_SIZE': env_int('SIGNATURE_BATCH_SIZE', 64), # Most messages per batch
+        'SIGNATURE_BATCH_DELAY': env_float('SIGNATURE_BATCH_DELAY_MS', 50) / 1000, # Longest a message waits for its batch
+        'RATE_LIMITING': (os.getenv('RATE_LIMITING') or 'True') == 'True', # Token bucket limits on socket events
+        'RATE_LIMIT_CONNECTION': os.getenv('RATE_LIMIT_CONNECTION') or '20:60', # rate:burst for all events of one connection
+        'RATE_LIMITS': os.getenv('RATE_LIMITS') or 'send_message_to_room=5:20,query_chat_room=2:10,query_chat_history=5:10,create_chat_room=0.2:5,query_user_by_username=2:10,mark_read=2:10,search_users=5:10',
+        'ROOM_REFRESH_WINDOW': env_float('ROOM_REFRESH_WINDOW_MS', 250) / 1000, # requery_room notifications within this window are sent once
+        'ARCHIVE_DIR': os.getenv('ARCHIVE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'), # Old messages moved out by archive-messages
+        'MESSAGE_RETENTION_DAYS': env_int('MESSAGE_RETENTION_DAYS', None), # Default --max-age-days for archive-messages
+        'MESSAGE_RETENTION_COUNT': env_int('MESSAGE_RETENTION_COUNT', None), # Default --keep for archive-messages
+        'ATTACHMENT_DIR': os.getenv('ATTACHMENT_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'attachments'), # Encrypted uploaded files
+        'ATTACHMENT_MAX_SIZE': env_int('ATTACHMENT_MAX_SIZE', 100 * 1024 * 1024), # Largest encrypted file a client may upload, in bytes
+        'ATTACHMENT_CHUNK_SIZE': env_int('ATTACHMENT_CHUNK_SIZE', 1024 * 1024), # Largest upload request body, in bytes
+        'USE_X_SENDFILE': (os.getenv('USE_X_SENDFILE') == 'True'), # Let a fronting web server send attachment files (X-Sendfile)
+    }
@@ -4,16 +4,72 @@ Cryptographic utilities
 - AES encryption/decryption functions
 - Digital signature operations
 - Key distribution helpers
+- Bounded caches for unwrapped room keys, parsed public keys and wrapped keys
 """ 
 
 from bcrypt import hashpw, gensalt, checkpw
 from Crypto.Cipher import AES, PKCS1_OAEP
-from Crypto.Hash import SHA256
+from Crypto.Hash import SHA256, SHA384
 from Crypto.PublicKey import RSA, ECC
-from Crypto.Signature import DSS
+from Crypto.Signature import DSS, pss
 from Crypto.Random import get_random_bytes
+from collections import OrderedDict
+import threading
+import hashlib
 import base64
 
+ROOM_KEY_CACHE_SIZE = 1024
+PUBLIC_KEY_CACHE_SIZE = 4096
+WRAPPED_KEY_CACHE_SIZE = 8192
+
+# Thread-safe LRU cache with hit/miss counters
+class KeyCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns the cached value or None, counting the lookup as a hit or miss
+    # An entry that fails valid(value) is stale: it counts as a miss and is left for put to replace
+    def get(self, key, valid=None):
+        with self._lock:
+            if key in self._entries and (valid is None or valid(self._entries[key])):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    # Stores a value, evicting the least recently used entry when full
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    # Removes every entry whose key matches the predicate
+    def invalidate(self, predicate):
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+# room_id -> (encrypted room key, unwrapped room key)
+ROOM_KEY_CACHE = KeyCache(ROOM_KEY_CACHE_SIZE)
+# public key fingerprint -> parsed RSA or ECC key object
+PUBLIC_KEY_CACHE = KeyCache(PUBLIC_KEY_CACHE_SIZE)
+# (room_id, user_id, public key fingerprint) -> (encrypted room key, room key wrapped for that user)
+WRAPPED_KEY_CACHE = KeyCache(WRAPPED_KEY_CACHE_SIZE)
+
 # Hash Password
 def hash_password(password: str, pepper: bytes) -> str:
     return hashpw(password.encode() + pepper, gensalt()).decode()
@@ -42,10 +98,36 @@ def decrypt_AES(ciphertext: str, key: bytes) -> bytes:
     cipher = AES.new(key, AES.MODE_GCM, nonce)
     return cipher.decrypt_and_verify(ciphertext, tag)
 
+# Fingerprint of a base64 encoded public key
+def public_key_fingerprint(public_key: str) -> str:
+    return hashlib.sha256(public_key.encode()).hexdigest()
+
+# One fingerprint for a user's pair of public keys, recorded on the messages they sign with it
+def signing_keys_fingerprint(public_key_rsa: str, public_key_dsa: str) -> str:
+    return hashlib.sha256(f"{public_key_rsa}:{public_key_dsa}".encode()).hexdigest()[:32]
+
+# Import a base64 encoded RSA public key, reusing parsed keys from the cache
+def import_public_key_RSA(public_key: str):
+    fingerprint = public_key_fingerprint(public_key)
+    key = PUBLIC_KEY_CACHE.get(fingerprint)
+    if key is None:
+        key = RSA.import_key(base64.b64decode(public_key))
+        PUBLIC_KEY_CACHE.put(fingerprint, key)
+    return key
+
+# Import a base64 encoded ECC public key (the clients' "DSA" key), reusing parsed keys from the cache
+def import_public_key_ECC(public_key: str):
+    fingerprint = public_key_fingerprint(public_key)
+    key = PUBLIC_KEY_CACHE.get(fingerprint)
+    if key is None:
+        key = ECC.import_key(base64.b64decode(public_key))
+        PUBLIC_KEY_CACHE.put(fingerprint, key)
+    return key
+
 # Encrypt Key with RSA
 # Outputs a base64 encoded string
 def encrypt_key_RSA(key: bytes, public_key: str) -> str:
-    public_key = RSA.import_key(base64.b64decode(public_key))
+    public_key = import_public_key_RSA(public_key)
     cipher = PKCS1_OAEP.new(public_key, hashAlgo=SHA256)
     return base64.b64encode(cipher.encrypt(key)).decode()
 
@@ -53,4 +135,61 @@ def encrypt_key_RSA(key: bytes, public_key: str) -> str:
 def decrypt_key_RSA(key: str, private_key: str) -> bytes:
     private_key = RSA.import_key(base64.b64decode(private_key))
     cipher = PKCS1_OAEP.new(private_key, hashAlgo=SHA256)
-    return cipher.decrypt(base64.b64decode(key))
\ No newline at end of file
+    return cipher.decrypt(base64.b64decode(key))
+
+# Decrypt a message encrypted by the browser (crypto.js encryptMessage)
+# Unlike encrypt_AES, the format is a 12 byte IV, then the ciphertext, then the tag
+def decrypt_message_AES(content: str, key: bytes) -> bytes:
+    content = base64.b64decode(content)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=content[:12])
+    return cipher.decrypt_and_verify(content[12:-16], content[-16:])
+
+# Verify an RSA-PSS signature (SHA-256, 32 byte salt), as made by crypto.js signMessageRSA
+def verify_signature_RSA(message: bytes, signature: str, public_key: str) -> bool:
+    try:
+        pss.new(import_public_key_RSA(public_key), salt_bytes=32).verify(SHA256.new(message), base64.b64decode(signature))
+        return True
+    except (ValueError, TypeError, IndexError):
+        return False
+
+# Verify an ECDSA signature (SHA-384), as made by crypto.js signMessageDSA
+def verify_signature_DSA(message: bytes, signature: str, public_key: str) -> bool:
+    try:
+        DSS.new(import_public_key_ECC(public_key), 'fips-186-3').verify(SHA384.new(message), base64.b64decode(signature))
+        return True
+    except (ValueError, TypeError, IndexError):
+        return False
+
+# Unwrap one epoch of a room's symmetric key with the master key
+# Cached per (room, epoch); a changed encrypted key (e.g. re-encrypted by ops.py) counts as a miss
+def get_room_key(room_id: int, epoch: int, encrypted_key: str, master_key: bytes) -> bytes:
+    cached = ROOM_KEY_CACHE.get((room_id, epoch), lambda entry: entry[0] == encrypted_key)
+    if cached is not None:
+        return cached[1]
+    room_key = base64.b64decode(decrypt_AES(encrypted_key, master_key))
+    ROOM_KEY_CACHE.put((room_id, epoch), (encrypted_key, room_key))
+    return room_key
+
+# Returns one epoch of the room's symmetric key encrypted with the user's RSA public key
+# Cached per (room, epoch, user, public key fingerprint)
+def get_wrapped_room_key(room_id: int, epoch: int, user_id: int, encrypted_key: str, public_key: str, master_key: bytes) -> str:
+    cache_key = (room_id, epoch, user_id, public_key_fingerprint(public_key))
+    cached = WRAPPED_KEY_CACHE.get(cache_key, lambda entry: entry[0] == encrypted_key)
+    if cached is not None:
+        return cached[1]
+    wrapped_key = encrypt_key_RSA(get_room_key(room_id, epoch, encrypted_key, master_key), public_key)
+    WRAPPED_KEY_CACHE.put(cache_key, (encrypted_key, wrapped_key))
+    return wrapped_key
+
+# Drop cached wrapped keys for a user, e.g. after they log in with new public keys
+def invalidate_user_keys(user_id: int):
+    WRAPPED_KEY_CACHE.invalidate(lambda key: key[2] == user_id)
+
+# Drop cached keys for a room, e.g. after its keys are re-encrypted under a new master key
+def invalidate_room_keys(room_id: int):
+    ROOM_KEY_CACHE.invalidate(lambda key: key[0] == room_id)
+    WRAPPED_KEY_CACHE.invalidate(lambda key: key[0] == room_id)
+
+# Hit/miss counters for every key cache
+def key_cache_stats() -> dict:
+    return {"room_keys": ROOM_KEY_CACHE.stats(), "public_keys": PUBLIC_KEY_CACHE.stats(), "wrapped_keys": WRAPPED_KEY_CACHE.stats()}
@@ -6,13 +6,39 @@ Classes:
     ChatSession: Represents a chat session.
     ChatParticipant: Represents the association between users and chat sessions.
     Message: Represents a message sent within a chat session.
+    Attachment: Represents an encrypted file uploaded to a chat session.
 
 A whole lot of helper functions, Im not going to list them all here.
 """
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import tuple_, event, text, bindparam, or_, Select
+from sqlalchemy.engine import Engine
+from contextlib import contextmanager
 from datetime import datetime
-
-db = SQLAlchemy()
+import sqlite3
+
+# Sends SELECTs to the 'reader' bind when one is configured
+# Everything else goes to the default (writer) engine: flushes, INSERT/UPDATE/DELETE statements and ORM bulk
+# updates by primary key, which reach get_bind without a clause
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and isinstance(clause, Select):
+            reader = self._db.engines.get('reader')
+            if reader is not None:
+                return reader
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+# Objects stay readable after commit, so results can be handed back from database worker threads
+db = SQLAlchemy(session_options={"class_": RoutingSession, "expire_on_commit": False})
+
+# SQLite connections use WAL, so reads see the last commit instead of waiting for a write to finish
+@event.listens_for(Engine, 'connect')
+def _sqlite_on_connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.close()
 
 ## Database Models ##
 
@@ -26,6 +52,7 @@ class User(db.Model):
     public_key_rsa = db.Column(db.String, nullable=False)
     public_key_dsa = db.Column(db.String, nullable=False)
     is_online = db.Column(db.Boolean, default=False)
+    online_workers = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Workers the user has a live socket on
     created_at = db.Column(db.DateTime, default=datetime.now)
     signature_preference = db.Column(
         db.Enum('RSA', 'DSA', name='signature_preference_enum'),
@@ -33,6 +60,12 @@ class User(db.Model):
         nullable=False
     )
 
+    __table_args__ = (
+        # Serves search_users: usernames by case-insensitive prefix, in order
+        # Maintained by SQLite on every insert, so new accounts are searchable as soon as they are committed
+        db.Index('ix_users_username_lower', db.func.lower(username)),
+    )
+
     # Relationships
     chat_participations = db.relationship('ChatParticipant', backref='user', lazy=True)
     sent_messages = db.relationship('Message', backref='sender', lazy=True)
@@ -49,6 +82,10 @@ class ChatSession(db.Model):
     name = db.Column(db.String, nullable=False)
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     encrypted_symmetric_key = db.Column(db.String, nullable=False) # Encrypted with the server's Master key
+    key_epoch = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Epoch of encrypted_symmetric_key, used for new messages
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Messages ever sent, kept up to date for unread counts
+    last_message_id = db.Column(db.Integer, nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
 
     # Relationships
     participants = db.relationship('ChatParticipant', backref='chat_session', lazy=True)
@@ -57,12 +94,31 @@ class ChatSession(db.Model):
     def __repr__(self):
         return f"<ChatSession {self.id} at {self.created_at}>"
 
+# Room Keys Table
+# Every key a chat session has used; rotating adds an epoch instead of re-encrypting history
+class RoomKey(db.Model):
+    __tablename__ = 'room_keys'
+
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_sessions.id'), primary_key=True, nullable=False)
+    epoch = db.Column(db.Integer, primary_key=True, nullable=False)
+    encrypted_symmetric_key = db.Column(db.String, nullable=False) # Encrypted with the server's Master key
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f"<RoomKey epoch {self.epoch} of Session {self.session_id}>"
+
 # Chat Participants Table
 class ChatParticipant(db.Model):
     __tablename__ = 'chat_participants'
+    __table_args__ = (
+        # The primary key covers lookups by session; this covers lookups by user
+        db.Index('ix_chat_participants_user_id', 'user_id'),
+    )
 
     session_id = db.Column(db.Integer, db.ForeignKey('chat_sessions.id'), primary_key=True, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True, nullable=False)
+    last_read_message_id = db.Column(db.Integer, nullable=True) # Newest message the user has read
+    read_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Session's message_count as of that message
 
     def __repr__(self):
         return f"<ChatParticipant User {self.user_id} in Session {self.session_id}>"
@@ -71,6 +127,12 @@ class ChatParticipant(db.Model):
 # Content is encrypted with the chat session's symmetric key
 class Message(db.Model):
     __tablename__ = 'messages'
+    __table_args__ = (
+        # Serves history pages: newest messages of one session first
+        db.Index('ix_messages_session_id_created_at', 'session_id', 'created_at'),
+        # Serves messages of one session after a given ID (reconnects, unread counts)
+        db.Index('ix_messages_session_id_id', 'session_id', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     session_id = db.Column(db.Integer, db.ForeignKey('chat_sessions.id'), nullable=False)
@@ -79,40 +141,131 @@ class Message(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.now)
     rsa_signature = db.Column(db.String, nullable=False)
     dsa_signature = db.Column(db.String, nullable=False)
+    key_epoch = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Room key epoch the content is encrypted under
+    attachment_id = db.Column(db.Integer, db.ForeignKey('attachments.id'), nullable=True)
+    attachment_size = db.Column(db.Integer, nullable=True) # Copied from the attachment so pages need no join
+    verified = db.Column(db.Boolean, nullable=True) # Server's check of both signatures (verification.py); NULL until checked
+    signing_keys = db.Column(db.String, nullable=True) # signing_keys_fingerprint of the sender's public keys when sent; NULL if unknown
 
     def __repr__(self):
         return f"<Message {self.id} in Session {self.session_id} from User {self.sender_id}>"
 
-# Returns HTML-formatted string containing all database contents
-def database_to_html(db) -> str:
-    html = "<html><body>"
-
-    # Users Table
-    html += "<h2>Users</h2><table border='1'><tr><th>ID</th><th>Username</th><th>Is Online</th><th>Created At</th><th>RSA Public Key</th><th>DSA Public Key</th><th>Hashed Password</th></tr>"
-    for user in User.query.all():
-        html += f"<tr><td>{user.id}</td><td>{user.username}</td><td>{user.is_online}</td><td>{user.created_at}</td><td>{user.public_key_rsa}</td><td>{user.public_key_dsa}</td><td>{user.password_hash}</td></tr>"
-    html += "</table>"
-
-    # Chat Sessions Table
-    html += "<h2>Chat Sessions</h2><table border='1'><tr><th>ID</th><th>Name</th><th>Owner ID</th><th>Created At</th><th>Encrypted Symmetric Key</th></tr>"
-    for session in ChatSession.query.all():
-        html += f"<tr><td>{session.id}</td><td>{session.name}</td><td>{session.owner_id}</td><td>{session.created_at}</td><td>{session.encrypted_symmetric_key}</td></tr>"
-    html += "</table>"
-
-    # Chat Participants Table
-    html += "<h2>Chat Participants</h2><table border='1'><tr><th>Session ID</th><th>User ID</th></tr>"
-    for participant in ChatParticipant.query.all():
-        html += f"<tr><td>{participant.session_id}</td><td>{participant.user_id}</td></tr>"
-    html += "</table>"
-
-    # Messages Table
-    html += "<h2>Messages</h2><table border='1'><tr><th>ID</th><th>Session ID</th><th>Sender ID</th><th>Encrypted Data</th><th>Created At</th><th>RSA Signature</th><th>DSA Signature</th></tr>"
-    for message in Message.query.all():
-        html += f"<tr><td>{message.id}</td><td>{message.session_id}</td><td>{message.sender_id}</td><td>{message.content}</td><td>{message.created_at}</td><td>{message.rsa_signature}</td><td>{message.dsa_signature}</td></tr>"
-    html += "</table>"
-
-    html += "</body></html>"
-    return html
+# Attachments Table
+# The encrypted file itself is stored on disk by attachments.py
+class Attachment(db.Model):
+    __tablename__ = 'attachments'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('chat_sessions.id'), nullable=False)
+    uploader_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    size = db.Column(db.Integer, nullable=False) # Size of the encrypted file, declared when the upload starts
+    complete = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f"<Attachment {self.id} in Session {self.session_id} from User {self.uploader_id}>"
+
+# Collects every SQL statement executed inside the with-block
+# Usage: with count_queries() as statements: ...; len(statements)
+@contextmanager
+def count_queries():
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+
+# Progress of resumable maintenance jobs in ops.py
+# Updated in the same transaction as each batch, so a resumed job never skips or repeats rows
+class RotationCheckpoint(db.Model):
+    __tablename__ = 'rotation_checkpoints'
+
+    job = db.Column(db.String, primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    def __repr__(self):
+        return f"<RotationCheckpoint {self.job} at {self.last_id}>"
+
+# Columns added after their table was first released, as (table, column, definition, statement filling in existing rows)
+ADDED_COLUMNS = [
+    # Each existing room's key becomes its epoch 0
+    ('chat_sessions', 'key_epoch', 'INTEGER NOT NULL DEFAULT 0',
+     "INSERT INTO room_keys (session_id, epoch, encrypted_symmetric_key, created_at) "
+     "SELECT id, key_epoch, encrypted_symmetric_key, created_at FROM chat_sessions "
+     "WHERE NOT EXISTS (SELECT 1 FROM room_keys WHERE room_keys.session_id = chat_sessions.id)"),
+    ('messages', 'key_epoch', 'INTEGER NOT NULL DEFAULT 0', None),
+    ('messages', 'attachment_id', 'INTEGER REFERENCES attachments (id)', None),
+    ('messages', 'attachment_size', 'INTEGER', None),
+    ('chat_sessions', 'last_message_id', 'INTEGER', None),
+    ('chat_sessions', 'last_message_at', 'DATETIME', None),
+    ('chat_sessions', 'message_count', 'INTEGER NOT NULL DEFAULT 0',
+     "UPDATE chat_sessions SET "
+     "message_count = (SELECT COUNT(*) FROM messages WHERE messages.session_id = chat_sessions.id), "
+     "last_message_id = (SELECT MAX(id) FROM messages WHERE messages.session_id = chat_sessions.id), "
+     "last_message_at = (SELECT MAX(created_at) FROM messages WHERE messages.session_id = chat_sessions.id)"),
+    ('chat_participants', 'last_read_message_id', 'INTEGER', None),
+    ('messages', 'verified', 'BOOLEAN', None),
+    ('messages', 'signing_keys', 'VARCHAR', None),
+    ('users', 'online_workers', 'INTEGER NOT NULL DEFAULT 0', None),
+    # Existing history counts as read
+    ('chat_participants', 'read_count', 'INTEGER NOT NULL DEFAULT 0',
+     "UPDATE chat_participants SET "
+     "read_count = (SELECT message_count FROM chat_sessions WHERE chat_sessions.id = chat_participants.session_id), "
+     "last_read_message_id = (SELECT last_message_id FROM chat_sessions WHERE chat_sessions.id = chat_participants.session_id)"),
+]
+
+# Returns the steps that bring the database up to date with the models, as (description, apply(connection))
+# Missing tables are created whole; existing tables get missing columns (with their backfill) and indexes
+def migration_steps(connection) -> list:
+    inspector = db.inspect(connection)
+    tables = set(inspector.get_table_names())
+    steps = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            steps.append((f"create table {table.name}", lambda connection, table=table: table.create(connection)))
+    columns = {}
+    for table, column, definition, backfill in ADDED_COLUMNS:
+        if table not in tables:
+            continue
+        if table not in columns:
+            columns[table] = [existing['name'] for existing in inspector.get_columns(table)]
+        if column not in columns[table]:
+            statements = [f"ALTER TABLE {table} ADD COLUMN {column} {definition}"] + ([backfill] if backfill else [])
+            steps.append((f"add column {table}.{column}",
+                          lambda connection, statements=statements: [connection.execute(text(s)) for s in statements]))
+    # The SQLite inspector skips (and warns about) expression indexes such as ix_users_username_lower,
+    # so on SQLite index names come from sqlite_master; other databases are asked through the inspector
+    indexes = set()
+    if connection.dialect.name == 'sqlite':
+        indexes.update(connection.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars())
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        if connection.dialect.name != 'sqlite':
+            indexes.update(existing['name'] for existing in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                steps.append((f"create index {index.name}", index.create))
+    return steps
+
+# Descriptions of the schema changes the database is missing; empty when it is up to date
+# Only reads the schema, so servers can check it at startup without changing anything
+def db_pending_migrations() -> list:
+    with db.engine.connect() as connection:
+        return [description for description, _ in migration_steps(connection)]
+
+# Creates missing tables and brings tables created by an older version up to date, in one transaction
+# Run explicitly (flask --app app migrate) before starting servers; returns the descriptions of the steps applied
+def db_migrate() -> list:
+    with db.engine.begin() as connection:
+        steps = migration_steps(connection)
+        for _, apply in steps:
+            apply(connection)
+    return [description for description, _ in steps]
 
 # Helper function for creating a new account in the database
 def db_create_account(username: str, password_hash: str, \
@@ -130,10 +283,31 @@ def db_create_account(username: str, password_hash: str, \
 def db_check_account(username: str):
     return User.query.filter_by(username=username).first()
 
+# Lowercases text the way SQLite's lower() does, which only folds ASCII letters
+def sqlite_lower(text: str) -> str:
+    return ''.join(c.lower() if c.isascii() else c for c in text)
+
+# Returns up to limit (id, username) rows whose username starts with prefix, ignoring case,
+# ordered by lowercased username then ID; after is the (username, id) of the last row of the previous page
+# A range scan on ix_users_username_lower, so the cost depends on the page size, not the number of accounts
+def db_search_users(prefix: str, limit: int, after: tuple = None) -> list:
+    low = sqlite_lower(prefix)
+    high = low[:-1] + chr(min(ord(low[-1]) + 1, 0x10FFFF))
+    name = db.func.lower(User.username)
+    query = db.session.query(User.id, User.username).filter(name >= low, name < high)
+    if after is not None:
+        # The plain comparison moves the start of the index range, the row value skips ties already sent
+        query = query.filter(name >= sqlite_lower(after[0]), tuple_(name, User.id) > tuple_(sqlite_lower(after[0]), after[1]))
+    return query.order_by(name, User.id).limit(limit).all()
+
 # Get user by ID
 def db_get_user_by_id(user_id: int):
     return User.query.get(user_id)
 
+# Get several users by id in one query
+def db_get_users_by_ids(user_ids: list):
+    return User.query.filter(User.id.in_(user_ids)).all()
+
 # Get all users
 def db_get_all_users():
     return User.query.all()
@@ -144,6 +318,24 @@ def db_update_online_status(user_id: int, is_online: bool):
     user.is_online = is_online
     db.session.commit()
 
+# Adds to the number of workers each user has a live socket on, and sets is_online from it
+# Takes a dict of user_id -> +1 or -1 and commits once
+def db_add_online_workers(deltas: dict):
+    for delta in (1, -1):
+        user_ids = [user_id for user_id, change in deltas.items() if change == delta]
+        if user_ids:
+            online_workers = User.online_workers + delta
+            User.query.filter(User.id.in_(user_ids)).update(
+                {User.online_workers: db.case((online_workers > 0, online_workers), else_=0), User.is_online: online_workers > 0},
+                synchronize_session=False)
+    db.session.commit()
+
+# Marks every user offline, e.g. at startup before any socket has connected
+def db_reset_online_statuses():
+    User.query.filter(or_(User.is_online.is_(True), User.online_workers != 0))\
+        .update({User.is_online: False, User.online_workers: 0}, synchronize_session=False)
+    db.session.commit()
+
 # Update user's public key
 def db_update_public_key(user_id: int, public_key_rsa: str, public_key_dsa: str):
     user = db_get_user_by_id(user_id)
@@ -154,8 +346,10 @@ def db_update_public_key(user_id: int, public_key_rsa: str, public_key_dsa: str)
 # Creates a new empty chat session
 # Chats must have a owner and a name
 def db_create_chat_session(name: str, owner_id: int, encrypted_symmetric_key: str) -> ChatSession:
-    session = ChatSession(name=name, owner_id=owner_id, encrypted_symmetric_key=encrypted_symmetric_key)
+    session = ChatSession(name=name, owner_id=owner_id, encrypted_symmetric_key=encrypted_symmetric_key, key_epoch=0)
     db.session.add(session)
+    db.session.flush()
+    db.session.add(RoomKey(session_id=session.id, epoch=0, encrypted_symmetric_key=encrypted_symmetric_key))
     db.session.commit()
     return session
 
@@ -184,33 +378,204 @@ def db_remove_chat_participant(session_id: int, user_id: int):
     db.session.commit()
     return participant
 
+# Returns every (session_id, user_id) participant pair, e.g. to build the in-memory membership index
+def db_get_chat_participant_pairs() -> list:
+    return [(row.session_id, row.user_id) for row in db.session.query(ChatParticipant.session_id, ChatParticipant.user_id)]
+
+# Moves the user's read cursor in the chat session forward to message_id
+# Returns the number of messages still unread, or None if the cursor did not move
+# (an older message, or an ID past the session's newest message)
+# The read count is the session's message count minus the messages newer than the cursor, counted on the
+# (session_id, id) index, so marking the newest message read stays cheap however long the history is
+# Messages newer than the cursor that were already archived are not counted
+def db_mark_read(session_id: int, user_id: int, message_id: int):
+    message_count = db.select(ChatSession.message_count).where(ChatSession.id == session_id).scalar_subquery()
+    last_message_id = db.select(ChatSession.last_message_id).where(ChatSession.id == session_id).scalar_subquery()
+    newer = db.select(db.func.count()).select_from(Message)\
+        .where(Message.session_id == session_id, Message.id > message_id).scalar_subquery()
+    unread = db.session.execute(
+        db.update(ChatParticipant)
+        .where(ChatParticipant.session_id == session_id, ChatParticipant.user_id == user_id, message_id <= last_message_id,
+               or_(ChatParticipant.last_read_message_id.is_(None), ChatParticipant.last_read_message_id < message_id))
+        .values(last_read_message_id=message_id, read_count=message_count - newer)
+        .returning(message_count - ChatParticipant.read_count)
+        .execution_options(synchronize_session=False)).scalar()
+    db.session.commit()
+    return unread
+
+# Whether the user is a participant in the chat session
+def db_is_chat_participant(session_id: int, user_id: int) -> bool:
+    return ChatParticipant.query.filter_by(session_id=session_id, user_id=user_id).first() is not None
+
 # Returns all User objects that are participants in a given chat session
 def db_get_chat_session_users(session_id: int) -> list:
-    participants = ChatParticipant.query.filter_by(session_id=session_id).all()
-    users = []
-    for participant in participants:
-        users.append(db_get_user_by_id(participant.user_id))
-    return users
+    return User.query.join(ChatParticipant, ChatParticipant.user_id == User.id)\
+        .filter(ChatParticipant.session_id == session_id).order_by(User.id).all()
 
 # Creates a new message in the given chat session
-def db_create_message(session_id: int, sender_id: int, content: str, rsa: str, dsa: str) -> Message:
-    message = Message(session_id=session_id, sender_id=sender_id, content=content, rsa_signature=rsa, dsa_signature=dsa)
+def db_create_message(session_id: int, sender_id: int, content: str, rsa: str, dsa: str, key_epoch: int = 0,
+                      attachment_id: int = None, attachment_size: int = None, signing_keys: str = None) -> Message:
+    message = Message(session_id=session_id, sender_id=sender_id, content=content, rsa_signature=rsa, dsa_signature=dsa,
+                      key_epoch=key_epoch, attachment_id=attachment_id, attachment_size=attachment_size,
+                      signing_keys=signing_keys)
     db.session.add(message)
+    db.session.flush()
+    db_count_new_messages([message])
     db.session.commit()
     return message
 
+# Adds just-flushed messages to their chat sessions' message counts and latest message
+# One statement for all sessions, in the same transaction as the inserts
+def db_count_new_messages(messages: list):
+    sessions = {}
+    for message in messages:
+        added, last_id, last_at = sessions.get(message.session_id, (0, 0, message.created_at))
+        sessions[message.session_id] = (added + 1, max(last_id, message.id), max(last_at, message.created_at))
+    table = ChatSession.__table__
+    db.session.execute(table.update().where(table.c.id == bindparam('room_id'))
+                       .values(message_count=table.c.message_count + bindparam('added'),
+                               last_message_id=bindparam('last_id'), last_message_at=bindparam('last_at')),
+                       [{"room_id": session_id, "added": added, "last_id": last_id, "last_at": last_at}
+                        for session_id, (added, last_id, last_at) in sessions.items()])
+
+# Creates many messages in one transaction
+# Takes dicts with the db_create_message arguments and returns the messages in the same order
+def db_create_messages(rows: list) -> list:
+    messages = [Message(session_id=row["session_id"], sender_id=row["sender_id"], content=row["content"],
+                        rsa_signature=row["rsa"], dsa_signature=row["dsa"], key_epoch=row.get("key_epoch", 0),
+                        attachment_id=row.get("attachment_id"), attachment_size=row.get("attachment_size"),
+                        signing_keys=row.get("signing_keys")) for row in rows]
+    try:
+        db.session.add_all(messages)
+        db.session.flush()
+        db_count_new_messages(messages)
+        # Detach so IDs and timestamps stay loaded after the commit instead of being re-selected one by one
+        for message in messages:
+            db.session.expunge(message)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return messages
+
 # Returns all messages in the given chat session, sorted by creation time
 def db_get_messages(session_id: int) -> list:
     messages = Message.query.filter_by(session_id=session_id).order_by(Message.created_at).all()
     return messages
 
+# Returns messages in the given chat session with an ID greater than message_id, in send order
+# With a limit, only the first limit of them
+def db_get_messages_since(session_id: int, message_id: int, limit: int = None) -> list:
+    query = Message.query.filter(Message.session_id == session_id, Message.id > message_id).order_by(Message.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+# Returns up to limit messages in the given chat session, oldest first
+# Without before_message_id this is the latest page; otherwise the page just older than that message
+# Uses keyset pagination on (created_at, id) so the cost does not grow with the size of the history
+def db_get_messages_page(session_id: int, limit: int, before_message_id: int = None) -> list:
+    query = Message.query.filter(Message.session_id == session_id)
+    if before_message_id is not None:
+        cursor = Message.query.get(before_message_id)
+        if cursor is None or cursor.session_id != session_id:
+            return []
+        query = query.filter(tuple_(Message.created_at, Message.id) < tuple_(cursor.created_at, cursor.id))
+    messages = query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit).all()
+    messages.reverse()
+    return messages
+
+# Returns the ID of the newest message in the chat session that should move to the archive, or None
+# A message is archived if it was sent before older_than, or if more than keep messages are newer than it
+def db_get_archive_boundary(session_id: int, older_than: datetime = None, keep: int = None):
+    boundary = None
+    if older_than is not None:
+        boundary = db.session.query(db.func.max(Message.id))\
+            .filter(Message.session_id == session_id, Message.created_at < older_than).scalar()
+    if keep is not None:
+        row = db.session.query(Message.id).filter(Message.session_id == session_id)\
+            .order_by(Message.id.desc()).offset(keep).limit(1).first()
+        if row is not None and (boundary is None or row.id > boundary):
+            boundary = row.id
+    return boundary
+
+# Returns up to limit messages in the chat session with an ID up to last_id, oldest first
+def db_get_messages_through(session_id: int, last_id: int, limit: int) -> list:
+    return Message.query.filter(Message.session_id == session_id, Message.id <= last_id)\
+        .order_by(Message.id).limit(limit).all()
+
+# Counts messages in the chat session with an ID up to last_id
+def db_count_messages_through(session_id: int, last_id: int) -> int:
+    return Message.query.filter(Message.session_id == session_id, Message.id <= last_id).count()
+
+# Deletes messages by ID in one statement
+def db_delete_messages(message_ids: list):
+    Message.query.filter(Message.id.in_(message_ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+# Everything needed to check the signatures of the given messages, as rows of (message ID, session ID, key epoch,
+# content, RSA signature, DSA signature, sender's RSA public key, sender's DSA public key, encrypted room key,
+# fingerprint of the keys the message was signed with)
+# Messages whose room key epoch is missing are left out
+def db_get_messages_to_verify(message_ids: list) -> list:
+    rows = db.session.query(Message.id, Message.session_id, Message.key_epoch, Message.content, Message.rsa_signature,
+                            Message.dsa_signature, User.public_key_rsa, User.public_key_dsa, RoomKey.encrypted_symmetric_key,
+                            Message.signing_keys)\
+        .join(User, User.id == Message.sender_id)\
+        .join(RoomKey, (RoomKey.session_id == Message.session_id) & (RoomKey.epoch == Message.key_epoch))\
+        .filter(Message.id.in_(message_ids)).all()
+    return [tuple(row) for row in rows]
+
+# Returns the IDs of up to limit messages after after_id that the server has not checked yet
+def db_get_unverified_message_ids(after_id: int, limit: int) -> list:
+    rows = db.session.query(Message.id).filter(Message.id > after_id, Message.verified.is_(None))\
+        .order_by(Message.id).limit(limit).all()
+    return [row.id for row in rows]
+
+# Saves signature check results, given as {message_id: verified}, in one transaction
+def db_set_messages_verified(results: dict):
+    if results:
+        db.session.execute(db.update(Message), [{"id": message_id, "verified": verified} for message_id, verified in results.items()])
+        db.session.commit()
+
+# Starts an attachment upload to a chat session
+def db_create_attachment(session_id: int, uploader_id: int, size: int) -> Attachment:
+    attachment = Attachment(session_id=session_id, uploader_id=uploader_id, size=size)
+    db.session.add(attachment)
+    db.session.commit()
+    return attachment
+
+# Returns the attachment with the given ID
+def db_get_attachment(attachment_id: int) -> Attachment:
+    return Attachment.query.get(attachment_id)
+
+# Marks an attachment as fully uploaded, so messages may reference it
+def db_complete_attachment(attachment_id: int):
+    Attachment.query.filter_by(id=attachment_id).update({Attachment.complete: True}, synchronize_session=False)
+    db.session.commit()
+
+# Returns up to limit IDs of uploads started before older_than that never completed
+def db_get_abandoned_attachments(older_than: datetime, limit: int) -> list:
+    rows = db.session.query(Attachment.id).filter(Attachment.complete.is_(False), Attachment.created_at < older_than)\
+        .order_by(Attachment.id).limit(limit).all()
+    return [row.id for row in rows]
+
+# Deletes attachments by ID in one statement
+def db_delete_attachments(attachment_ids: list):
+    Attachment.query.filter(Attachment.id.in_(attachment_ids)).delete(synchronize_session=False)
+    db.session.commit()
+
 # Returns all chat sessions the given user is a part of
 def db_get_user_chat_sessions(user_id: int) -> list:
-    participants = ChatParticipant.query.filter_by(user_id=user_id).all()
-    sessions = []
-    for participant in participants:
-        sessions.append(db_get_chat_session(participant.session_id))
-    return sessions
+    return ChatSession.query.join(ChatParticipant, ChatParticipant.session_id == ChatSession.id)\
+        .filter(ChatParticipant.user_id == user_id).order_by(ChatSession.id).all()
+
+# Returns (ChatSession, ChatParticipant) for every chat session the user is part of, in one query
+# Unread counts come from the two rows' counters: message_count - read_count
+def db_get_user_chat_rooms(user_id: int) -> list:
+    return db.session.query(ChatSession, ChatParticipant)\
+        .join(ChatParticipant, ChatParticipant.session_id == ChatSession.id)\
+        .filter(ChatParticipant.user_id == user_id).order_by(ChatSession.id).all()
 
 # Get all chat sessions
 def db_get_all_chat_sessions():
@@ -220,4 +585,59 @@ def db_get_all_chat_sessions():
 def db_update_chat_session_key(session_id: int, encrypted_symmetric_key: str):
     session = db_get_chat_session(session_id)
     session.encrypted_symmetric_key = encrypted_symmetric_key
+    db.session.commit()
+
+# Returns up to limit chat sessions with an ID greater than after_id, in ID order
+def db_get_chat_sessions_after(after_id: int, limit: int) -> list:
+    return ChatSession.query.filter(ChatSession.id > after_id).order_by(ChatSession.id).limit(limit).all()
+
+# Returns {epoch: encrypted key} for the given epochs of a chat session
+def db_get_room_keys(session_id: int, epochs: list) -> dict:
+    rows = RoomKey.query.filter(RoomKey.session_id == session_id, RoomKey.epoch.in_(epochs)).all()
+    return {row.epoch: row.encrypted_symmetric_key for row in rows}
+
+# Returns every key of the given chat sessions as {(session_id, epoch): encrypted key}
+def db_get_room_keys_for_sessions(session_ids: list) -> dict:
+    rows = RoomKey.query.filter(RoomKey.session_id.in_(session_ids)).all()
+    return {(row.session_id, row.epoch): row.encrypted_symmetric_key for row in rows}
+
+# Starts a new key epoch for each chat session in one transaction
+# Takes a dict of session_id -> new encrypted_symmetric_key and returns session_id -> new epoch
+# If a job is given, its checkpoint is saved in the same commit
+def db_add_room_key_epochs(keys: dict, job: str = None, last_id: int = None) -> dict:
+    epochs = {}
+    for session_id, key in keys.items():
+        epoch = db.session.execute(db.update(ChatSession).where(ChatSession.id == session_id)
+                                   .values(key_epoch=ChatSession.key_epoch + 1, encrypted_symmetric_key=key)
+                                   .returning(ChatSession.key_epoch)).scalar_one()
+        db.session.add(RoomKey(session_id=session_id, epoch=epoch, encrypted_symmetric_key=key))
+        epochs[session_id] = epoch
+    if job is not None:
+        db.session.merge(RotationCheckpoint(job=job, last_id=last_id))
+    db.session.commit()
+    return epochs
+
+# Replaces existing room keys (e.g. re-encrypted under a new master key) in one transaction
+# Takes a dict of (session_id, epoch) -> encrypted key; each chat session's current key follows its epoch's new value
+# If a job is given, its checkpoint is saved in the same commit
+def db_update_room_keys(keys: dict, job: str = None, last_id: int = None):
+    if keys:
+        db.session.execute(db.update(RoomKey), [{"session_id": session_id, "epoch": epoch, "encrypted_symmetric_key": key}
+                                                for (session_id, epoch), key in keys.items()])
+        current_key = db.select(RoomKey.encrypted_symmetric_key)\
+            .where(RoomKey.session_id == ChatSession.id, RoomKey.epoch == ChatSession.key_epoch).scalar_subquery()
+        db.session.execute(db.update(ChatSession).where(ChatSession.id.in_({session_id for session_id, _ in keys}))
+                           .values(encrypted_symmetric_key=current_key))
+    if job is not None:
+        db.session.merge(RotationCheckpoint(job=job, last_id=last_id))
+    db.session.commit()
+
+# Returns the last ID a maintenance job committed, or None if it has no checkpoint
+def db_get_checkpoint(job: str):
+    checkpoint = RotationCheckpoint.query.get(job)
+    return checkpoint.last_id if checkpoint else None
+
+# Removes a maintenance job's checkpoint once it has finished
+def db_clear_checkpoint(job: str):
+    RotationCheckpoint.query.filter_by(job=job).delete()
     db.session.commit()
\ No newline at end of file
@@ -0,0 +1,76 @@
+"""
+Group commit for chat messages
+- Collects messages from many handlers and writes them in one transaction (one fsync per batch)
+- A batch is written when it reaches max_batch rows or its oldest message has waited max_delay seconds
+- Callers block until their batch is durable, so nothing is broadcast before it is stored
+- Messages are written in submission order, so per-room ordering and ID order are preserved
+"""
+
+from collections import deque
+import threading
+import time
+
+class GroupCommitQueue:
+    # write_batch takes a list of items and returns one result per item, in order
+    # create_event and sleep must match the server's async mode (e.g. socketio.server.eio.create_event, socketio.sleep)
+    def __init__(self, write_batch, max_batch: int = 64, max_delay: float = 0.005,
+                 create_event=threading.Event, sleep=time.sleep):
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.create_event = create_event
+        self.sleep = sleep
+        self._pending = deque()
+        self._wakeup = create_event()
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+
+    # Queues an item and waits until it has been committed
+    # Returns the write_batch result for the item, or raises the error that failed its batch
+    def submit(self, item):
+        entry = {"item": item, "done": self.create_event(), "result": None, "error": None, "queued_at": time.perf_counter()}
+        self._pending.append(entry)
+        self._wakeup.set()
+        entry["done"].wait()
+        if entry["error"] is not None:
+            raise entry["error"]
+        return entry["result"]
+
+    # Writes batches until the process exits; run as a background task
+    # context is a callable returning a context manager wrapped around each write, e.g. app.app_context
+    def run_forever(self, context):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while self._pending:
+                # Give other handlers a chance to join the batch
+                deadline = self._pending[0]["queued_at"] + self.max_delay
+                while len(self._pending) < self.max_batch and time.perf_counter() < deadline:
+                    self.sleep(min(0.001, self.max_delay))
+                batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+                self._write(batch, context)
+
+    def _write(self, batch: list, context):
+        try:
+            with context():
+                results = self.write_batch([entry["item"] for entry in batch])
+            for entry, result in zip(batch, results):
+                entry["result"] = result
+        except Exception as e:
+            for entry in batch:
+                entry["error"] = e
+        self.batches += 1
+        self.items += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for entry in batch:
+            entry["done"].set()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "items": self.items,
+            "largest_batch": self.largest_batch,
+            "average_batch": (self.items / self.batches) if self.batches else 0.0,
+        }
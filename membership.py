@@ -0,0 +1,60 @@
+"""
+In-memory index of chat room membership
+- Loaded from chat_participants on first use and updated whenever a participant is added or removed
+- Answers "is user U in room R" without a database query, so every room-scoped event can be checked
+- Only correct for a single worker: other workers' changes never reach it, so with a message queue
+  the app checks the database instead
+"""
+
+import threading
+
+# {room_id: set of user_ids} from (room_id, user_id) pairs
+def group_members(pairs) -> dict:
+    members = {}
+    for room_id, user_id in pairs:
+        members.setdefault(room_id, set()).add(user_id)
+    return members
+
+class MembershipIndex:
+    def __init__(self):
+        self._members = {} # room_id -> set of user_ids
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    # Replaces the index with the given (room_id, user_id) pairs
+    def load(self, pairs):
+        members = group_members(pairs)
+        with self._lock:
+            self._members = members
+            self.loaded = True
+
+    # Loads the index from loader(), which returns (room_id, user_id) pairs, unless it is already loaded
+    # Holds the lock while loader runs, so an add or remove committed meanwhile is applied after the load, not lost
+    def ensure_loaded(self, loader):
+        with self._lock:
+            if not self.loaded:
+                self._members = group_members(loader())
+                self.loaded = True
+
+    # IDs may come straight from a client as strings; is_member is asked with ints, so they are stored as ints
+    def add(self, room_id: int, user_id: int):
+        with self._lock:
+            self._members.setdefault(int(room_id), set()).add(int(user_id))
+
+    def remove(self, room_id: int, user_id: int):
+        room_id, user_id = int(room_id), int(user_id)
+        with self._lock:
+            users = self._members.get(room_id)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self._members[room_id]
+
+    def is_member(self, room_id: int, user_id: int) -> bool:
+        users = self._members.get(room_id)
+        return users is not None and user_id in users
+
+    # Sizes for /metrics
+    def stats(self) -> dict:
+        with self._lock:
+            return {"rooms": len(self._members), "memberships": sum(len(users) for users in self._members.values())}
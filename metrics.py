@@ -0,0 +1,274 @@
+"""
+Per-handler metrics in Prometheus text format
+- Call counts, errors and latency histograms for every Socket.IO event handler and Flask route
+- SQL statements and SQL time spent inside each handler
+- Number of emits and payload bytes each handler sends (structured payloads are sampled, see EMIT_SIZE_SAMPLE)
+- Gauges from other components (key caches, worker pools, presence) via collectors
+- On-demand cProfile sampling of a handler's next N calls
+- Optionally hands every handled socket event to a TrafficRecorder (recorder.py)
+"""
+
+from flask import request, session, g
+from flask_socketio import SocketIO
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from contextvars import ContextVar
+from functools import wraps
+import cProfile
+import inspect
+import io
+import json
+import pstats
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+EMIT_SIZE_SAMPLE = 16 # One in this many dict/list payloads is serialized to measure it, and counted this many times
+
+# Accumulates SQL and emit costs for the handler call running in this thread/greenlet
+_current_call = ContextVar('metrics_current_call', default=None)
+
+class CallCosts:
+    def __init__(self):
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.emits = 0
+        self.emit_bytes = 0
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_call.get() is not None:
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    costs = _current_call.get()
+    starts = conn.info.get('metrics_query_start')
+    if costs is not None and starts:
+        costs.sql_statements += 1
+        costs.sql_seconds += time.perf_counter() - starts.pop()
+
+class HandlerMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.emits = 0
+        self.emit_bytes = 0
+
+class MetricsRegistry:
+    def __init__(self, prefix: str = 'securechat'):
+        self.prefix = prefix
+        self.handlers = {} # (kind, name) -> HandlerMetrics
+        self.collectors = [] # (metric name, label name, callable returning {label value: {stat: number}})
+        self.profile_remaining = {} # handler name -> calls left to profile
+        self.profiles = {} # handler name -> pstats.Stats
+        self._structured_emits = 0
+        self._lock = threading.Lock()
+
+    # Registers a source of gauges, e.g. add_collector('key_cache', 'cache', key_cache_stats)
+    def add_collector(self, name: str, label: str, fn):
+        self.collectors.append((name, label, fn))
+
+    # Starts tracking one handler call; returns a token for finish_call
+    def start_call(self):
+        costs = CallCosts()
+        return costs, _current_call.set(costs), time.perf_counter()
+
+    # Records a finished handler call
+    def finish_call(self, kind: str, name: str, token, failed: bool = False):
+        costs, reset_token, start = token
+        elapsed = time.perf_counter() - start
+        _current_call.reset(reset_token)
+        with self._lock:
+            metrics = self.handlers.get((kind, name))
+            if metrics is None:
+                metrics = self.handlers[(kind, name)] = HandlerMetrics()
+            metrics.calls += 1
+            metrics.errors += 1 if failed else 0
+            metrics.latency_sum += elapsed
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    metrics.buckets[i] += 1
+            metrics.sql_statements += costs.sql_statements
+            metrics.sql_seconds += costs.sql_seconds
+            metrics.emits += costs.emits
+            metrics.emit_bytes += costs.emit_bytes
+
+    # Counts an emit against the handler currently running, if any
+    # Strings and bytes (msgpack replies) are measured exactly; serializing every dict just to measure it would double
+    # the cost of fan-out, so only a sample of them is serialized and scaled up
+    def record_emit(self, data):
+        costs = _current_call.get()
+        if costs is None:
+            return
+        costs.emits += 1
+        if data is None:
+            return
+        if isinstance(data, (str, bytes, bytearray)):
+            costs.emit_bytes += len(data)
+            return
+        self._structured_emits += 1 # Unlocked; a lost increment only shifts the sample
+        if self._structured_emits % EMIT_SIZE_SAMPLE:
+            return
+        try:
+            costs.emit_bytes += EMIT_SIZE_SAMPLE * len(json.dumps(data, separators=(',', ':')))
+        except (TypeError, ValueError):
+            pass
+
+    # Returns a started profiler if profiling was requested for this handler, otherwise None
+    def _start_profiler(self, name: str):
+        with self._lock:
+            remaining = self.profile_remaining.get(name, 0)
+            if remaining <= 0:
+                return None
+            self.profile_remaining[name] = remaining - 1
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _store_profile(self, name: str, profiler):
+        profiler.disable()
+        with self._lock:
+            if name in self.profiles:
+                self.profiles[name].add(profiler)
+            else:
+                self.profiles[name] = pstats.Stats(profiler)
+
+    # Runs fn, under cProfile if profiling was requested for this handler
+    # Under eventlet the profile also includes other greenlets that run during the call
+    def call(self, name: str, fn, *args):
+        profiler = self._start_profiler(name)
+        if profiler is None:
+            return fn(*args)
+        try:
+            return fn(*args)
+        finally:
+            self._store_profile(name, profiler)
+
+    # Profiles the handler's next calls; previous results for it are discarded
+    def start_profile(self, name: str, calls: int):
+        with self._lock:
+            self.profile_remaining[name] = calls
+            self.profiles.pop(name, None)
+
+    # Returns the collected profile as text, sorted by cumulative time
+    def profile_report(self, name: str, limit: int = 40) -> str:
+        with self._lock:
+            stats = self.profiles.get(name)
+            remaining = self.profile_remaining.get(name, 0)
+            if stats is None:
+                return f"No profile for {name} ({remaining} calls still to profile)\n"
+            out = io.StringIO()
+            stats.stream = out
+            stats.sort_stats('cumulative').print_stats(limit)
+        return f"{remaining} calls still to profile\n" + out.getvalue()
+
+    # Renders every metric in Prometheus text exposition format
+    def render(self) -> str:
+        p = self.prefix
+        lines = []
+        def header(name, kind, text):
+            lines.append(f"# HELP {p}_{name} {text}")
+            lines.append(f"# TYPE {p}_{name} {kind}")
+
+        with self._lock:
+            handlers = sorted(self.handlers.items())
+            counters = (
+                ('handler_calls_total', 'Handler calls', lambda m: m.calls),
+                ('handler_errors_total', 'Handler calls that raised', lambda m: m.errors),
+                ('handler_sql_statements_total', 'SQL statements executed by the handler', lambda m: m.sql_statements),
+                ('handler_sql_seconds_total', 'Time spent in SQL by the handler', lambda m: m.sql_seconds),
+                ('handler_emits_total', 'Socket.IO emits sent by the handler', lambda m: m.emits),
+                ('handler_emit_bytes_total', 'Payload bytes sent by the handler (Socket.IO emits, sampled, or HTTP response body)', lambda m: m.emit_bytes),
+            )
+            for name, text, value in counters:
+                header(name, 'counter', text)
+                for (kind, handler), metrics in handlers:
+                    lines.append(f'{p}_{name}{{kind="{kind}",handler="{handler}"}} {value(metrics)}')
+            header('handler_latency_seconds', 'histogram', 'Handler latency')
+            for (kind, handler), metrics in handlers:
+                labels = f'kind="{kind}",handler="{handler}"'
+                for bound, count in zip(LATENCY_BUCKETS, metrics.buckets):
+                    lines.append(f'{p}_handler_latency_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{p}_handler_latency_seconds_bucket{{{labels},le="+Inf"}} {metrics.calls}')
+                lines.append(f'{p}_handler_latency_seconds_sum{{{labels}}} {metrics.latency_sum}')
+                lines.append(f'{p}_handler_latency_seconds_count{{{labels}}} {metrics.calls}')
+
+        for name, label, fn in self.collectors:
+            values = {}
+            for label_value, stats in (fn() or {}).items():
+                for stat, value in (stats or {}).items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        values.setdefault(stat, []).append((label_value, value))
+            for stat, samples in sorted(values.items()):
+                lines.append(f"# TYPE {p}_{name}_{stat} gauge")
+                for label_value, value in samples:
+                    lines.append(f'{p}_{name}_{stat}{{{label}="{label_value}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    # Records every Flask request by endpoint
+    def init_app(self, app):
+        @app.before_request
+        def _metrics_before_request():
+            g.metrics_token = self.start_call()
+            g.metrics_profiler = self._start_profiler(request.endpoint or 'unmatched')
+
+        @app.teardown_request
+        def _metrics_teardown_request(exc):
+            name = request.endpoint or 'unmatched'
+            profiler = g.pop('metrics_profiler', None)
+            if profiler is not None:
+                self._store_profile(name, profiler)
+            token = g.pop('metrics_token', None)
+            if token is not None:
+                self.finish_call('http', name, token, failed=exc is not None)
+
+        @app.after_request
+        def _metrics_after_request(response):
+            costs = _current_call.get()
+            if costs is not None and not response.is_streamed:
+                costs.emit_bytes += response.calculate_content_length() or 0
+            return response
+
+# SocketIO that records metrics for every event handler and emit
+# recorder, when set, also gets every handled event for the traffic trace
+class InstrumentedSocketIO(SocketIO):
+    def __init__(self, app=None, metrics: MetricsRegistry = None, recorder=None, **kwargs):
+        self.metrics = metrics
+        self.recorder = recorder
+        super().__init__(app, **kwargs)
+
+    def on(self, message, namespace=None):
+        register = super().on(message, namespace=namespace)
+        def decorator(handler):
+            # Flask-SocketIO may pass more arguments than the handler takes (e.g. auth on connect)
+            parameters = inspect.signature(handler).parameters.values()
+            if any(p.kind == p.VAR_POSITIONAL for p in parameters):
+                max_args = None
+            else:
+                max_args = sum(1 for p in parameters if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD))
+            @wraps(handler)
+            def instrumented(*args):
+                if self.metrics is None:
+                    return handler(*args)
+                token = self.metrics.start_call()
+                failed = True
+                try:
+                    result = self.metrics.call(message, handler, *args[:max_args])
+                    failed = False
+                    return result
+                finally:
+                    self.metrics.finish_call('socketio', message, token, failed=failed)
+                    if self.recorder is not None:
+                        self.recorder.record(message, request.sid, session.get('user_id'), args[0] if args else None, token[2])
+            return register(instrumented)
+        return decorator
+
+    def emit(self, event, *args, **kwargs):
+        if self.metrics is not None:
+            self.metrics.record_emit(args[0] if args else None)
+        return super().emit(event, *args, **kwargs)
@@ -1,38 +1,358 @@
 '''
 This file contains functions that are used to 
-recalculate password hashes and encrypted symmetric keys for all users and chat sessions in the database.
-Use these functions whenever the pepper or master key is changed.
+recalculate the encrypted symmetric keys for all chat sessions in the database.
+Use these functions whenever the master key is changed.
 Master keys should be regularly rotated for security purposes.
+Password hashes cannot be moved to a new pepper: that needs every user's plaintext password,
+so changing PEPPER makes every existing password fail to log in.
 
+Room key rotation streams chat sessions in chunks, runs the crypto on a worker pool,
+commits each chunk together with a checkpoint and resumes from that checkpoint after a crash.
+Room keys are versioned by epoch: regenerating adds one epoch per room and leaves history readable,
+rewrapping re-encrypts every epoch's key under the new master key.
+
+Message archival moves old messages out of the messages table into compressed per-room segments (archive.py).
+Each run only moves messages that crossed the retention limits since the last run.
+
+Attachment pruning deletes uploads that were started but never completed, with their partial files.
+
+Signature verification checks the messages the server has not checked yet (verification.py), e.g. history from
+before SIGNATURE_VERIFICATION was enabled or messages the server dropped while its signature pool was full.
+
+Export and import stream the whole database as JSON lines (backup.py), table by table, in constant memory,
+for backups and for moving a server to another host.
+
+Every task is a Flask CLI command, registered on the app by create_app, and reads its settings from app.config.
+Schema changes are applied by the migrate command only; servers refuse to start on an outdated schema.
+
+Usage (python ops.py <command> works the same as flask --app app <command>):
+    flask --app app migrate [--check]
+    flask --app app rotate-room-keys [--rewrap] [--chunk-size 500] [--workers 4] [--pool thread|process] [--dry-run] [--restart]
+    flask --app app archive-messages [--max-age-days 90] [--keep 1000] [--segment-size 1000] [--dry-run]
+    flask --app app prune-attachments [--max-age-hours 24] [--dry-run]
+    flask --app app verify-signatures [--chunk-size 500] [--workers 4] [--pool thread|process]
+    flask --app app export <file.jsonl[.gz] or -> [--window 1000]
+    flask --app app import <file.jsonl[.gz]> [--batch-size 5000]
+    flask --app app purge --yes
+    flask --app app reset-presence
 '''
-from app import app, db
-from database import db_get_all_users, db_update_public_key, db_get_all_chat_sessions, db_update_chat_session_key
-from crypto import hash_password, encrypt_AES, generate_symmetric_key
-import os
-import base64
-
-# Load environment variables
-from dotenv import load_dotenv
-load_dotenv()
-PEPPER = base64.b64decode(os.getenv('PEPPER'))
-MASTER_KEY = base64.b64decode(os.getenv('MASTER_KEY'))
-
-def recalculate_password_hashes():
-    users = db_get_all_users()
-    for user in users:
-        new_hash = hash_password(user.password_hash, PEPPER)
-        user.password_hash = new_hash
-        print(f"Updated password hash for user {user.username}")
+from database import db, db_get_chat_sessions_after, db_get_checkpoint, db_clear_checkpoint
+from database import db_get_room_keys_for_sessions, db_add_room_key_epochs, db_update_room_keys
+from database import db_get_archive_boundary, db_get_messages_through, db_count_messages_through, db_delete_messages
+from database import db_get_abandoned_attachments, db_delete_attachments, db_migrate, db_pending_migrations
+from database import db_get_unverified_message_ids, db_get_messages_to_verify, db_set_messages_verified
+from database import db_reset_online_statuses
+from crypto import encrypt_AES, decrypt_AES, generate_symmetric_key, invalidate_room_keys
+from archive import MessageArchive
+from attachments import AttachmentStore
+from verification import verification_item, verify_messages, signed_with_current_keys
+from backup import export_chunks, gzip_chunks, open_export, import_lines, EXPORT_WINDOW, IMPORT_BATCH
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import with_appcontext
+import click
+import shutil
+import sys
+import time
 
+# Starts a new key epoch for every chat session
 def recalculate_encrypted_symmetric_keys():
-    sessions = db_get_all_chat_sessions()
-    for session in sessions:
-        new_key = generate_symmetric_key()
-        encrypted_key = encrypt_AES(new_key, MASTER_KEY)
-        db_update_chat_session_key(session.id, encrypted_key.decode())
-        print(f"Updated encrypted symmetric key for chat session {session.name}")
-
-def purge_database():
-    with app.app_context():
-        db.drop_all()
-purge_database()
\ No newline at end of file
+    rotate_room_keys(rewrap=False)
+
+# Encrypts a brand-new room key with the master key
+def regenerate_room_key(encrypted_key: str, master_key: bytes) -> str:
+    return encrypt_AES(generate_symmetric_key(), master_key).decode()
+
+# Re-encrypts an existing room key from the old master key to the new one
+# Keys already under the new master key (e.g. from a chunk committed before a crash) are returned unchanged
+def rewrap_room_key(encrypted_key: str, old_master_key: bytes, master_key: bytes) -> str:
+    try:
+        room_key = decrypt_AES(encrypted_key, old_master_key)
+    except ValueError:
+        decrypt_AES(encrypted_key, master_key)
+        return encrypted_key
+    return encrypt_AES(room_key, master_key).decode()
+
+# Rotates every chat session's key in chunks
+# rewrap=True keeps the room keys and moves every epoch's key from OLD_MASTER_KEY to MASTER_KEY,
+# rewrap=False starts a new key epoch for each room; older messages stay readable with their epoch's key
+# Both cost one chunk of crypto per chunk of rooms, independent of the number of messages
+# Must be called inside an app context; returns the number of sessions processed
+def rotate_room_keys(rewrap: bool = False, chunk_size: int = 500, workers: int = 4, pool: str = 'thread',
+                     dry_run: bool = False, restart: bool = False) -> int:
+    master_key = current_app.config['MASTER_KEY']
+    old_master_key = current_app.config['OLD_MASTER_KEY']
+    if rewrap and old_master_key is None:
+        raise ValueError("OLD_MASTER_KEY must be set to rewrap room keys")
+    job = 'rotate-room-keys:rewrap' if rewrap else 'rotate-room-keys:regenerate'
+    checkpoint = None if restart else db_get_checkpoint(job)
+    last_id = checkpoint or 0
+    if checkpoint:
+        print(f"Resuming {job} after chat session {checkpoint}")
+
+    executor_class = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+    processed = 0
+    start = time.perf_counter()
+    with executor_class(max_workers=workers) as executor:
+        while True:
+            sessions = db_get_chat_sessions_after(last_id, chunk_size)
+            if not sessions:
+                break
+            ids = [session.id for session in sessions]
+            old_keys = [session.encrypted_symmetric_key for session in sessions]
+            db.session.expunge_all()
+            last_id = ids[-1]
+            if rewrap:
+                epoch_keys = db_get_room_keys_for_sessions(ids)
+                db.session.expunge_all()
+                old_epoch_keys = list(epoch_keys.values())
+                new_keys = list(executor.map(rewrap_room_key, old_epoch_keys,
+                                             [old_master_key] * len(old_epoch_keys), [master_key] * len(old_epoch_keys)))
+                if not dry_run:
+                    db_update_room_keys(dict(zip(epoch_keys, new_keys)), job=job, last_id=last_id)
+            else:
+                new_keys = list(executor.map(regenerate_room_key, old_keys, [master_key] * len(ids)))
+                if not dry_run:
+                    db_add_room_key_epochs(dict(zip(ids, new_keys)), job=job, last_id=last_id)
+            if not dry_run:
+                for session_id in ids:
+                    invalidate_room_keys(session_id)
+            processed += len(ids)
+            elapsed = time.perf_counter() - start
+            print(f"{'Checked' if dry_run else 'Rotated'} {processed} chat sessions up to ID {last_id} ({processed / elapsed:.0f}/s)")
+    if not dry_run:
+        db_clear_checkpoint(job)
+    elapsed = time.perf_counter() - start
+    print(f"{'Dry run: ' if dry_run else ''}{processed} chat sessions in {elapsed:.2f}s ({processed / elapsed if elapsed else 0:.0f}/s)")
+    return processed
+
+# Moves every chat session's messages older than max_age_days, or beyond the newest keep, to the archive
+# Rows are deleted only after their segment is on disk; rows already archived by an interrupted run are just deleted
+# Must be called inside an app context; returns the number of messages archived
+def archive_messages(archive, max_age_days: int = None, keep: int = None, segment_size: int = 1000,
+                     chunk_size: int = 500, dry_run: bool = False) -> int:
+    if max_age_days is None and keep is None:
+        raise ValueError("Set a maximum age or a number of messages to keep")
+    older_than = datetime.now() - timedelta(days=max_age_days) if max_age_days is not None else None
+    archived = 0
+    last_id = 0
+    start = time.perf_counter()
+    while True:
+        sessions = db_get_chat_sessions_after(last_id, chunk_size)
+        if not sessions:
+            break
+        ids = [session.id for session in sessions]
+        db.session.expunge_all()
+        last_id = ids[-1]
+        for session_id in ids:
+            boundary = db_get_archive_boundary(session_id, older_than, keep)
+            if boundary is None:
+                continue
+            if dry_run:
+                archived += db_count_messages_through(session_id, boundary)
+                continue
+            last_archived = archive.last_archived_id(session_id)
+            while True:
+                messages = db_get_messages_through(session_id, boundary, segment_size)
+                if not messages:
+                    break
+                new_messages = [msg for msg in messages if msg.id > last_archived]
+                archive.append(session_id, new_messages)
+                if new_messages:
+                    last_archived = new_messages[-1].id
+                message_ids = [msg.id for msg in messages]
+                db.session.expunge_all()
+                db_delete_messages(message_ids)
+                archived += len(new_messages)
+        elapsed = time.perf_counter() - start
+        print(f"{'Checked' if dry_run else 'Archived'} {archived} messages from chat sessions up to ID {last_id} ({archived / elapsed:.0f}/s)")
+    elapsed = time.perf_counter() - start
+    print(f"{'Dry run: ' if dry_run else ''}{archived} messages {'to archive' if dry_run else 'archived'} in {elapsed:.2f}s")
+    return archived
+
+# Deletes uploads started more than max_age_hours ago that never completed
+# Files are removed before their rows, so an interrupted run leaves nothing unreferenced on disk
+# Must be called inside an app context; returns the number of uploads deleted
+def prune_attachments(store, max_age_hours: float = 24, chunk_size: int = 500, dry_run: bool = False) -> int:
+    older_than = datetime.now() - timedelta(hours=max_age_hours)
+    pruned = 0
+    while True:
+        attachment_ids = db_get_abandoned_attachments(older_than, chunk_size)
+        if not attachment_ids or dry_run:
+            pruned += len(attachment_ids)
+            break
+        for attachment_id in attachment_ids:
+            store.remove(attachment_id)
+        db_delete_attachments(attachment_ids)
+        pruned += len(attachment_ids)
+    print(f"{'Dry run: ' if dry_run else ''}{pruned} abandoned uploads {'to delete' if dry_run else 'deleted'}")
+    return pruned
+
+# Checks the signatures of every message the server has not checked yet, in chunks of messages
+# Messages signed with keys their sender has since replaced (every login brings new keys) stay unchecked
+# Each chunk is split across the workers, so process workers keep their parsed public keys between chunks
+# Must be called inside an app context; returns the number of messages checked
+def verify_signatures(chunk_size: int = 500, workers: int = 4, pool: str = 'thread') -> int:
+    master_key = current_app.config['MASTER_KEY']
+    executor_class = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+    checked = valid = unchecked = 0
+    last_id = 0
+    start = time.perf_counter()
+    with executor_class(max_workers=workers) as executor:
+        while True:
+            message_ids = db_get_unverified_message_ids(last_id, chunk_size)
+            if not message_ids:
+                break
+            last_id = message_ids[-1]
+            rows = [row for row in db_get_messages_to_verify(message_ids) if signed_with_current_keys(row)]
+            items = [verification_item(row, master_key) for row in rows]
+            parts = [items[i::workers] for i in range(workers)]
+            results = {}
+            for i, verified in enumerate(executor.map(verify_messages, parts)):
+                results.update({row[0]: result for row, result in zip(rows[i::workers], verified)})
+            db_set_messages_verified(results)
+            checked += len(results)
+            unchecked += len(message_ids) - len(results)
+            valid += sum(1 for result in results.values() if result)
+            elapsed = time.perf_counter() - start
+            print(f"Checked {checked} messages up to ID {last_id} ({checked / elapsed:.0f}/s)")
+    elapsed = time.perf_counter() - start
+    print(f"{checked} messages checked in {elapsed:.2f}s: {valid} verified, {checked - valid} with an invalid signature")
+    if unchecked:
+        print(f"{unchecked} messages left unchecked: signed with keys their senders have since replaced")
+    return checked
+
+# Drops every table, and the message archive and attachments, whose IDs would clash with new ones
+def purge_database(archive=None, attachments=None):
+    db.drop_all()
+    for store in (archive, attachments):
+        if store is not None:
+            shutil.rmtree(store.directory, ignore_errors=True)
+
+## Commands ##
+@click.command('migrate')
+@click.option('--check', is_flag=True, help='list pending schema changes and exit non-zero if there are any')
+@with_appcontext
+def migrate_command(check):
+    """Create missing tables and bring an older database's schema up to date."""
+    if check:
+        pending = db_pending_migrations()
+        for description in pending:
+            click.echo(f"Pending: {description}")
+        if pending:
+            raise SystemExit(1)
+        click.echo("Schema is up to date")
+        return
+    applied = db_migrate()
+    for description in applied:
+        click.echo(f"Applied: {description}")
+    click.echo(f"{len(applied)} schema changes applied" if applied else "Schema is up to date")
+
+@click.command('rotate-room-keys')
+@click.option('--rewrap', is_flag=True, help='keep room keys, move them from OLD_MASTER_KEY to MASTER_KEY')
+@click.option('--chunk-size', type=int, default=500)
+@click.option('--workers', type=int, default=4)
+@click.option('--pool', type=click.Choice(['thread', 'process']), default='thread')
+@click.option('--dry-run', is_flag=True, help='do the crypto but write nothing')
+@click.option('--restart', is_flag=True, help='ignore any saved checkpoint')
+@with_appcontext
+def rotate_room_keys_command(rewrap, chunk_size, workers, pool, dry_run, restart):
+    """Re-encrypt or regenerate every chat session key."""
+    rotate_room_keys(rewrap=rewrap, chunk_size=chunk_size, workers=workers, pool=pool, dry_run=dry_run, restart=restart)
+
+@click.command('archive-messages')
+@click.option('--max-age-days', type=int, help='archive messages older than this (default MESSAGE_RETENTION_DAYS)')
+@click.option('--keep', type=int, help='archive all but the newest KEEP messages of each room (default MESSAGE_RETENTION_COUNT)')
+@click.option('--segment-size', type=int, default=1000, help='messages per archive segment')
+@click.option('--chunk-size', type=int, default=500, help='chat sessions loaded at a time')
+@click.option('--dry-run', is_flag=True, help='count the messages that would be archived')
+@with_appcontext
+def archive_messages_command(max_age_days, keep, segment_size, chunk_size, dry_run):
+    """Move old messages to compressed per-room archive segments."""
+    if max_age_days is None:
+        max_age_days = current_app.config['MESSAGE_RETENTION_DAYS']
+    if keep is None:
+        keep = current_app.config['MESSAGE_RETENTION_COUNT']
+    if max_age_days is None and keep is None:
+        raise click.UsageError("archive-messages needs --max-age-days or --keep (or MESSAGE_RETENTION_DAYS / MESSAGE_RETENTION_COUNT)")
+    archive_messages(MessageArchive(current_app.config['ARCHIVE_DIR']), max_age_days=max_age_days, keep=keep,
+                     segment_size=segment_size, chunk_size=chunk_size, dry_run=dry_run)
+
+@click.command('prune-attachments')
+@click.option('--max-age-hours', type=float, default=24, help='only delete uploads started longer ago than this')
+@click.option('--dry-run', is_flag=True, help='count the uploads that would be deleted')
+@with_appcontext
+def prune_attachments_command(max_age_hours, dry_run):
+    """Delete uploads that were never completed."""
+    prune_attachments(AttachmentStore(current_app.config['ATTACHMENT_DIR']), max_age_hours=max_age_hours, dry_run=dry_run)
+
+@click.command('verify-signatures')
+@click.option('--chunk-size', type=int, default=500, help='messages loaded at a time')
+@click.option('--workers', type=int, default=4)
+@click.option('--pool', type=click.Choice(['thread', 'process']), default='thread')
+@with_appcontext
+def verify_signatures_command(chunk_size, workers, pool):
+    """Check the signatures of messages the server has not checked yet."""
+    verify_signatures(chunk_size=chunk_size, workers=workers, pool=pool)
+
+@click.command('export')
+@click.argument('path')
+@click.option('--window', type=int, default=EXPORT_WINDOW, help='rows read per query')
+@with_appcontext
+def export_command(path, window):
+    """Write the whole database to PATH as JSON lines (gzip compressed if PATH ends in .gz, - for stdout)."""
+    start = time.perf_counter()
+    chunks = export_chunks(db.engine, window=window)
+    if path == '-':
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+        return
+    written = 0
+    with open(path, 'wb') as f:
+        for data in gzip_chunks(chunks) if path.endswith('.gz') else (chunk.encode('utf-8') for chunk in chunks):
+            f.write(data)
+            written += len(data)
+    click.echo(f"Exported {written / 1e6:.1f} MB to {path} in {time.perf_counter() - start:.2f}s")
+
+@click.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', type=int, default=IMPORT_BATCH, help='rows inserted per transaction')
+@with_appcontext
+def import_command(path, batch_size):
+    """Load an export into this (freshly migrated, empty) database. After a failed import, purge and migrate before retrying."""
+    start = time.perf_counter()
+    try:
+        with open_export(path) as f:
+            counts = import_lines(db.engine, f, batch_size=batch_size)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for table, count in counts.items():
+        click.echo(f"{table}: {count} rows")
+    click.echo(f"Imported {sum(counts.values())} rows in {time.perf_counter() - start:.2f}s")
+
+@click.command('purge')
+@click.confirmation_option(prompt='Drop every table, the message archive and attachments?')
+@with_appcontext
+def purge_command():
+    """Drop every table, the message archive and attachments."""
+    purge_database(MessageArchive(current_app.config['ARCHIVE_DIR']), AttachmentStore(current_app.config['ATTACHMENT_DIR']))
+    click.echo("Dropped all tables")
+
+@click.command('reset-presence')
+@with_appcontext
+def reset_presence_command():
+    """Mark every user offline, e.g. after a worker crashed with users online. Run with every worker stopped."""
+    db_reset_online_statuses()
+    click.echo("Marked every user offline")
+
+# Adds the maintenance commands to the app's flask CLI
+def register_commands(app):
+    for command in (migrate_command, rotate_room_keys_command, archive_messages_command, prune_attachments_command,
+                    verify_signatures_command, export_command, import_command, purge_command, reset_presence_command):
+        app.cli.add_command(command)
+
+if __name__ == '__main__':
+    from flask.cli import FlaskGroup
+    from app import create_app
+    FlaskGroup(create_app=create_app, help='Maintenance tasks for the secure chat database')()
@@ -0,0 +1,86 @@
+"""
+In-memory presence tracking
+- Tracks each user's live sockets so a user with several tabs stays online until the last one closes
+  (and so all of them can be taken out of a room the user is removed from)
+- Buffers online/offline changes and writes them to the database in periodic batches, as a count of the workers
+  each user has a live socket on, so with several workers every worker reads the same online status
+"""
+
+from database import db_add_online_workers
+import threading
+
+class PresenceRegistry:
+    def __init__(self):
+        self._sockets = {} # user_id -> set of live socket IDs on this worker
+        self._pending = {} # user_id -> is_online, not yet written to the database
+        self._counted = set() # users this worker has added to users.online_workers
+        self._lock = threading.Lock()
+
+    # Registers a new socket for the user
+    # Returns True if the user just came online
+    def connect(self, user_id: int, sid: str) -> bool:
+        with self._lock:
+            sids = self._sockets.setdefault(user_id, set())
+            sids.add(sid)
+            if len(sids) == 1:
+                self._pending[user_id] = True
+                return True
+            return False
+
+    # Unregisters one of the user's sockets
+    # Returns True if that was their last socket and the user just went offline
+    def disconnect(self, user_id: int, sid: str) -> bool:
+        with self._lock:
+            sids = self._sockets.get(user_id)
+            if sids is None or sid not in sids:
+                return False
+            sids.discard(sid)
+            if sids:
+                return False
+            del self._sockets[user_id]
+            self._pending[user_id] = False
+            return True
+
+    # Marks every user with a socket on this worker offline, for a worker that is shutting down
+    # The next flush takes them off users.online_workers
+    def release(self):
+        with self._lock:
+            for user_id in self._counted | set(self._sockets):
+                self._pending[user_id] = False
+            self._sockets.clear()
+
+    # The user's live socket IDs on this worker
+    def sockets(self, user_id: int) -> list:
+        with self._lock:
+            return list(self._sockets.get(user_id, ()))
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self._sockets
+
+    def online_count(self) -> int:
+        return len(self._sockets)
+
+    # Writes buffered status changes to the database in one transaction
+    # A user who came online and went offline again between flushes is not written at all
+    # Must be called inside an app context
+    def flush(self) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        deltas = {user_id: 1 if is_online else -1 for user_id, is_online in pending.items()
+                  if is_online != (user_id in self._counted)}
+        if not deltas:
+            return 0
+        try:
+            db_add_online_workers(deltas)
+        except Exception:
+            # Keep the changes for the next flush unless a newer change replaced them
+            with self._lock:
+                for user_id, is_online in pending.items():
+                    self._pending.setdefault(user_id, is_online)
+            raise
+        for user_id, delta in deltas.items():
+            if delta > 0:
+                self._counted.add(user_id)
+            else:
+                self._counted.discard(user_id)
+        return len(deltas)
@@ -0,0 +1,135 @@
+"""
+Opt-in recorder of socket traffic, replayed against a scratch server by benchmarks/replay.py
+- Enabled by TRAFFIC_TRACE_DIR; each worker process writes its own gzip compressed JSON lines file there
+- A header line, then one array per handled event: milliseconds since the trace started, connection, event name,
+  user, room, payload size in bytes, milliseconds spent in the handler, and the user the event acts on (if another one)
+- Anonymized: connections, users and rooms are numbered in order of first appearance, so a trace keeps who did what
+  where without real IDs; payloads are only measured, never written (no ciphertext, signatures, names or keys)
+- Lines are buffered and written in blocks, each flushed so a trace cut off by a crash is readable up to its last block;
+  a background task writes them at least every flush_interval seconds, even when no more events arrive
+- close() ends the file properly; app.py calls it on SIGTERM, which skips atexit handlers
+- Recording stops after max_events events
+"""
+
+from datetime import datetime
+import atexit
+import gzip
+import json
+import os
+import threading
+import time
+
+TRACE_FORMAT = 'securechat-trace'
+TRACE_VERSION = 1
+TRACE_FIELDS = ['t_ms', 'conn', 'event', 'user', 'room', 'bytes', 'server_ms', 'target']
+TRACE_SUFFIX = '.jsonl.gz'
+
+# Size of an event's payload as the client sent it, in bytes
+def payload_size(data) -> int:
+    if data is None:
+        return 0
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    try:
+        return len(json.dumps(data, separators=(',', ':')))
+    except (TypeError, ValueError):
+        return 0
+
+# Numbers values in order of first appearance; None stays None
+def pseudonym(mapping: dict, value):
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        pass
+    if value not in mapping:
+        mapping[value] = len(mapping) + 1
+    return mapping[value]
+
+class TrafficRecorder:
+    # start_task and sleep must match the server's async mode (e.g. socketio.start_background_task, socketio.sleep)
+    def __init__(self, directory: str, max_events: int = 1000000, flush_every: int = 256, flush_interval: float = 1.0,
+                 start_task=None, sleep=time.sleep):
+        self.directory = directory
+        self.max_events = max_events
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.start_task = start_task or (lambda fn, *args: threading.Thread(target=fn, args=args, daemon=True).start())
+        self.sleep = sleep
+        self.path = None # Opened with the first event
+        self.recorded = 0
+        self._file = None
+        self._buffer = []
+        self._started = None
+        self._last_flush = 0.0
+        self._connections = {}
+        self._users = {}
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"trace-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}{TRACE_SUFFIX}")
+        self._file = gzip.open(self.path, 'wb')
+        header = {"format": TRACE_FORMAT, "version": TRACE_VERSION, "started_at": datetime.now().isoformat(), "fields": TRACE_FIELDS}
+        self._file.write((json.dumps(header, separators=(',', ':')) + '\n').encode('utf-8'))
+        atexit.register(self.close)
+        self.start_task(self._flush_periodically)
+
+    # Writes buffered lines every flush_interval seconds until the recorder is closed
+    def _flush_periodically(self):
+        while True:
+            self.sleep(self.flush_interval)
+            with self._lock:
+                if self._file is None:
+                    return
+                self._flush()
+
+    # Records one handled event; start is the time.perf_counter() at which its handler started
+    def record(self, event: str, sid: str, user_id, data, start: float):
+        elapsed = time.perf_counter() - start
+        size = payload_size(data)
+        room_id = data.get('room_id') if isinstance(data, dict) else None
+        target_id = data.get('user_id') if isinstance(data, dict) else None
+        with self._lock:
+            if self.recorded >= self.max_events:
+                return
+            if self._file is None:
+                self._open()
+                self._started = start
+            self.recorded += 1
+            user = pseudonym(self._users, user_id)
+            target = pseudonym(self._users, target_id)
+            self._buffer.append([round((start - self._started) * 1000, 3), pseudonym(self._connections, sid), event, user,
+                                 pseudonym(self._rooms, room_id), size, round(elapsed * 1000, 3), target if target != user else None])
+            if len(self._buffer) >= self.flush_every or time.perf_counter() - self._last_flush > self.flush_interval \
+                    or self.recorded == self.max_events:
+                self._flush()
+
+    # Writes buffered lines; GzipFile.flush ends a deflate block, so everything written so far can be read back
+    def _flush(self):
+        if self._file is None or not self._buffer:
+            return
+        self._file.write(''.join(json.dumps(line, separators=(',', ':')) + '\n' for line in self._buffer).encode('utf-8'))
+        self._file.flush()
+        self._buffer.clear()
+        self._last_flush = time.perf_counter()
+
+    # Flushes and closes the trace; with a timeout, gives up if the lock is not free by then
+    # (a signal handler may interrupt the thread that holds it)
+    def close(self, timeout: float = -1):
+        if not self._lock.acquire(timeout=timeout):
+            return
+        try:
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        finally:
+            self._lock.release()
+
+    # Counters for /metrics
+    def stats(self) -> dict:
+        with self._lock:
+            return {"recorded_total": self.recorded, "buffered": len(self._buffer), "max_events": self.max_events}
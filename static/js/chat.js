@@ -1,5 +1,6 @@
 document.addEventListener('DOMContentLoaded', () => {
-    const socket = io();  // Initialize Socket.IO
+    // Initialize Socket.IO, asking for compact room payloads (key fingerprints, columnar messages)
+    const socket = io({ auth: { payload_format: 'compact' } });
 
     // HTML elements
     const messageInput = document.getElementById('chat-input');
@@ -8,9 +9,11 @@ document.addEventListener('DOMContentLoaded', () => {
     const chatRoomsList = document.getElementById('chat-rooms');
     const currentRoomHeader = document.getElementById('current-room');
     const usernameInput = document.getElementById('username-input');
+    const userSuggestions = document.getElementById('user-suggestions');
     const logoutButton = document.getElementById('logout-button');
     const leaveChatButton = document.getElementById('leave-chat-button');
     const toggleSwitch = document.getElementById('toggle-switch');
+    const attachmentInput = document.getElementById('attachment-input');
 
     // Private keys
     const rsaPrivateKey = localStorage.getItem('rsaPrivateKey');
@@ -24,8 +27,28 @@ document.addEventListener('DOMContentLoaded', () => {
     let chat_rooms = []; // List of chat rooms that the user is in
     let messages = []; // List of messages in the current chat room
     let participants = []; // List of participants in the current chat room
-    let session_key = null; // Decrypted session key for the current chat room (AES)
+    let session_key = null; // Decrypted session key for the current chat room (AES), used for new messages
+    let key_epoch = null; // Epoch of session_key
+    let room_keys = {}; // Promises of decrypted keys for the current chat room, by epoch
+    let key_waiters = {}; // Resolvers for keys requested with query_room_keys, by epoch
+    let last_message_id = null; // ID of the newest message received for the current chat room
+    let oldest_message_id = null; // ID of the oldest message loaded for the current chat room
+    let has_more_history = false; // Whether older messages can still be fetched
+    let loading_history = false; // Whether a history page request is in flight
     let signatureType = "RSA"; // Default signature algorithm
+    let public_keys = {}; // Public keys received so far, by fingerprint
+    let pending_rooms = []; // Room payloads waiting for public keys to be fetched
+    const KEY_QUERY_TIMEOUT = 10000; // ms to wait for public keys before showing waiting rooms without them
+    let key_query_timer = null; // Gives up on the public keys pending_rooms wait for
+    const ATTACHMENT_PLAIN_CHUNK = 256 * 1024; // File bytes encrypted and uploaded per request
+    const ATTACHMENT_RETRIES = 5; // Failed chunk uploads retried before giving up
+    const READ_DELAY = 500; // ms between mark_read events for the current room
+    const ROOM_LIST_REFRESH = 30000; // ms between room list refreshes, for unread counts in other rooms
+    let read_timer = null; // Pending mark_read for the current room
+    const SEARCH_DELAY = 250; // ms of typing pause before searching the user directory
+    let search_timer = null; // Pending search_users for the username input
+    let suggestions = []; // Users whose username starts with the username input, from search_users
+    let pending_add = null; // Username looked up with query_user_by_username, to add to the current room
 
     // Run once
     function runOnce() {
@@ -41,6 +64,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
     // Join the new room
     current_room = room;
+    last_message_id = null;
     socket.emit('join_room', { 'room_id': current_room.id });
     socket.emit('query_chat_room', { 'room_id': current_room.id });
     currentRoomHeader.textContent = `Current Room: ${current_room.name}`;
@@ -58,7 +82,7 @@ document.addEventListener('DOMContentLoaded', () => {
         function addChatRoom(room) {
             const li = document.createElement('li');
             const button = document.createElement('button');
-            button.textContent = room.name;
+            button.textContent = room.unread ? `${room.name} (${room.unread})` : room.name;
             button.onclick = () => joinRoom(room);
             li.appendChild(button);
             chatRoomsList.appendChild(li);
@@ -71,6 +95,26 @@ document.addEventListener('DOMContentLoaded', () => {
         chat_rooms.forEach(room => addChatRoom(room));
     }
 
+    // Tell the server the newest message of the current room has been read, at most once per READ_DELAY
+    function markRead() {
+        if (read_timer || !current_room || !last_message_id) {
+            return;
+        }
+        read_timer = setTimeout(() => {
+            read_timer = null;
+            if (!current_room || !last_message_id) {
+                return;
+            }
+            socket.emit('mark_read', {'room_id': current_room.id, 'message_id': last_message_id}, ack => {
+                const room = chat_rooms.find(room => room.id === ack.room_id);
+                if (room && ack.unread != null) {
+                    room.unread = ack.unread;
+                    updateChatRoomsList(chat_rooms);
+                }
+            });
+        }, READ_DELAY);
+    }
+
     // Update the chat room user list
     function updateUserList(new_users) {
         function addUser(user) {
@@ -91,33 +135,127 @@ document.addEventListener('DOMContentLoaded', () => {
         new_users.forEach(user => addUser(user));
     }
 
+    // Add a single message to the messages list
+    // The list item is placed immediately so ordering does not depend on decryption time
+    // If before is given, the message is inserted above that element instead of appended
+    function addMessage(message, before = null) {
+        last_message_id = Math.max(last_message_id || 0, message.id);
+        oldest_message_id = oldest_message_id === null ? message.id : Math.min(oldest_message_id, message.id);
+        const li = document.createElement('li');
+        messagesList.insertBefore(li, before);
+        // Decrypt the message content using the key of the epoch it was sent in
+        let message_key = null;
+        roomKey(message.key_epoch ?? key_epoch).then(key => {
+            message_key = key;
+            return decryptMessage(message.content, key);
+        }).then(decryptedContent => {
+            const user = participants.find(user => user.id === message.sender_id);
+            // Verify the sender's signature either RSA or DSA, unless the server already verified both
+            const checked = message.verified === true ? Promise.resolve(true)
+                : verifySignature(signatureType, decryptedContent, message.signatures, {"RSA": user.rsa_public_key, "DSA": user.dsa_public_key});
+            checked.then(isValid => {
+                if (!isValid) {
+                    console.error('Invalid signature');
+                    li.remove();
+                    return;
+                }
+                console.log(message.verified === true ? 'Signatures verified by the server' : signatureType +' Signature is' + message.signatures[signatureType]);
+                const username = participants.find(user => user.id === message.sender_id).username;
+                li.textContent = `${message.created_at} ${username}: ${decryptedContent}`;
+                if (message.attachment) {
+                    // The content of a message with an attachment is the file name
+                    li.textContent = `${message.created_at} ${username}: `;
+                    const link = document.createElement('a');
+                    link.href = '#';
+                    link.textContent = `${decryptedContent} (${Math.ceil(message.attachment.size / 1024)} KB)`;
+                    link.onclick = (e) => {
+                        e.preventDefault();
+                        downloadAttachment(message.attachment, decryptedContent, message_key).catch(error => {
+                            console.error('Error downloading attachment:', error);
+                        });
+                    };
+                    li.appendChild(link);
+                }
+                }).catch(error => {
+                    console.error('Error verifying signature:', error);
+                });
+        });
+    }
+
     // Update the messages list
     function updateMessagesList(messages) {
-        function addMessage(message, session_key) {
-            // Decrypt the message content using the session key
-            decryptMessage(message.content, session_key).then(decryptedContent => {
-                const user = participants.find(user => user.id === message.sender_id);
-                // Verify the sender's signature either RSA or DSA
-                verifySignature(signatureType, decryptedContent, message.signatures, {"RSA": user.rsa_public_key, "DSA": user.dsa_public_key}).then(isValid => {
-                    if (!isValid) {
-                        console.error('Invalid signature');
-                        return;
-                    }
-                    console.log(signatureType +' Signature is' + message.signatures[signatureType]);
-                    const li = document.createElement('li');
-                    const username = participants.find(user => user.id === message.sender_id).username;
-                    li.textContent = `${message.created_at} ${username}: ${decryptedContent}`;
-                    messagesList.appendChild(li);
-                    }).catch(error => {
-                        console.error('Error verifying signature:', error);
-                    });
-            });
-        }
-
         // Clear the current messages list
         messagesList.innerHTML = '';
+        last_message_id = null;
+        oldest_message_id = null;
+
+        messages.forEach(message => addMessage(message));
+    }
 
-        messages.forEach(message => addMessage(message, session_key));
+    // Returns a promise of the current room's key for an epoch, asking the server for it if needed
+    function roomKey(epoch) {
+        if (!(epoch in room_keys)) {
+            room_keys[epoch] = new Promise(resolve => { key_waiters[epoch] = resolve; });
+            socket.emit('query_room_keys', {'room_id': current_room.id, 'epochs': [epoch]});
+        }
+        return room_keys[epoch];
+    }
+
+    // Decrypt room keys received from the server, given as {epoch: key wrapped with our RSA public key}
+    function storeRoomKeys(wrapped_keys) {
+        Object.entries(wrapped_keys).forEach(([epoch, wrapped_key]) => {
+            const key = decryptSessionKey(wrapped_key, rsaPrivateKey);
+            if (key_waiters[epoch]) {
+                key_waiters[epoch](key);
+                delete key_waiters[epoch];
+            } else {
+                room_keys[epoch] = key;
+            }
+        });
+    }
+
+    // Fetch the previous page of history when scrolled to the top of the messages list
+    messagesList.addEventListener('scroll', () => {
+        if (messagesList.scrollTop > 0 || !current_room || !has_more_history || loading_history) {
+            return;
+        }
+        loading_history = true;
+        socket.emit('query_chat_history', {'room_id': current_room.id, 'before_message_id': oldest_message_id});
+    });
+
+    // Sign, encrypt and send a message to the current room, optionally referencing an uploaded attachment
+    // The server only accepts the room's current key epoch; if the key was rotated before we heard of it,
+    // the message is encrypted again with the new key and resent. An attachment was uploaded under the old key,
+    // so a message with one fails instead and the upload has to be repeated.
+    async function sendMessage(message, attachment_id = null) {
+        const room_id = current_room.id;
+        const rsa_signature = await signMessageRSA(message, rsaPrivateKey);
+        const dsa_signature = await signMessageDSA(message, dsaPrivateKey);
+        let epoch = key_epoch;
+        let key = session_key;
+        for (let attempt = 0; ; attempt++) {
+            const enc_msg = await encryptMessage(message, key);
+            const ack = await new Promise(resolve => socket.emit('send_message_to_room', {
+                'user_id': current_user_id, 'message': enc_msg, 'room_id': room_id, 'rsa_signature': rsa_signature,
+                'dsa_signature': dsa_signature, 'key_epoch': epoch, 'attachment_id': attachment_id}, resolve));
+            if (!ack || !ack.error) {
+                console.log("Message: " + message + " sent to room: " + room_id);
+                console.log("Encrypted message: " + enc_msg);
+                console.log("RSA Signature: " + rsa_signature);
+                console.log("DSA Signature: " + dsa_signature);
+                return;
+            }
+            if (ack.error !== 'stale key epoch' || attachment_id !== null || attempt >= 2
+                    || !current_room || current_room.id !== room_id) {
+                throw new Error(`Message not sent: ${ack.error}`);
+            }
+            epoch = ack.key_epoch;
+            key = await roomKey(epoch);
+            if (current_room && current_room.id === room_id && epoch > key_epoch) {
+                key_epoch = epoch;
+                session_key = key;
+            }
+        }
     }
 
     // Message input event listener
@@ -126,49 +264,141 @@ document.addEventListener('DOMContentLoaded', () => {
                 const message = messageInput.value;
                 e.preventDefault();
                 if (current_room && message) {
-                    // Emit the message event
-                    signMessageRSA(message, rsaPrivateKey).then(rsa_signature => {
-                    signMessageDSA(message, dsaPrivateKey).then(dsa_signature => {
-                    encryptMessage(message, session_key).then(enc_msg => {
-                        socket.emit('send_message_to_room', {'user_id': current_user_id, 'message': enc_msg, 'room_id': current_room.id,
-                                                             'rsa_signature': rsa_signature, 'dsa_signature': dsa_signature});
-                        console.log("Message: " + message + " sent to room: " + current_room.name);
-                        console.log("Encrypted message: " + enc_msg);
-                        console.log("RSA Signature: " + rsa_signature);
-                        console.log("DSA Signature: " + dsa_signature);
+                    sendMessage(message).then(() => {
                         messageInput.value = '';  // Clear the message input
                     }).catch(error => {
-                        console.error('Error encrypting message:', error);
+                        console.error('Error sending message:', error);
                     });
-                }).catch(error => {
-                    console.error('Error signing message with DSA:', error);
-                });
-                }).catch(error => {
-                    console.error('Error signing message with RSA:', error);
-                });
             }
         };
     });
 
-    // Username input event listener
+    // Encrypt a file in chunks with the room key and upload it, resuming after failed chunks
+    // Every chunk is stored as a 4 byte length followed by its IV and ciphertext, so downloads can be split again
+    // Returns the attachment ID
+    async function uploadAttachment(file, room_id, key) {
+        const chunk_count = Math.max(1, Math.ceil(file.size / ATTACHMENT_PLAIN_CHUNK));
+        const record_size = ATTACHMENT_PLAIN_CHUNK + ATTACHMENT_CHUNK_OVERHEAD;
+        const form = new FormData();
+        form.append('room_id', room_id);
+        form.append('size', file.size + chunk_count * ATTACHMENT_CHUNK_OVERHEAD);
+        const created = await fetch('/api/attachments', {method: 'POST', body: form});
+        if (!created.ok) {
+            throw new Error(await created.text());
+        }
+        const attachment_id = (await created.json()).attachment_id;
+        let offset = 0;
+        let failures = 0;
+        while (offset < file.size + chunk_count * ATTACHMENT_CHUNK_OVERHEAD) {
+            const index = offset / record_size;
+            const plain = await file.slice(index * ATTACHMENT_PLAIN_CHUNK, (index + 1) * ATTACHMENT_PLAIN_CHUNK).arrayBuffer();
+            const record = await encryptAttachmentChunk(plain, key);
+            const response = await fetch(`/api/attachments/${attachment_id}?offset=${offset}`, {method: 'PUT', body: record}).catch(() => null);
+            if (response && response.ok) {
+                offset = (await response.json()).received;
+                failures = 0;
+                continue;
+            }
+            if (++failures > ATTACHMENT_RETRIES) {
+                throw new Error(`Upload of ${file.name} failed`);
+            }
+            // Continue from whatever the server has
+            const status = await fetch(`/api/attachments/${attachment_id}/status`).catch(() => null);
+            if (status && status.ok) {
+                offset = (await status.json()).received;
+            }
+        }
+        return attachment_id;
+    }
+
+    // Fetch an attachment, decrypt it chunk by chunk and save it under its file name
+    async function downloadAttachment(attachment, name, key) {
+        const response = await fetch(`/api/attachments/${attachment.id}`);
+        if (!response.ok) {
+            throw new Error(await response.text());
+        }
+        const data = new Uint8Array(await response.arrayBuffer());
+        const parts = [];
+        for (let position = 0; position < data.length;) {
+            const length = new DataView(data.buffer, position, 4).getUint32(0);
+            parts.push(await decryptAttachmentChunk(data.subarray(position + 4, position + 4 + length), key));
+            position += 4 + length;
+        }
+        const link = document.createElement('a');
+        link.href = URL.createObjectURL(new Blob(parts));
+        link.download = name;
+        link.click();
+        setTimeout(() => URL.revokeObjectURL(link.href), 1000);
+    }
+
+    // Attachment input event listener: upload the chosen file, then send its name as the message
+    attachmentInput.addEventListener('change', () => {
+        const file = attachmentInput.files[0];
+        if (!current_room || !file) {
+            return;
+        }
+        uploadAttachment(file, current_room.id, session_key).then(attachment_id => {
+            return sendMessage(file.name, attachment_id);
+        }).then(() => {
+            attachmentInput.value = '';
+        }).catch(error => {
+            console.error('Error sending attachment:', error);
+            alert(`Could not send ${file.name}`);
+        });
+    });
+
+    // Adds a user to the current room and clears the username input
+    function addUser(user) {
+        socket.emit('add_user_to_chat', {'user_id': user.id, 'room_id': current_room.id});
+        console.log("User: " + user.username + " added to room: " + current_room.name);
+        usernameInput.value = '';
+        suggestions = [];
+        userSuggestions.replaceChildren();
+    }
+
+    // Fills the username input's suggestions with users whose username starts with what was typed
+    function searchUsers() {
+        search_timer = null;
+        const prefix = usernameInput.value.trim();
+        if (!prefix) {
+            suggestions = [];
+            userSuggestions.replaceChildren();
+            return;
+        }
+        socket.emit('search_users', {'prefix': prefix}, res => {
+            // Throttled calls have no users, and replies for text that has since changed are stale
+            if (!res.users || res.prefix !== usernameInput.value.trim()) {
+                return;
+            }
+            suggestions = res.users;
+            userSuggestions.replaceChildren(...suggestions.map(user => {
+                const option = document.createElement('option');
+                option.value = user.username;
+                return option;
+            }));
+        });
+    }
+
+    // Username input event listeners: search once typing pauses, add the user on Enter
+    usernameInput.addEventListener('input', () => {
+        clearTimeout(search_timer);
+        search_timer = setTimeout(searchUsers, SEARCH_DELAY);
+    });
+
     usernameInput.addEventListener('keydown', (e) => {
         if (e.key === 'Enter' && !e.shiftKey) {
-            username = usernameInput.value;
+            const username = usernameInput.value.trim();
             e.preventDefault();
             // Must be in a room to add users
             if (current_room && username) {
-                // Query user by username
-                socket.emit('query_user_by_username', {'username': username});
-                socket.on('res_query_user_by_username', data => {
-                    user = { 'id': data.user_id, 'username': username };
-                    if (user.id === -1) {
-                        alert('User not found');
-                        return;
-                    }
-                    socket.emit('add_user_to_chat', {'user_id': user.id, 'room_id': current_room.id});
-                    console.log("User: " + username + " added to room: " + current_room.name);
-                    usernameInput.value = '';  // Clear the username input
-                });
+                const user = suggestions.find(user => user.username === username);
+                if (user) {
+                    addUser(user);
+                } else {
+                    // Not among the suggestions (yet), so look the exact username up
+                    pending_add = username;
+                    socket.emit('query_user_by_username', {'username': username});
+                }
             }
         }
     });
@@ -189,8 +419,10 @@ document.addEventListener('DOMContentLoaded', () => {
     // Leave chat button event listener
     leaveChatButton.onclick = () => {
         if (current_room) {
+            socket.emit('leave_room', { 'room_id': current_room.id });
             socket.emit('remove_user_from_chat', { 'room_id': current_room.id, 'user_id': current_user_id });
             current_room = null;
+            last_message_id = null;
             currentRoomHeader.textContent = 'Current Room: None';
             messagesList.innerHTML = '';
             userList.innerHTML = '';
@@ -214,7 +446,82 @@ document.addEventListener('DOMContentLoaded', () => {
         socket.emit('query_chat_room', { 'room_id': current_room.id });
     });
 
+    // Expand compact columnar messages into one object per message
+    function expandMessages(columns) {
+        return columns.id.map((id, i) => ({
+            'id': id,
+            'sender_id': columns.sender_id[i],
+            'created_at': columns.created_at[i],
+            'content': columns.content[i],
+            'signatures': {"RSA": columns.rsa_signature[i], "DSA": columns.dsa_signature[i]},
+            'key_epoch': columns.key_epoch[i],
+            'attachment': columns.attachment_id[i] == null ? null : {'id': columns.attachment_id[i], 'size': columns.attachment_size[i]},
+            'verified': columns.verified ? columns.verified[i] : null,
+        }));
+    }
+
+    // Remember a participant's public keys by fingerprint
+    // Users who registered but never logged in have empty keys; those are remembered too, so nobody waits for them
+    function cachePublicKeys(user) {
+        if (user.rsa_public_key !== undefined) {
+            public_keys[user.rsa_fingerprint] = user.rsa_public_key;
+        }
+        if (user.dsa_public_key !== undefined) {
+            public_keys[user.dsa_fingerprint] = user.dsa_public_key;
+        }
+    }
+
+    // Fill in participants' public keys from their fingerprints
+    // Returns the ids of participants whose keys have not been fetched yet
+    function attachPublicKeys(users) {
+        users.forEach(user => {
+            user.rsa_public_key = public_keys[user.rsa_fingerprint];
+            user.dsa_public_key = public_keys[user.dsa_fingerprint];
+        });
+        return users.filter(user => user.rsa_public_key === undefined || user.dsa_public_key === undefined).map(user => user.id);
+    }
+
+    // Fetch public keys, retrying when the server is throttling us or busy
+    function queryPublicKeys(user_ids) {
+        socket.emit('query_public_keys', {'user_ids': user_ids}, ack => {
+            if (ack && ack.retry_after != null) {
+                setTimeout(() => queryPublicKeys(user_ids), ack.retry_after * 1000);
+            }
+        });
+    }
+
+    // Show waiting rooms in order, stopping at one whose keys are still being fetched
+    // After KEY_QUERY_TIMEOUT without progress, the waiting rooms are shown with the keys that did arrive
+    function showPendingRooms(give_up = false) {
+        clearTimeout(key_query_timer);
+        key_query_timer = null;
+        while (pending_rooms.length > 0) {
+            if (attachPublicKeys(pending_rooms[0].participants).length > 0 && !give_up) {
+                break;
+            }
+            showRoom(pending_rooms.shift());
+        }
+        if (pending_rooms.length > 0) {
+            key_query_timer = setTimeout(() => showPendingRooms(true), KEY_QUERY_TIMEOUT);
+        }
+    }
+
     // Socket.IO events
+    // Adds the user looked up when Enter was pressed
+    socket.on('res_query_user_by_username', data => {
+        if (data.username !== pending_add) {
+            return;
+        }
+        pending_add = null;
+        if (data.user_id === -1) {
+            alert('User not found');
+            return;
+        }
+        if (current_room) {
+            addUser({'id': data.user_id, 'username': data.username});
+        }
+    });
+
     socket.on('res_query_user_chat_rooms', data => {
         chat_rooms = data.chat_rooms;
 
@@ -223,25 +530,165 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     socket.on('res_query_chat_room', data => {
+        if (data.format === 'compact') {
+            data.messages = expandMessages(data.messages);
+            const missing = attachPublicKeys(data.participants);
+            // Wait for unknown keys, keeping room payloads in the order they arrived
+            if (missing.length > 0 || pending_rooms.length > 0) {
+                pending_rooms.push(data);
+                if (missing.length > 0) {
+                    queryPublicKeys(missing);
+                }
+                if (key_query_timer === null) {
+                    key_query_timer = setTimeout(() => showPendingRooms(true), KEY_QUERY_TIMEOUT);
+                }
+                return;
+            }
+        }
+        showRoom(data);
+    });
+
+    // Public keys for participants that were sent as fingerprints
+    socket.on('res_query_public_keys', data => {
+        data.keys.forEach(key => cachePublicKeys(key));
+        showPendingRooms();
+    });
+
+    // Show a chat room, or append new messages to the one being viewed
+    function showRoom(data) {
+        // Only append if this is an incremental response for the room we are still viewing
+        // The server answers a catch-up that is too far behind with the latest page and since_message_id null,
+        // which replaces the messages shown, as when the room is opened
+        const incremental = data.since_message_id !== null && current_room && current_room.id === data.room_id;
         current_room = { 'id': data.room_id, 'name': data.room_name };
         participants = data.participants;
-        messages = data.messages;
-        const encrypted_session_key = data.user_encrypted_key;
+        if (!incremental) {
+            room_keys = {};
+            key_waiters = {};
+        }
+        key_epoch = data.key_epoch ?? 0;
+        storeRoomKeys(data.user_encrypted_keys ?? {[key_epoch]: data.user_encrypted_key});
 
-        decryptSessionKey(encrypted_session_key, rsaPrivateKey).then(decrypted_session_key => {
-            session_key = decrypted_session_key,
-            updateUserList(participants),
-            updateMessagesList(messages)
+        roomKey(key_epoch).then(decrypted_session_key => {
+            session_key = decrypted_session_key;
+            updateUserList(participants);
+            if (incremental) {
+                messages = messages.concat(data.messages);
+                data.messages.forEach(message => addMessage(message));
+            } else {
+                messages = data.messages;
+                has_more_history = data.has_more;
+                loading_history = false;
+                updateMessagesList(messages);
+            }
+            markRead();
         });
+    }
+
+    // An older page of messages for scroll-back
+    socket.on('res_query_chat_history', data => {
+        loading_history = false;
+        if (data.format === 'compact') {
+            data.messages = expandMessages(data.messages);
+        }
+        if (!current_room || current_room.id !== data.room_id || data.before_message_id !== oldest_message_id) {
+            return;
+        }
+        has_more_history = data.has_more;
+        messages = data.messages.concat(messages);
+        const first = messagesList.firstChild;
+        data.messages.forEach(message => addMessage(message, first));
+    });
+
+    // Keys for epochs requested by roomKey
+    socket.on('res_query_room_keys', data => {
+        if (current_room && current_room.id === data.room_id) {
+            storeRoomKeys(data.user_encrypted_keys);
+        }
+    });
+
+    // The room's key was rotated (e.g. a participant was removed); fetch the new key before sending again
+    socket.on('room_key_rotated', data => {
+        if (current_room && current_room.id === data.room_id) {
+            socket.emit('query_chat_room', {'room_id': current_room.id, 'since_message_id': last_message_id});
+        }
     });
 
     // Any time the state of the chat room changes, requery the room info
+    // Only messages newer than the last one received are fetched
     socket.on('requery_room', data => {
         if (!current_room) {
             console.log('No current room to requery');
             return;
         }
-        socket.emit('query_chat_room', {'room_id': current_room.id});
+        socket.emit('query_chat_room', {'room_id': current_room.id, 'since_message_id': last_message_id});
+    });
+
+    // A new message was sent to the current room
+    socket.on('new_message', data => {
+        if (!current_room || current_room.id !== data.room_id || !session_key) {
+            return;
+        }
+        messages.push(data.message);
+        addMessage(data.message);
+        markRead();
+    });
+
+    // A user was added to the current room
+    socket.on('participant_added', data => {
+        if (!current_room || current_room.id !== data.room_id) {
+            return;
+        }
+        cachePublicKeys(data.participant);
+        participants.push(data.participant);
+        updateUserList(participants);
+    });
+
+    // A user was removed from the current room
+    socket.on('participant_removed', data => {
+        if (!current_room || current_room.id !== data.room_id) {
+            return;
+        }
+        if (data.user_id === current_user_id) {
+            socket.emit('leave_room', { 'room_id': current_room.id });
+            current_room = null;
+            last_message_id = null;
+            currentRoomHeader.textContent = 'Current Room: None';
+            messagesList.innerHTML = '';
+            userList.innerHTML = '';
+            socket.emit('query_user_chat_rooms');
+            return;
+        }
+        participants = participants.filter(user => user.id !== data.user_id);
+        updateUserList(participants);
+    });
+
+    // A user in one of our rooms came online or went offline
+    socket.on('presence_changed', data => {
+        if (!current_room || current_room.id !== data.room_id) {
+            return;
+        }
+        const user = participants.find(user => user.id === data.user_id);
+        if (user) {
+            user.is_online = data.is_online;
+            updateUserList(participants);
+        }
+    });
+
+    // The server rejected an event because we sent too many
+    socket.on('throttled', data => {
+        console.warn(`Throttled ${data.event}, retry after ${data.retry_after}s`);
+        if (data.event === 'send_message_to_room') {
+            alert('You are sending messages too quickly. Please wait a moment and try again.');
+        }
+    });
+
+    // Rejoin the current room after a reconnect and fetch only what was missed
+    socket.on('connect', () => {
+        if (current_room) {
+            socket.emit('join_room', { 'room_id': current_room.id });
+            socket.emit('query_chat_room', {'room_id': current_room.id, 'since_message_id': last_message_id});
+        }
     });
 
     socket.on('chat_created', data => {
@@ -253,4 +700,5 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     runOnce();
+    setInterval(() => socket.emit('query_user_chat_rooms'), ROOM_LIST_REFRESH);
 });
@@ -190,6 +190,30 @@ async function encryptMessage(message, session_key) {
     }
 }
 
+// Bytes an encrypted attachment chunk adds: 4 byte length, 12 byte IV and 16 byte GCM tag
+const ATTACHMENT_CHUNK_OVERHEAD = 4 + 12 + 16;
+
+// Encrypt one chunk of a file with AES
+// Returns a Uint8Array holding the length of what follows (big endian), the IV and the ciphertext
+async function encryptAttachmentChunk(chunk, session_key) {
+    const iv = window.crypto.getRandomValues(new Uint8Array(12));
+    const key = await window.crypto.subtle.importKey("raw", session_key, { name: "AES-GCM" }, false, ["encrypt"]);
+    const ciphertext = await window.crypto.subtle.encrypt({ name: "AES-GCM", iv: iv, tagLength: 128 }, key, chunk);
+
+    const record = new Uint8Array(4 + iv.byteLength + ciphertext.byteLength);
+    new DataView(record.buffer).setUint32(0, iv.byteLength + ciphertext.byteLength);
+    record.set(iv, 4);
+    record.set(new Uint8Array(ciphertext), 4 + iv.byteLength);
+    return record;
+}
+
+// Decrypt one chunk of a file with AES
+// record is the IV followed by the ciphertext, without the length prefix; returns an ArrayBuffer
+async function decryptAttachmentChunk(record, session_key) {
+    const key = await window.crypto.subtle.importKey("raw", session_key, { name: "AES-GCM" }, false, ["decrypt"]);
+    return window.crypto.subtle.decrypt({ name: "AES-GCM", iv: record.slice(0, 12), tagLength: 128 }, key, record.slice(12));
+}
+
 // Sign a message with DSA
 async function signMessageDSA(message, dsaPrivateKey) {
     try {
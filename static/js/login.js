@@ -31,6 +31,8 @@ document.addEventListener('DOMContentLoaded', async () => {
         .then(response => {
             if (response.ok) {
                 window.location.href = '/chat';
+            } else if (response.status === 503) {
+                alert('Server busy, please try again in a moment');
             } else {
                 alert('Login failed');
             }
@@ -16,6 +16,8 @@ document.addEventListener('DOMContentLoaded', () => {
         .then(response => {
             if (response.ok) {
                 window.location.href = '/login';
+            } else if (response.status === 503) {
+                alert('Server busy, please try again in a moment');
             } else {
                 alert('Registration failed');
             }
@@ -0,0 +1,128 @@
+"""
+Rate limiting and coalescing for Socket.IO traffic
+- Token buckets per connection: one for all events and one per limited event type
+- Over-limit calls are rejected with the number of seconds until the next token, so clients can be told to back off
+- Room notifications sent within a short window are collapsed into one emit per room
+- Allowed/throttled and requested/sent counters for /metrics
+"""
+
+import threading
+import time
+
+class TokenBucket:
+    # rate tokens are added per second, up to burst
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    # Takes a token if one is available
+    # Returns 0 on success, otherwise the seconds until a token will be available
+    def take(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+# Parses a limit like "5:20" (5 per second, bursts of up to 20) into (rate, burst)
+# A bucket that never refills would have no retry time to report, so the rate must be positive
+def parse_limit(text: str) -> tuple:
+    rate, _, burst = text.partition(':')
+    rate, burst = float(rate), float(burst or rate)
+    if rate <= 0:
+        raise ValueError(f"Rate limit {text!r} must allow a positive number of calls per second")
+    return (rate, burst)
+
+# Parses limits like "send_message_to_room=5:20,query_chat_room=2:10" into {event: (rate, burst)}
+def parse_limits(text: str) -> dict:
+    limits = {}
+    for item in (text or '').split(','):
+        if not item.strip():
+            continue
+        event, _, budget = item.partition('=')
+        limits[event.strip()] = parse_limit(budget)
+    return limits
+
+class RateLimiter:
+    # connection_limit is (rate, burst) shared by all events of one connection, or None
+    # event_limits is {event: (rate, burst)} for events with their own budget
+    def __init__(self, connection_limit: tuple = None, event_limits: dict = None, clock=time.monotonic):
+        self.connection_limit = connection_limit
+        self.event_limits = event_limits or {}
+        self.clock = clock
+        self._buckets = {} # connection -> {event, or None for the connection budget: TokenBucket}
+        self._lock = threading.Lock()
+        self.allowed = {} # event -> calls allowed
+        self.throttled = {} # event -> calls rejected
+
+    def _bucket(self, connection: str, event: str, limit: tuple, now: float) -> TokenBucket:
+        buckets = self._buckets.setdefault(connection, {})
+        bucket = buckets.get(event)
+        if bucket is None:
+            bucket = buckets[event] = TokenBucket(limit[0], limit[1], now)
+        return bucket
+
+    # Checks one call of event on the connection
+    # Returns 0 if it may run, otherwise the seconds the client should wait before retrying
+    # A call rejected by its event budget does not use up the connection budget
+    def check(self, connection: str, event: str) -> float:
+        with self._lock:
+            now = self.clock()
+            wait = 0
+            event_limit = self.event_limits.get(event)
+            if event_limit is not None:
+                wait = self._bucket(connection, event, event_limit, now).take(now)
+            if not wait and self.connection_limit is not None:
+                wait = self._bucket(connection, None, self.connection_limit, now).take(now)
+            counters = self.throttled if wait else self.allowed
+            counters[event] = counters.get(event, 0) + 1
+            return wait
+
+    # Drops a closed connection's buckets
+    def forget(self, connection: str):
+        with self._lock:
+            self._buckets.pop(connection, None)
+
+    # Counters per event, for /metrics
+    def stats(self) -> dict:
+        with self._lock:
+            events = set(self.allowed) | set(self.throttled)
+            return {event: {"allowed_total": self.allowed.get(event, 0), "throttled_total": self.throttled.get(event, 0)}
+                    for event in sorted(events)}
+
+class RoomCoalescer:
+    # emit(room_id) sends the notification; start_task and sleep must match the server's async mode
+    # (e.g. socketio.start_background_task, socketio.sleep)
+    def __init__(self, emit, window: float = 0.25, start_task=None, sleep=time.sleep):
+        self.emit = emit
+        self.window = window
+        self.start_task = start_task or (lambda fn, *args: threading.Thread(target=fn, args=args, daemon=True).start())
+        self.sleep = sleep
+        self._pending = set() # rooms with a notification scheduled
+        self._lock = threading.Lock()
+        self.requested = 0
+        self.sent = 0
+
+    # Schedules a notification for the room, unless one is already waiting to be sent
+    def notify(self, room_id):
+        with self._lock:
+            self.requested += 1
+            if room_id in self._pending:
+                return
+            self._pending.add(room_id)
+        self.start_task(self._send_later, room_id)
+
+    def _send_later(self, room_id):
+        self.sleep(self.window)
+        with self._lock:
+            self._pending.discard(room_id)
+            self.sent += 1
+        self.emit(room_id)
+
+    # Counters for /metrics
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requested_total": self.requested, "sent_total": self.sent, "pending": len(self._pending)}
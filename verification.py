@@ -0,0 +1,113 @@
+"""
+Server-side verification of message signatures
+- Clients sign the plaintext, so the server decrypts each message with its room key epoch before checking it
+- Both the RSA-PSS and the ECDSA signature are checked against the sender's stored public keys;
+  parsed key objects are cached by crypto.py, once per worker process
+- Clients get new keys at every login, so only messages signed with the keys the sender has now can be checked;
+  the others (and messages from before signing keys were recorded) stay NULL, unknown rather than invalid
+- Messages are queued after they are stored and checked in batches on a worker pool, off the send path
+- Results are saved as Message.verified: True when both signatures are valid, False when either is not
+  (or the content does not decrypt), NULL until checked
+- Clients skip their own check only for messages the server verified; everything else they still check
+- Messages queued while the pool is full stay unchecked; flask --app app verify-signatures catches them up
+"""
+
+from crypto import get_room_key, decrypt_message_AES, verify_signature_RSA, verify_signature_DSA, signing_keys_fingerprint
+import logging
+import threading
+import time
+
+# Whether a db_get_messages_to_verify row was signed with the public keys its sender has stored now
+def signed_with_current_keys(row: tuple) -> bool:
+    rsa_public_key, dsa_public_key, signing_keys = row[6], row[7], row[9]
+    return signing_keys is not None and signing_keys == signing_keys_fingerprint(rsa_public_key, dsa_public_key)
+
+# Input of verify_message, built from a db_get_messages_to_verify row
+# The room key is unwrapped here, so workers never see the master key
+def verification_item(row: tuple, master_key: bytes) -> tuple:
+    message_id, session_id, key_epoch, content, rsa_signature, dsa_signature, rsa_public_key, dsa_public_key, encrypted_key, _ = row
+    room_key = get_room_key(session_id, key_epoch, encrypted_key, master_key)
+    return (content, room_key, rsa_signature, dsa_signature, rsa_public_key, dsa_public_key)
+
+# Whether both signatures of one message are valid
+def verify_message(item: tuple) -> bool:
+    content, room_key, rsa_signature, dsa_signature, rsa_public_key, dsa_public_key = item
+    try:
+        plaintext = decrypt_message_AES(content, room_key)
+    except (ValueError, TypeError, IndexError):
+        return False
+    return verify_signature_RSA(plaintext, rsa_signature, rsa_public_key) \
+        and verify_signature_DSA(plaintext, dsa_signature, dsa_public_key)
+
+# Checks a batch of messages in one pool call; module level so process pools can run it
+def verify_messages(items: list) -> list:
+    return [verify_message(item) for item in items]
+
+class SignatureVerifier:
+    # verify_batch(message_ids) checks and saves a batch, returning {message_id: verified} for the messages it could check
+    # Messages are collected for max_delay seconds, then checked in batches of up to max_batch, one task per batch
+    # start_task and sleep must match the server's async mode (e.g. socketio.start_background_task, socketio.sleep)
+    # Batches run outside any app context, so failures go to logger (e.g. app.logger)
+    def __init__(self, verify_batch, max_batch: int = 64, max_delay: float = 0.05, queue_limit: int = 4096,
+                 start_task=None, sleep=time.sleep, logger=None):
+        self.verify_batch = verify_batch
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue_limit = queue_limit
+        self.start_task = start_task or (lambda fn, *args: threading.Thread(target=fn, args=args, daemon=True).start())
+        self.sleep = sleep
+        self._pending = []
+        self._scheduled = False
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.valid = 0
+        self.invalid = 0
+        self.dropped = 0
+        self.unchecked = 0
+        self.batches = 0
+
+    # Queues a stored message for checking; never waits
+    # Messages beyond queue_limit are dropped and stay unchecked
+    def submit(self, message_id: int):
+        with self._lock:
+            if len(self._pending) >= self.queue_limit:
+                self.dropped += 1
+                return
+            self._pending.append(message_id)
+            self.queued += 1
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.start_task(self._collect)
+
+    def _collect(self):
+        self.sleep(self.max_delay)
+        with self._lock:
+            pending, self._pending, self._scheduled = self._pending, [], False
+        batches = [pending[i:i + self.max_batch] for i in range(0, len(pending), self.max_batch)]
+        for batch in batches[1:]:
+            self.start_task(self._verify, batch)
+        self._verify(batches[0])
+
+    def _verify(self, message_ids: list):
+        try:
+            results = self.verify_batch(message_ids)
+        except Exception:
+            self.logger.exception("Failed to verify the signatures of %d messages", len(message_ids))
+            with self._lock:
+                self.dropped += len(message_ids)
+            return
+        valid = sum(1 for verified in results.values() if verified)
+        with self._lock:
+            self.batches += 1
+            self.valid += valid
+            self.invalid += len(results) - valid
+            self.unchecked += len(message_ids) - len(results)
+
+    # Counters for /metrics
+    def stats(self) -> dict:
+        with self._lock:
+            return {"queued_total": self.queued, "valid_total": self.valid, "invalid_total": self.invalid,
+                    "dropped_total": self.dropped, "unchecked_total": self.unchecked, "batches_total": self.batches,
+                    "pending": len(self._pending)}
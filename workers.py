@@ -0,0 +1,102 @@
+"""
+Bounded worker pools for CPU-heavy work
+- Runs blocking calls (e.g. bcrypt) on native threads or processes so the Socket.IO event loop keeps serving
+- Rejects work immediately when the queue is full instead of letting callers wait forever
+- Gives up on calls that take longer than their timeout; queued calls that time out never start
+- Tracks queue depth and latency
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading
+import time
+
+# Raised when a pool's queue is full
+class PoolBusy(Exception):
+    pass
+
+# Raised when a call does not finish within its timeout
+class PoolTimeout(Exception):
+    pass
+
+class BoundedPool:
+    # kind is 'thread' or 'process'; workers=0 runs calls inline on the caller
+    # sleep is used to wait for results cooperatively, e.g. socketio.sleep
+    def __init__(self, name: str, kind: str = 'thread', workers: int = 4, queue_limit: int = 64,
+                 sleep=time.sleep, poll_interval: float = 0.002):
+        if kind not in ('thread', 'process'):
+            raise ValueError(f"Unknown pool kind: {kind}")
+        self.name = name
+        self.kind = kind
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.sleep = sleep
+        self.poll_interval = poll_interval
+        self._executor = None
+        if workers > 0:
+            executor_class = ThreadPoolExecutor if kind == 'thread' else ProcessPoolExecutor
+            self._executor = executor_class(max_workers=workers)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    # Runs fn(*args) on the pool and returns its result
+    # Raises PoolBusy if workers and queue are all taken, PoolTimeout if the result takes longer than timeout seconds
+    # A call that already started keeps running on its worker after a timeout; its result is discarded
+    def run(self, fn, *args, timeout: float = None):
+        with self._lock:
+            if self.in_flight >= self.workers + self.queue_limit:
+                self.rejected += 1
+                raise PoolBusy(f"{self.name} pool is full")
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        start = time.perf_counter()
+        try:
+            if self._executor is None:
+                return fn(*args)
+            future = self._executor.submit(fn, *args)
+            # Poll quickly at first so short calls return fast, then back off to poll_interval
+            delay = min(0.0005, self.poll_interval)
+            while not future.done():
+                if timeout is not None and time.perf_counter() - start > timeout:
+                    future.cancel()
+                    with self._lock:
+                        self.timed_out += 1
+                    raise PoolTimeout(f"{self.name} pool call took longer than {timeout}s")
+                self.sleep(delay)
+                delay = min(delay * 2, self.poll_interval)
+            return future.result()
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+                self.latency_total += elapsed
+                self.latency_max = max(self.latency_max, elapsed)
+
+    # Number of calls waiting for a free worker
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.workers) if self.workers > 0 else 0
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "queue_limit": self.queue_limit,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth(),
+            "peak_in_flight": self.peak_in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "latency_ms_avg": (self.latency_total / self.completed * 1000) if self.completed else 0.0,
+            "latency_ms_max": self.latency_max * 1000,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)